@@ -0,0 +1,110 @@
+"""Benchmark sparse top-k soft correspondence in ResidualMLPHead against the dense path.
+
+Reports the head's latency and peak memory when it scores the embeddings itself
+(the return_attn=False path) for anchor clouds of several sizes, then the
+accuracy of the full model with each corr_topk: relative flow error and the
+rotation (degrees) and translation differences of the solved poses, against
+the dense model with the same weights. Pass --checkpoint for meaningful
+accuracy numbers; a randomly initialized model has near-uniform attention.
+
+    python scripts/benchmark_corr_topk.py --device cuda --checkpoint model.ckpt
+    python scripts/benchmark_corr_topk.py --device cpu --num-anchor-points 2048
+"""
+from typing import List, Optional
+
+import torch
+import typer
+
+from taxpose.nets.export import load_residual_flow
+from taxpose.nets.transformer_flow import (
+    ResidualFlow_DiffEmbTransformer,
+    ResidualMLPHead,
+)
+from taxpose.nets.transformer_flow_pm import extract_flow_and_weight
+from taxpose.utils.benchmark import measure_latency_and_memory
+from taxpose.utils.se3 import dualflow2pose
+
+
+def make_head_fn(
+    corr_topk, device, batch_size, num_points, num_anchor_points, emb_dims
+):
+    torch.manual_seed(0)
+    head = ResidualMLPHead(emb_dims=emb_dims, corr_topk=corr_topk).to(device).eval()
+    action_emb = torch.randn(batch_size, emb_dims, num_points, device=device)
+    anchor_emb = torch.randn(batch_size, emb_dims, num_anchor_points, device=device)
+    action = torch.randn(batch_size, 3, num_points, device=device)
+    anchor = torch.randn(batch_size, 3, num_anchor_points, device=device)
+
+    def forward():
+        with torch.no_grad():
+            head(action_emb, anchor_emb, action, anchor)
+
+    return forward
+
+
+def predict(model, action, anchor, corr_topk):
+    model.head_action.corr_topk = corr_topk
+    model.head_anchor.corr_topk = corr_topk
+    with torch.no_grad():
+        x_action, x_anchor = model(action, anchor)
+    flow_action, w_action = extract_flow_and_weight(x_action, True)
+    flow_anchor, w_anchor = extract_flow_and_weight(x_anchor, True)
+    T = dualflow2pose(
+        xyz_src=action,
+        xyz_tgt=anchor,
+        flow_src=flow_action,
+        flow_tgt=flow_anchor,
+        weights_src=w_action,
+        weights_tgt=w_anchor,
+        return_transform3d=True,
+        normalization_scehme="softmax",
+        temperature=1,
+    ).get_matrix()
+    return flow_action, T
+
+
+def main(
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    num_anchor_points: List[int] = typer.Option([1024, 2048, 4096]),
+    num_points: int = 1024,
+    corr_topk: List[int] = typer.Option([8, 32, 128]),
+    batch_size: int = 1,
+    emb_dims: int = 512,
+    n_iters: int = 5,
+    checkpoint: Optional[str] = None,
+):
+    dev = torch.device(device)
+    print(f"{'M':>6} {'k':>6} {'latency (ms)':>13} {'peak mem (MB)':>14}")
+    for m in num_anchor_points:
+        for k in [None] + corr_topk:
+            latency_ms, peak_mb = measure_latency_and_memory(
+                make_head_fn,
+                (k, device, batch_size, num_points, m, emb_dims),
+                device,
+                n_iters,
+            )
+            print(f"{m:>6} {str(k or 'dense'):>6} {latency_ms:>13.2f} {peak_mb:>14.1f}")
+
+    torch.manual_seed(0)
+    if checkpoint is not None:
+        model = load_residual_flow(checkpoint, emb_dims=emb_dims, center_feature=True)
+    else:
+        model = ResidualFlow_DiffEmbTransformer(emb_dims=emb_dims, center_feature=True)
+    model = model.to(dev).eval()
+    action = torch.rand(batch_size, num_points, 3, device=dev) - 0.5
+    anchor = torch.rand(batch_size, num_anchor_points[0], 3, device=dev) - 0.5
+    ref_flow, ref_T = predict(model, action, anchor, None)
+
+    print(f"\n{'k':>6} {'flow err':>9} {'rot (deg)':>10} {'trans':>9}")
+    for k in corr_topk:
+        flow, T = predict(model, action, anchor, k)
+        flow_err = ((flow - ref_flow).norm() / ref_flow.norm()).item()
+        # ||R - R_ref||_F = 2 sqrt(2) sin(theta / 2), stable for small angles.
+        chord = (T[:, :3, :3] - ref_T[:, :3, :3]).norm(dim=(1, 2))
+        rot_deg = torch.rad2deg(2 * torch.asin(chord / 2**1.5)).max().item()
+        trans = (T[:, 3, :3] - ref_T[:, 3, :3]).norm(dim=-1).max().item()
+        print(f"{k:>6} {flow_err:>9.2e} {rot_deg:>10.3f} {trans:>9.2e}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
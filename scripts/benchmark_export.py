@@ -0,0 +1,98 @@
+"""Benchmark CPU inference of ResidualFlow_DiffEmbTransformer: eager vs. exported.
+
+Compares the eager model with the TorchScript and ONNX Runtime exports from
+`taxpose.nets.export` on action/anchor clouds of several sizes. Each measurement
+runs in a fresh process, which also reports the increase in max RSS. Random
+weights are used unless a checkpoint is given; latency does not depend on them.
+
+    python scripts/benchmark_export.py
+    python scripts/benchmark_export.py --num-points 1024 --num-threads 4
+"""
+import os
+import tempfile
+from typing import List, Optional
+
+import torch
+import typer
+
+from taxpose.nets.export import (
+    ExportableResidualFlow,
+    export_onnx,
+    export_torchscript,
+    load_residual_flow,
+)
+from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
+from taxpose.utils.benchmark import measure_latency_and_memory
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+def make_forward_fn(backend, checkpoint, emb_dims, batch_size, num_points, threads):
+    torch.manual_seed(0)
+    torch.set_num_threads(threads)
+    if checkpoint is None:
+        model = ResidualFlow_DiffEmbTransformer(emb_dims=emb_dims, center_feature=True)
+    else:
+        model = load_residual_flow(checkpoint, emb_dims=emb_dims, center_feature=True)
+    action = torch.randn(batch_size, num_points, 3)
+    anchor = torch.randn(batch_size, num_points, 3)
+
+    if backend == "eager":
+        run = model
+    elif backend == "torchscript":
+        path = os.path.join(tempfile.mkdtemp(), "model.pt")
+        run = export_torchscript(ExportableResidualFlow(model), path)
+    elif backend == "onnxruntime":
+        path = os.path.join(tempfile.mkdtemp(), "model.onnx")
+        export_onnx(ExportableResidualFlow(model), path)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        inputs = {"points_action": action.numpy(), "points_anchor": anchor.numpy()}
+        return lambda: session.run(None, inputs)
+    else:
+        raise ValueError(f"unknown backend: {backend}")
+
+    def forward():
+        with torch.no_grad():
+            run(action, anchor)
+
+    # The TorchScript profiling executor optimizes the graph on the second call.
+    forward()
+    forward()
+    return forward
+
+
+def main(
+    num_points: List[int] = typer.Option([512, 1024, 2048]),
+    checkpoint: Optional[str] = None,
+    emb_dims: int = 512,
+    batch_size: int = 1,
+    num_threads: int = torch.get_num_threads(),
+    n_iters: int = 10,
+):
+    backends = ["eager", "torchscript"]
+    if onnxruntime is not None:
+        backends.append("onnxruntime")
+    else:
+        print("onnxruntime is not installed, skipping the ONNX backend")
+
+    print(f"{'N':>6} {'backend':>12} {'latency (ms)':>13} {'peak mem (MB)':>14}")
+    for n in num_points:
+        for backend in backends:
+            latency_ms, peak_mb = measure_latency_and_memory(
+                make_forward_fn,
+                (backend, checkpoint, emb_dims, batch_size, n, num_threads),
+                "cpu",
+                n_iters,
+            )
+            print(f"{n:>6} {backend:>12} {latency_ms:>13.2f} {peak_mb:>14.1f}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
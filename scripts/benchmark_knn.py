@@ -0,0 +1,64 @@
+"""Benchmark the DGCNN kNN graph builder against the original dense implementation.
+
+Reports latency and peak memory for building the kNN index at several cloud sizes.
+On CUDA, peak memory comes from the caching allocator; on CPU, each measurement runs
+in a fresh process and the increase in max RSS is reported.
+
+    python scripts/benchmark_knn.py --device cuda
+    python scripts/benchmark_knn.py --device cpu --num-points 1024 --num-points 4096
+"""
+from typing import List
+
+import torch
+import typer
+
+from taxpose.utils.benchmark import measure_latency_and_memory
+from third_party.dcp import model as dcp_model
+
+
+def knn_dense(x, k):
+    """The original DCP implementation: materializes the full B x N x N distance matrix."""
+    inner = -2 * torch.matmul(x.transpose(2, 1).contiguous(), x)
+    xx = torch.sum(x**2, dim=1, keepdim=True)
+    pairwise_distance = -xx - inner - xx.transpose(2, 1).contiguous()
+    return pairwise_distance.topk(k=k, dim=-1)[1]
+
+
+def make_knn_fn(backend, device, batch_size, num_points, k, chunk_size):
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, 3, num_points, device=device)
+    if backend == "dense":
+        return lambda: knn_dense(x, k)
+    elif backend == "chunked":
+        return lambda: dcp_model.knn(x, k, chunk_size=chunk_size)
+    elif backend == "kdtree":
+        return lambda: dcp_model.knn_kdtree(x, k)
+    raise ValueError(f"unknown backend: {backend}")
+
+
+def main(
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    num_points: List[int] = typer.Option([1024, 2048, 4096, 8192]),
+    batch_size: int = 8,
+    k: int = 20,
+    chunk_size: int = dcp_model.KNN_CHUNK_SIZE,
+    n_iters: int = 10,
+):
+    backends = ["dense", "chunked"]
+    if torch.device(device).type == "cpu" and dcp_model.torch_cluster is not None:
+        backends.append("kdtree")
+
+    print(f"{'N':>6} {'backend':>8} {'latency (ms)':>13} {'peak mem (MB)':>14}")
+    for n in num_points:
+        for backend in backends:
+            latency_ms, peak_mb = measure_latency_and_memory(
+                make_knn_fn,
+                (backend, device, batch_size, n, k, chunk_size),
+                device,
+                n_iters,
+            )
+            print(f"{n:>6} {backend:>8} {latency_ms:>13.2f} {peak_mb:>14.1f}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,42 @@
+"""Benchmark per-sample loading time of JointOccTrainDataset.
+
+    python scripts/benchmark_ndf_dataset.py /path/to/ndf_data --num-samples 200
+"""
+import random
+import time
+
+import numpy as np
+import torch
+import typer
+
+from taxpose.datasets.ndf_dataset import JointOccTrainDataset
+
+
+def main(
+    ndf_data_path: str,
+    num_samples: int = 100,
+    depth_aug: bool = True,
+    multiview_aug: bool = True,
+    obj_class: str = "all",
+    seed: int = 0,
+):
+    dataset = JointOccTrainDataset(
+        ndf_data_path,
+        depth_aug=depth_aug,
+        multiview_aug=multiview_aug,
+        obj_class=obj_class,
+    )
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    idxs = np.random.randint(len(dataset), size=num_samples)
+    dataset[idxs[0]]
+    start = time.perf_counter()
+    for i in idxs:
+        dataset[i]
+    ms = (time.perf_counter() - start) / num_samples * 1000
+    print(f"{ms:.2f} ms/sample ({1000 / ms:.1f} samples/s per worker)")
+
+
+if __name__ == "__main__":
+    typer.run(main)
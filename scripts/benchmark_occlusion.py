@@ -0,0 +1,75 @@
+"""Benchmark the batched occlusion masks against looping the single-cloud ops.
+
+For each batch size, reports the latency of occluding B clouds of 10k points
+with ball_occlusion/plane_occlusion one cloud at a time, and with the batched
+ball_occlusion_mask/plane_occlusion_mask.
+
+    python scripts/benchmark_occlusion.py --device cuda
+"""
+from typing import List
+
+import torch
+import typer
+
+from taxpose.utils.benchmark import time_fn
+from taxpose.utils.occlusion_utils import (
+    ball_occlusion,
+    ball_occlusion_mask,
+    plane_occlusion,
+    plane_occlusion_mask,
+)
+
+
+def main(
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    batch_size: List[int] = typer.Option([1, 8, 32]),
+    num_points: int = 10000,
+    radius: float = 0.1,
+    stand_off: float = 0.04,
+    num_occluders: int = 1,
+    n_iters: int = 20,
+):
+    dev = torch.device(device)
+    torch.manual_seed(0)
+
+    print(f"{'B':>4} {'op':>6} {'looped (ms)':>12} {'batched (ms)':>13}")
+    for b in batch_size:
+        points = 0.1 * torch.randn(b, num_points, 3, device=dev)
+        # Ragged batch: every other cloud is half padding.
+        lengths = torch.full((b,), num_points, device=dev)
+        lengths[1::2] = num_points // 2
+
+        def looped_ball():
+            for p, n in zip(points, lengths.tolist()):
+                for _ in range(num_occluders):
+                    p = ball_occlusion(p[:n], radius=radius)
+
+        def looped_plane():
+            for p, n in zip(points, lengths.tolist()):
+                for _ in range(num_occluders):
+                    p = plane_occlusion(p[:n], stand_off=stand_off)
+
+        def batched_ball():
+            ball_occlusion_mask(
+                points, lengths=lengths, radius=radius, num_occluders=num_occluders
+            )
+
+        def batched_plane():
+            plane_occlusion_mask(
+                points,
+                lengths=lengths,
+                stand_off=stand_off,
+                num_occluders=num_occluders,
+            )
+
+        for name, looped, batched in [
+            ("ball", looped_ball, batched_ball),
+            ("plane", looped_plane, batched_plane),
+        ]:
+            looped_ms = time_fn(looped, n_iters, dev)
+            batched_ms = time_fn(batched, n_iters, dev)
+            print(f"{b:>4} {name:>6} {looped_ms:>12.3f} {batched_ms:>13.3f}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
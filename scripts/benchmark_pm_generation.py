@@ -0,0 +1,53 @@
+"""Benchmark PlaceDataset sample generation with and without pooled render environments.
+
+Generates n_repeat samples of each scene, as cached-dataset generation does,
+and reports samples/sec for each env_pool_size.
+
+    python scripts/benchmark_pm_generation.py --pm-root /data/partnet-mobility --n-scenes 4
+"""
+import time
+from pathlib import Path
+from typing import List
+
+import typer
+
+from taxpose.datasets.pm_placement import PlaceDataset, scenes_by_location
+
+
+def main(
+    pm_root: Path = typer.Option(..., dir_okay=True, file_okay=False),
+    mode: str = "obs",
+    goal_location: str = "top",
+    n_scenes: int = 4,
+    n_repeat: int = 10,
+    env_pool_size: List[int] = typer.Option([0, 4]),
+    seed: int = 0,
+):
+    scene_ids = [
+        (*scene[:3], goal_location)
+        for scene in scenes_by_location("train", mode, goal_location)[:n_scenes]
+    ]
+    print(f"{'pool size':>9} {'samples/s':>10}")
+    for size in env_pool_size:
+        dset = PlaceDataset(
+            root=str(pm_root),
+            scene_ids=scene_ids,
+            randomize_camera=True,
+            mode=mode,
+            snap_to_surface=True,
+            full_obj=True,
+            even_downsample=True,
+            env_pool_size=size,
+        )
+        start = time.perf_counter()
+        for scene_id in scene_ids:
+            for i in range(n_repeat):
+                dset.get_data(*scene_id, seed=seed + i)
+        elapsed = time.perf_counter() - start
+        if dset.env_pool is not None:
+            dset.env_pool.close()
+        print(f"{size:>9} {len(scene_ids) * n_repeat / elapsed:>10.2f}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,76 @@
+"""Benchmark ResidualFlow_DiffEmbTransformer.forward with and without memory-efficient attention.
+
+Reports inference latency and peak memory for action/anchor clouds of several sizes.
+With --fuse-twin-branches, the action and anchor branches run as one fused pass.
+
+    python scripts/benchmark_transformer_flow.py --device cuda
+    python scripts/benchmark_transformer_flow.py --device cpu --num-points 1024 --num-points 2048
+"""
+from typing import List
+
+import torch
+import typer
+
+from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
+from taxpose.utils.benchmark import measure_latency_and_memory
+
+
+def make_forward_fn(
+    memory_efficient_attn,
+    device,
+    batch_size,
+    num_points,
+    emb_dims,
+    cycle,
+    fuse_twin_branches=False,
+):
+    torch.manual_seed(0)
+    model = ResidualFlow_DiffEmbTransformer(
+        emb_dims=emb_dims,
+        cycle=cycle,
+        memory_efficient_attn=memory_efficient_attn,
+        fuse_twin_branches=fuse_twin_branches,
+    )
+    model = model.to(device).eval()
+    action = torch.randn(batch_size, num_points, 3, device=device)
+    anchor = torch.randn(batch_size, num_points, 3, device=device)
+
+    def forward():
+        with torch.no_grad():
+            model(action, anchor)
+
+    return forward
+
+
+def main(
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+    num_points: List[int] = typer.Option([1024, 2048, 4096, 8192]),
+    batch_size: int = 1,
+    emb_dims: int = 512,
+    cycle: bool = True,
+    n_iters: int = 5,
+    fuse_twin_branches: bool = False,
+):
+    print(f"{'N':>6} {'attention':>10} {'latency (ms)':>13} {'peak mem (MB)':>14}")
+    for n in num_points:
+        for memory_efficient_attn in [False, True]:
+            latency_ms, peak_mb = measure_latency_and_memory(
+                make_forward_fn,
+                (
+                    memory_efficient_attn,
+                    device,
+                    batch_size,
+                    n,
+                    emb_dims,
+                    cycle,
+                    fuse_twin_branches,
+                ),
+                device,
+                n_iters,
+            )
+            name = "efficient" if memory_efficient_attn else "dense"
+            print(f"{n:>6} {name:>10} {latency_ms:>13.2f} {peak_mb:>14.1f}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
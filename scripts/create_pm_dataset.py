@@ -5,7 +5,12 @@ from pathlib import Path
 import typer
 from rpad.pyg.dataset import CachedByKeyDataset
 
-from taxpose.datasets.pm_placement import PlaceDataset, scenes_by_location
+from taxpose.datasets.pm_placement import (
+    PlaceDataset,
+    scenes_by_location,
+    shard_store_dir,
+)
+from taxpose.datasets.shard_store import build_shards, print_worker_stats
 
 
 class Split(str, Enum):
@@ -35,6 +40,10 @@ def main(
     full_obj: bool = True,
     even_downsample: bool = True,
     seed: int = 123456,
+    env_pool_size: int = 4,
+    sharded: bool = False,
+    shard_size: int = 50,
+    retry_failed: bool = False,
 ):
     # This is so we can properly distribute.
     os.environ["OPENBLAS_NUM_THREADS"] = "1"
@@ -64,8 +73,30 @@ def main(
         full_obj=full_obj,
         even_downsample=even_downsample,
         rotate_anchor=rotate_anchor,
+        env_pool_size=env_pool_size,
     )
 
+    if sharded:
+        # Resumable: only samples missing from the shard store are generated.
+        for mode, scene_ids, mode_seed in [
+            ("obs", obs_scene_ids, 123456),
+            ("goal", goal_scene_ids, 654321),
+        ]:
+            print(f"Building {mode} samples in {shard_store_dir(pm_root)}")
+            stats = build_shards(
+                PlaceDataset,
+                {**dset_kwargs, "scene_ids": scene_ids, "mode": mode},
+                scene_ids,
+                shard_store_dir(pm_root),
+                n_repeat=n_repeat,
+                seed=mode_seed,
+                shard_size=shard_size,
+                n_workers=n_workers,
+                retry_failed=retry_failed,
+            )
+            print_worker_stats(stats)
+        return
+
     obs_dset = CachedByKeyDataset(
         dset_cls=PlaceDataset,
         dset_kwargs={
@@ -47,7 +47,8 @@ from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
 from taxpose.training.flow_equivariance_training_module_nocentering_eval_init import (
     EquivarianceTestingModule,
 )
-from taxpose.utils.ndf_sim_utils import get_clouds, get_object_clouds
+from taxpose.utils.ndf_sim_utils import get_clouds, get_object_clouds, settle_bodies
+from taxpose.utils.parallel_eval import resolve_config, run_sharded_eval, seed_trial
 
 NOISE_VALUE_LIST = [0.01, 0.02, 0.03, 0.04, 0.06, 0.08, 0.16, 0.24, 0.32, 0.4]
 
@@ -84,7 +85,15 @@ def get_world_transform(pred_T_action_mat, obj_start_pose, point_cloud, invert=F
     return final_pose
 
 
-def load_data(num_points, clouds, classes, action_class, anchor_class):
+def load_data(
+    num_points,
+    clouds,
+    classes,
+    action_class,
+    anchor_class,
+    device="cuda",
+    num_samples=1,
+):
     points_raw_np = clouds
     classes_raw_np = classes
 
@@ -99,12 +108,14 @@ def load_data(num_points, clouds, classes, action_class, anchor_class):
     points_action = torch.from_numpy(points_action_np).float().unsqueeze(0)
     points_anchor = torch.from_numpy(points_anchor_np).float().unsqueeze(0)
 
-    points_action, points_anchor = subsample(num_points, points_action, points_anchor)
+    points_action, points_anchor = subsample(
+        num_points, points_action, points_anchor, num_samples
+    )
 
-    return points_action.cuda(), points_anchor.cuda()
+    return points_action.to(device), points_anchor.to(device)
 
 
-def load_data_raw(num_points, clouds, classes, action_class, anchor_class):
+def load_data_raw(num_points, clouds, classes, action_class, anchor_class, device="cuda"):
     points_raw_np = clouds
     classes_raw_np = classes
 
@@ -119,10 +130,13 @@ def load_data_raw(num_points, clouds, classes, action_class, anchor_class):
     if points_action is None:
         return None, None
 
-    return points_action.cuda(), points_anchor.cuda()
+    return points_action.to(device), points_anchor.to(device)
 
 
-def subsample(num_points, points_action, points_anchor):
+def subsample(num_points, points_action, points_anchor, num_samples=1):
+    # Each of the num_samples copies starts FPS from its own random point.
+    points_action = points_action.repeat(num_samples, 1, 1)
+    points_anchor = points_anchor.repeat(num_samples, 1, 1)
     if points_action.shape[1] > num_points:
         points_action, _ = sample_farthest_points(
             points_action, K=num_points, random_start_point=True
@@ -150,6 +164,13 @@ def subsample(num_points, points_action, points_anchor):
     return points_action, points_anchor
 
 
+def infer_transform(model, points_action, points_anchor, num_hypotheses, fusion):
+    """Pose from one forward pass, or the consensus of num_hypotheses subsamples."""
+    if num_hypotheses > 1:
+        return model.get_consensus_transform(points_action, points_anchor, mode=fusion)
+    return model.get_transform(points_action, points_anchor)
+
+
 def pb2mc_update(recorder, mc_vis, stop_event, run_event):
     iters = 0
     # while True:
@@ -174,24 +195,7 @@ def create_target_desc_subdir(demo_path, parent_model_path, child_model_path):
     return dirname
 
 
-def main(args):
-
-    hydra.initialize(config_path="../configs", job_name="eval_bottle_rndf")
-    # TODO: Make sure I set different tasks etc.
-    if args.child_load_pose_type == "random_upright":
-        pose_dist = "upright"
-    else:
-        pose_dist = "arbitrary"
-
-    hydra_cfg = hydra.compose(
-        config_name="eval_full_bottle_place",
-        overrides=["pose_dist={:s}".format(pose_dist)],
-        return_hydra_config=True
-    )
-    hydra.core.hydra_config.HydraConfig.instance().set_config(hydra_cfg)
-
-    pl.seed_everything(hydra_cfg.seed)
-
+def build_models(hydra_cfg):
     place_network = ResidualFlow_DiffEmbTransformer(
         emb_dims=hydra_cfg.emb_dims,
         emb_nn=hydra_cfg.emb_nn,
@@ -201,6 +205,8 @@ def main(args):
         return_flow_component=hydra_cfg.return_flow_component,
         freeze_embnn=hydra_cfg.freeze_embnn,
         return_attn=hydra_cfg.return_attn,
+        anchor_emb_cache_size=hydra_cfg.anchor_emb_cache_size,
+        fuse_twin_branches=hydra_cfg.fuse_twin_branches,
     )
 
     place_model = EquivarianceTestingModule(
@@ -209,6 +215,9 @@ def main(args):
         image_log_period=hydra_cfg.image_logging_period,
         weight_normalize=hydra_cfg.weight_normalize_place,
         loop=hydra_cfg.loop,
+        refine_rot_tol=hydra_cfg.refine_rot_tol,
+        refine_trans_tol=hydra_cfg.refine_trans_tol,
+        precision=hydra_cfg.precision,
     )
 
     place_model.cuda()
@@ -219,6 +228,12 @@ def main(args):
         )
         log_info("Model Loaded from " + str(hydra_cfg.checkpoint_file_place))
 
+    return {"place": place_model}
+
+
+def evaluate(args, trial_ids, models):
+    place_model = models["place"]
+
     #####################################################################################
     # set up all generic experiment info
     assert args.relation_method in ['intersection', 'ebm'], 'Invalid argument for --relation_method'
@@ -593,8 +608,12 @@ def main(args):
     #####################################################################################
     # start experiment: sample parent and child object on each iteration and infer the relation
     place_success_list = []
+    trial_results = []
+
+    for iteration in trial_ids:
+        seed_trial(args.seed, iteration)
+        settle_steps = 0
 
-    for iteration in range(args.start_iteration, args.num_iterations):
         #####################################################################################
         # set up the trial
         
@@ -820,7 +839,7 @@ def main(args):
             # safeCollisionFilterPair(obj_id, table_id, -1, -1, enableCollision=True)
             safeCollisionFilterPair(obj_id, table_id, -1, table_base_id, enableCollision=True)
 
-            time.sleep(1.5)
+            settle_steps += settle_bodies(pb_client, [obj_id], max_time=1.5)
 
             pc_master_dict[pc]['pb_obj_id'] = obj_id
 
@@ -883,16 +902,25 @@ def main(args):
             classes=tmp_obj_classes,
             action_class=0,
             anchor_class=1,
+            device=place_model.device,
         )
         points_mug, points_rack = load_data(
             num_points=1024,
+            num_samples=args.num_hypotheses,
             clouds=tmp_obj_points,
             classes=tmp_obj_classes,
             action_class=0,
             anchor_class=1,
+            device=place_model.device,
         )
 
-        ans = place_model.get_transform(points_mug, points_rack)  # 1, 4, 4
+        ans = infer_transform(
+            place_model,
+            points_mug,
+            points_rack,
+            args.num_hypotheses,
+            args.hypothesis_fusion,
+        )  # 1, 4, 4
 
         pred_T_action_init = ans["pred_T_action"]
         pred_T_action_mat = pred_T_action_init.get_matrix()[0].T.detach().cpu().numpy()
@@ -959,13 +987,10 @@ def main(args):
         # safeCollisionFilterPair(pc_master_dict['child']['pb_obj_id'], table_id, -1, -1, enableCollision=False)
         safeCollisionFilterPair(pc_master_dict['child']['pb_obj_id'], table_id, -1, table_base_id, enableCollision=False)
 
-        time.sleep(3.0)
-
         # turn on the physics and let things settle to evaluate success/failure
-        pb_client.set_step_sim(False)
+        settle_steps += settle_bodies(pb_client, [child_obj_id, parent_obj_id], max_time=2.0)
 
         # evaluation criteria
-        time.sleep(2.0)
         
         success_crit_dict = {}
         kvs = {}
@@ -1030,9 +1055,8 @@ def main(args):
         # reset child to this state
         pb_client.reset_body(child_obj_id, final_child_pose_upside_down_list[:3], final_child_pose_upside_down_list[3:]) 
 
-        # turn on the simulation and wait for a couple seconds
-        pb_client.set_step_sim(False)
-        time.sleep(2.0)
+        # turn on the simulation and wait for things to settle
+        settle_steps += settle_bodies(pb_client, [child_obj_id, parent_obj_id], max_time=2.0)
 
         # check if they are still in contact (they shouldn't be)
         ud_obj_surf_contacts = p.getContactPoints(parent_obj_id, child_obj_id, -1, -1)
@@ -1044,7 +1068,8 @@ def main(args):
         place_success = np.all(np.asarray(list(success_crit_dict.values())))
         
         place_success_list.append(place_success)
-        log_str = 'Iteration: %d, ' % iteration
+        trial_results.append(dict(trial=iteration, place_success=place_success, settle_steps=settle_steps))
+        log_str = 'Iteration: %d, settle steps: %d, ' % (iteration, settle_steps)
 
         kvs['Place Success'] = sum(place_success_list) / float(len(place_success_list))
 
@@ -1073,6 +1098,7 @@ def main(args):
             success_criteria_dict=success_crit_dict,
             place_success=place_success,
             place_success_list=place_success_list,
+            settle_steps=settle_steps,
             mesh_file=obj_obj_file,
             args=args.__dict__,
             cfg=util.cn2dict(cfg),
@@ -1099,6 +1125,49 @@ def main(args):
         mc_vis['scene/final_child_pcd'].delete()
         pause_mc_thread(False)
 
+    return trial_results
+
+
+def main(args):
+
+    hydra.initialize(config_path="../configs", job_name="eval_bottle_rndf")
+    # TODO: Make sure I set different tasks etc.
+    if args.child_load_pose_type == "random_upright":
+        pose_dist = "upright"
+    else:
+        pose_dist = "arbitrary"
+
+    hydra_cfg = hydra.compose(
+        config_name="eval_full_bottle_place",
+        overrides=["pose_dist={:s}".format(pose_dist)],
+        return_hydra_config=True
+    )
+    hydra.core.hydra_config.HydraConfig.instance().set_config(hydra_cfg)
+
+    pl.seed_everything(hydra_cfg.seed)
+
+    trial_ids = list(range(args.start_iteration, args.num_iterations))
+    if args.num_eval_workers > 1:
+        # Workers are headless and cannot resolve ${hydra:...} interpolations.
+        hydra_cfg = resolve_config(hydra_cfg)
+        args.pybullet_viz = False
+
+    results = run_sharded_eval(
+        evaluate,
+        (args,),
+        trial_ids,
+        build_models,
+        (hydra_cfg,),
+        ["place"],
+        args.num_eval_workers,
+    )
+    place_success_list = [r['place_success'] for r in results]
+    settle_steps = [r['settle_steps'] for r in results]
+    log_info('Trials: %d, Place Success: %.3f, Mean settle steps: %.1f' % (
+        len(results),
+        sum(place_success_list) / float(max(len(results), 1)),
+        sum(settle_steps) / float(max(len(results), 1))))
+
 
 # python -m scripts.eval_rndf --parent_class syn_rack_easy --child_class mug --exp mug_on_rack_upright_pose_new --parent_model_path ndf_vnn/rndf_weights/ndf_rack.pth --child_model_path ndf_vnn/rndf_weights/ndf_mug2.pth --is_child_shapenet_obj --rel_demo_exp release_demos/mug_on_rack_relation --pybullet_server --opt_iterations 650 --num_iterations 100 --new_descriptors --parent_load_pose_type random_upright --child_load_pose_type any_pose --pybullet_viz
 
@@ -1126,6 +1195,9 @@ if __name__ == "__main__":
     parser.add_argument('--resume_iter', type=int, default=0)
     parser.add_argument('--save_all_opt_results', action='store_true', help='If True, then we will save point clouds for all optimization runs, otherwise just save the best one (which we execute)')
     parser.add_argument('--start_iteration', type=int, default=0)
+    parser.add_argument('--num_hypotheses', type=int, default=1, help='If > 1, fuse the poses predicted from this many subsamples of the scene')
+    parser.add_argument('--hypothesis_fusion', type=str, default='medoid', help='either "medoid" or "mean"')
+    parser.add_argument('--num_eval_workers', type=int, default=1, help='If > 1, shard the trials across this many headless PyBullet worker processes')
 
     parser.add_argument('--single_instance', action='store_true')
     parser.add_argument('--rand_mesh_scale', action='store_true')
@@ -46,7 +46,8 @@ from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
 from taxpose.training.flow_equivariance_training_module_nocentering_eval_init import (
     EquivarianceTestingModule,
 )
-from taxpose.utils.ndf_sim_utils import get_clouds, get_object_clouds
+from taxpose.utils.ndf_sim_utils import get_clouds, get_object_clouds, settle_bodies
+from taxpose.utils.parallel_eval import resolve_config, run_sharded_eval, seed_trial
 
 # Gotta do some path hacking to convince ndf_robot to work.
 NDF_ROOT = Path(__file__).parent.parent / "third_party" / "ndf_robot"
@@ -86,7 +87,15 @@ def get_world_transform(pred_T_action_mat, obj_start_pose, point_cloud, invert=F
     return final_pose
 
 
-def load_data(num_points, clouds, classes, action_class, anchor_class):
+def load_data(
+    num_points,
+    clouds,
+    classes,
+    action_class,
+    anchor_class,
+    device="cuda",
+    num_samples=1,
+):
     points_raw_np = clouds
     classes_raw_np = classes
 
@@ -101,12 +110,16 @@ def load_data(num_points, clouds, classes, action_class, anchor_class):
     points_action = torch.from_numpy(points_action_np).float().unsqueeze(0)
     points_anchor = torch.from_numpy(points_anchor_np).float().unsqueeze(0)
 
-    points_action, points_anchor = subsample(num_points, points_action, points_anchor)
+    points_action, points_anchor = subsample(
+        num_points, points_action, points_anchor, num_samples
+    )
 
-    return points_action.cuda(), points_anchor.cuda()
+    return points_action.to(device), points_anchor.to(device)
 
 
-def load_data_raw(num_points, clouds, classes, action_class, anchor_class):
+def load_data_raw(
+    num_points, clouds, classes, action_class, anchor_class, device="cuda"
+):
     points_raw_np = clouds
     classes_raw_np = classes
 
@@ -121,10 +134,13 @@ def load_data_raw(num_points, clouds, classes, action_class, anchor_class):
     if points_action is None:
         return None, None
 
-    return points_action.cuda(), points_anchor.cuda()
+    return points_action.to(device), points_anchor.to(device)
 
 
-def subsample(num_points, points_action, points_anchor):
+def subsample(num_points, points_action, points_anchor, num_samples=1):
+    # Each of the num_samples copies starts FPS from its own random point.
+    points_action = points_action.repeat(num_samples, 1, 1)
+    points_anchor = points_anchor.repeat(num_samples, 1, 1)
     if points_action.shape[1] > num_points:
         points_action, _ = sample_farthest_points(
             points_action, K=num_points, random_start_point=True
@@ -152,6 +168,13 @@ def subsample(num_points, points_action, points_anchor):
     return points_action, points_anchor
 
 
+def infer_transform(model, points_action, points_anchor, num_hypotheses, fusion):
+    """Pose from one forward pass, or the consensus of num_hypotheses subsamples."""
+    if num_hypotheses > 1:
+        return model.get_consensus_transform(points_action, points_anchor, mode=fusion)
+    return model.get_transform(points_action, points_anchor)
+
+
 def write_to_file(file_name, string):
     with open(file_name, "a") as f:
         f.writelines(string)
@@ -160,6 +183,75 @@ def write_to_file(file_name, string):
     log_info("file dir: {}".format(os.getcwd()))
 
 
+def build_models(hydra_cfg):
+    place_network = ResidualFlow_DiffEmbTransformer(
+        emb_dims=hydra_cfg.emb_dims,
+        emb_nn=hydra_cfg.emb_nn,
+        center_feature=hydra_cfg.center_feature,
+        pred_weight=hydra_cfg.pred_weight,
+        residual_on=hydra_cfg.residual_on,
+        return_flow_component=hydra_cfg.return_flow_component,
+        freeze_embnn=hydra_cfg.freeze_embnn,
+        return_attn=hydra_cfg.return_attn,
+        anchor_emb_cache_size=hydra_cfg.anchor_emb_cache_size,
+        fuse_twin_branches=hydra_cfg.fuse_twin_branches,
+    )
+
+    place_model = EquivarianceTestingModule(
+        place_network,
+        lr=hydra_cfg.lr,
+        image_log_period=hydra_cfg.image_logging_period,
+        weight_normalize=hydra_cfg.weight_normalize_place,
+        loop=hydra_cfg.loop,
+        refine_rot_tol=hydra_cfg.refine_rot_tol,
+        refine_trans_tol=hydra_cfg.refine_trans_tol,
+        precision=hydra_cfg.precision,
+    )
+
+    place_model.cuda()
+
+    if hydra_cfg.checkpoint_file_place is not None:
+        place_model.load_state_dict(
+            torch.load(hydra_cfg.checkpoint_file_place)["state_dict"]
+        )
+        log_info("Model Loaded from " + str(hydra_cfg.checkpoint_file_place))
+
+    grasp_network = ResidualFlow_DiffEmbTransformer(
+        emb_dims=hydra_cfg.emb_dims,
+        emb_nn=hydra_cfg.emb_nn,
+        center_feature=hydra_cfg.center_feature,
+        pred_weight=hydra_cfg.pred_weight,
+        residual_on=hydra_cfg.residual_on,
+        return_flow_component=hydra_cfg.return_flow_component,
+        freeze_embnn=hydra_cfg.freeze_embnn,
+        return_attn=hydra_cfg.return_attn,
+        anchor_emb_cache_size=hydra_cfg.anchor_emb_cache_size,
+        fuse_twin_branches=hydra_cfg.fuse_twin_branches,
+    )
+
+    grasp_model = EquivarianceTestingModule(
+        grasp_network,
+        lr=hydra_cfg.lr,
+        image_log_period=hydra_cfg.image_logging_period,
+        weight_normalize=hydra_cfg.weight_normalize_grasp,
+        softmax_temperature=hydra_cfg.softmax_temperature_grasp,
+        loop=hydra_cfg.loop,
+        refine_rot_tol=hydra_cfg.refine_rot_tol,
+        refine_trans_tol=hydra_cfg.refine_trans_tol,
+        precision=hydra_cfg.precision,
+    )
+
+    grasp_model.cuda()
+
+    if hydra_cfg.checkpoint_file_grasp is not None:
+        grasp_model.load_state_dict(
+            torch.load(hydra_cfg.checkpoint_file_grasp)["state_dict"]
+        )
+        log_info("Model Loaded from " + str(hydra_cfg.checkpoint_file_grasp))
+
+    return {"place": place_model, "grasp": grasp_model}
+
+
 ###################################################################
 # WHAT TO CHANGE FOR LOCAL USE
 # or Search "#### TO BE CHANGED ####"
@@ -172,9 +264,7 @@ def write_to_file(file_name, string):
 #### TO BE CHANGED ####
 
 
-#### TO BE CHANGED ####
-@hydra.main(config_path="../configs", config_name="eval_full_mug_place")
-def main(hydra_cfg):
+def evaluate(hydra_cfg, trial_ids, models):
     data_dir = hydra_cfg.data_dir
     # '/home/exx/Documents/taxpose/search_existing_models.txt'
     log_txt_file = hydra_cfg.log_txt_file
@@ -480,62 +570,13 @@ def main(hydra_cfg):
 
     pl.seed_everything(hydra_cfg.seed)
 
-    place_network = ResidualFlow_DiffEmbTransformer(
-        emb_dims=hydra_cfg.emb_dims,
-        emb_nn=hydra_cfg.emb_nn,
-        center_feature=hydra_cfg.center_feature,
-        pred_weight=hydra_cfg.pred_weight,
-        residual_on=hydra_cfg.residual_on,
-        return_flow_component=hydra_cfg.return_flow_component,
-        freeze_embnn=hydra_cfg.freeze_embnn,
-        return_attn=hydra_cfg.return_attn,
-    )
-
-    place_model = EquivarianceTestingModule(
-        place_network,
-        lr=hydra_cfg.lr,
-        image_log_period=hydra_cfg.image_logging_period,
-        weight_normalize=hydra_cfg.weight_normalize_place,
-        loop=hydra_cfg.loop,
-    )
-
-    place_model.cuda()
-
-    if hydra_cfg.checkpoint_file_place is not None:
-        place_model.load_state_dict(
-            torch.load(hydra_cfg.checkpoint_file_place)["state_dict"]
-        )
-        log_info("Model Loaded from " + str(hydra_cfg.checkpoint_file_place))
-
-    grasp_network = ResidualFlow_DiffEmbTransformer(
-        emb_dims=hydra_cfg.emb_dims,
-        emb_nn=hydra_cfg.emb_nn,
-        center_feature=hydra_cfg.center_feature,
-        pred_weight=hydra_cfg.pred_weight,
-        residual_on=hydra_cfg.residual_on,
-        return_flow_component=hydra_cfg.return_flow_component,
-        freeze_embnn=hydra_cfg.freeze_embnn,
-        return_attn=hydra_cfg.return_attn,
-    )
-
-    grasp_model = EquivarianceTestingModule(
-        grasp_network,
-        lr=hydra_cfg.lr,
-        image_log_period=hydra_cfg.image_logging_period,
-        weight_normalize=hydra_cfg.weight_normalize_grasp,
-        softmax_temperature=hydra_cfg.softmax_temperature_grasp,
-        loop=hydra_cfg.loop,
-    )
-
-    grasp_model.cuda()
-
-    if hydra_cfg.checkpoint_file_grasp is not None:
-        grasp_model.load_state_dict(
-            torch.load(hydra_cfg.checkpoint_file_grasp)["state_dict"]
-        )
-        log_info("Model Loaded from " + str(hydra_cfg.checkpoint_file_grasp))
+    place_model = models["place"]
+    grasp_model = models["grasp"]
 
-    for iteration in range(hydra_cfg.start_iteration, hydra_cfg.num_iterations):
+    trial_results = []
+    for iteration in trial_ids:
+        seed_trial(hydra_cfg.seed, iteration)
+        settle_steps = 0
         # load a test object
         obj_shapenet_id = random.sample(test_object_ids, 1)[0]
         id_str = "Shapenet ID: %s" % obj_shapenet_id
@@ -680,7 +721,7 @@ def main(hydra_cfg):
             robot.pb_client.set_step_sim(False)
         safeCollisionFilterPair(obj_id, table_id, -1, -1, enableCollision=True)
         p.changeDynamics(obj_id, -1, linearDamping=5, angularDamping=5)
-        time.sleep(1.5)
+        settle_steps += settle_bodies(robot.pb_client, [obj_id], max_time=1.5)
 
         hide_link(table_id, rack_link_id)
 
@@ -694,7 +735,7 @@ def main(hydra_cfg):
             rack_color = p.getVisualShapeData(table_id)[rack_link_id][7]
             show_link(table_id, rack_link_id, rack_color)
 
-        time.sleep(1.5)
+        settle_steps += settle_bodies(robot.pb_client, [obj_id], max_time=1.5)
         teleport_rgb = robot.cam.get_images(get_rgb=True)[0]
         teleport_img_fname = osp.join(eval_teleport_imgs_dir, "%d_init.png" % iteration)
         np2img(teleport_rgb.astype(np.uint8), teleport_img_fname)
@@ -703,6 +744,7 @@ def main(hydra_cfg):
 
         points_mug_raw, points_rack_raw = load_data_raw(
             num_points=1024,
+            device=place_model.device,
             clouds=obj_points,
             classes=obj_classes,
             action_class=0,
@@ -712,6 +754,7 @@ def main(hydra_cfg):
             continue
         points_gripper_raw, points_mug_raw = load_data_raw(
             num_points=1024,
+            device=place_model.device,
             clouds=obj_points,
             classes=obj_classes,
             action_class=2,
@@ -719,13 +762,21 @@ def main(hydra_cfg):
         )
         points_mug, points_rack = load_data(
             num_points=1024,
+            num_samples=hydra_cfg.num_hypotheses,
+            device=place_model.device,
             clouds=obj_points,
             classes=obj_classes,
             action_class=0,
             anchor_class=1,
         )
 
-        ans = place_model.get_transform(points_mug, points_rack)  # 1, 4, 4
+        ans = infer_transform(
+            place_model,
+            points_mug,
+            points_rack,
+            hydra_cfg.num_hypotheses,
+            hydra_cfg.hypothesis_fusion,
+        )  # 1, 4, 4
 
         pred_T_action_init = ans["pred_T_action"]
         pred_T_action_mat = pred_T_action_init.get_matrix()[0].T.detach().cpu().numpy()
@@ -748,12 +799,20 @@ def main(hydra_cfg):
         # Get Grasp Pose
         points_gripper, points_mug = load_data(
             num_points=1024,
+            num_samples=hydra_cfg.num_hypotheses,
+            device=place_model.device,
             clouds=obj_points,
             classes=obj_classes,
             action_class=2,
             anchor_class=0,
         )
-        ans_grasp = grasp_model.get_transform(points_gripper, points_mug)  # 1, 4, 4
+        ans_grasp = infer_transform(
+            grasp_model,
+            points_gripper,
+            points_mug,
+            hydra_cfg.num_hypotheses,
+            hydra_cfg.hypothesis_fusion,
+        )  # 1, 4, 4
         pred_T_action_init_gripper2mug = ans_grasp["pred_T_action"]
         pred_T_action_mat_gripper2mug = (
             pred_T_action_init_gripper2mug.get_matrix()[0].T.detach().cpu().numpy()
@@ -830,7 +889,6 @@ def main(hydra_cfg):
             shapenet_id=obj_shapenet_id,
         )
 
-        time.sleep(1.0)
         teleport_rgb = robot.cam.get_images(get_rgb=True)[0]
         teleport_img_fname = osp.join(
             eval_teleport_imgs_dir, "teleport_%d.png" % iteration
@@ -839,8 +897,7 @@ def main(hydra_cfg):
         safeCollisionFilterPair(
             obj_id, table_id, -1, placement_link_id, enableCollision=True
         )
-        robot.pb_client.set_step_sim(False)
-        time.sleep(1.0)
+        settle_steps += settle_bodies(robot.pb_client, [obj_id], max_time=1.0)
 
         cloud_points, cloud_colors, cloud_classes = get_clouds(cams)
         obj_points, obj_colors, obj_classes = get_object_clouds(cams)
@@ -861,7 +918,7 @@ def main(hydra_cfg):
             shapenet_id=obj_shapenet_id,
         )
 
-        time.sleep(1.0)
+        settle_steps += settle_bodies(robot.pb_client, [obj_id], max_time=1.0)
         teleport_rgb = robot.cam.get_images(get_rgb=True)[0]
         teleport_img_fname = osp.join(
             eval_teleport_imgs_dir, "post_teleport_%d.png" % iteration
@@ -875,7 +932,6 @@ def main(hydra_cfg):
         if not place_success_teleport:
             place_fail_teleport_list.append(iteration)
 
-        time.sleep(1.0)
         safeCollisionFilterPair(obj_id, table_id, -1, -1, enableCollision=True)
         robot.pb_client.reset_body(obj_id, pos, ori)
 
@@ -891,7 +947,8 @@ def main(hydra_cfg):
             safeRemoveConstraint(o_cid)
             p.resetBasePositionAndOrientation(obj_id, pos, ori)
             print(p.getBasePositionAndOrientation(obj_id))
-            time.sleep(0.5)
+            if not hydra_cfg.pose_dist.any_pose:
+                settle_steps += settle_bodies(robot.pb_client, [obj_id], max_time=0.5)
 
             if hydra_cfg.pose_dist.any_pose:
                 o_cid = constraint_obj_world(obj_id, pos, ori)
@@ -1176,7 +1233,9 @@ def main(hydra_cfg):
                     safeCollisionFilterPair(
                         obj_id, table_id, -1, -1, enableCollision=False
                     )
-                    time.sleep(4.0)
+                    settle_steps += settle_bodies(
+                        robot.pb_client, [obj_id], max_time=4.0
+                    )
 
                     # observe and record outcome
                     obj_surf_contacts = p.getContactPoints(
@@ -1197,7 +1256,7 @@ def main(hydra_cfg):
             place_fail_list.append(iteration)
         if not grasp_success:
             grasp_fail_list.append(iteration)
-        log_str = "Iteration: %d, " % iteration
+        log_str = "Iteration: %d, settle steps: %d, " % (iteration, settle_steps)
         kvs = {}
         # kvs["Place [teleport] Success"] = place_success_teleport_list[-1]
         # kvs["Grasp Success"] = grasp_success_list[-1]
@@ -1243,7 +1302,11 @@ def main(hydra_cfg):
             write_to_file(log_txt_file, log_str)
 
         else:
-            if iteration == hydra_cfg.num_iterations - 1:
+            # With several workers, main() logs the merged results instead.
+            if (
+                iteration == hydra_cfg.num_iterations - 1
+                and hydra_cfg.num_eval_workers <= 1
+            ):
                 write_to_file(log_txt_file, "cwd:" + os.getcwd())
                 write_to_file(
                     log_txt_file,
@@ -1283,6 +1346,7 @@ def main(hydra_cfg):
             grasp_success_list=grasp_success_list,
             place_success_list=place_success_list,
             place_success_teleport_list=place_success_teleport_list,
+            settle_steps=settle_steps,
             start_obj_pose=util.pose_stamped2list(obj_start_pose),
             best_place_obj_pose=obj_end_pose_list,
             mesh_file=obj_obj_file,
@@ -1295,6 +1359,80 @@ def main(hydra_cfg):
 
         robot.pb_client.remove_body(obj_id)
 
+        trial_results.append(
+            dict(
+                trial=iteration,
+                shapenet_id=obj_shapenet_id,
+                grasp_success=grasp_success,
+                place_success=place_success,
+                place_success_teleport=place_success_teleport,
+                settle_steps=settle_steps,
+            )
+        )
+
+    return trial_results
+
+
+def log_merged_results(hydra_cfg, results):
+    grasp_success = [r["grasp_success"] for r in results]
+    place_success_teleport = [r["place_success_teleport"] for r in results]
+    overall_success = [g and p for g, p in zip(grasp_success, place_success_teleport)]
+    kvs = {}
+    kvs["Grasp Success Rate"] = sum(grasp_success) / float(len(results))
+    kvs["Place [teleport] Success Rate"] = sum(place_success_teleport) / float(
+        len(results)
+    )
+    kvs["overall success Rate"] = sum(overall_success) / float(len(results))
+    kvs["Mean settle steps"] = sum(r["settle_steps"] for r in results) / float(
+        len(results)
+    )
+    log_str = "Trials: %d, " % len(results)
+    for k, v in kvs.items():
+        log_str += "%s: %.3f, " % (k, v)
+
+    log_txt_file = hydra_cfg.log_txt_file
+    write_to_file(log_txt_file, "cwd:" + os.getcwd())
+    write_to_file(
+        log_txt_file,
+        "pose_distribution: {}".format(
+            "arbitrary" if hydra_cfg.pose_dist.any_pose else "upright"
+        ),
+    )
+    write_to_file(log_txt_file, "seed: {}".format(hydra_cfg.seed))
+    write_to_file(log_txt_file, "eval workers: {}".format(hydra_cfg.num_eval_workers))
+    log_info(log_str)
+    write_to_file(log_txt_file, log_str)
+    write_to_file(
+        log_txt_file, "checkpoint_file_grasp: " + hydra_cfg.checkpoint_file_grasp
+    )
+    write_to_file(
+        log_txt_file, "checkpoint_file_place: " + hydra_cfg.checkpoint_file_place
+    )
+    write_to_file(log_txt_file, "\n")
+
+
+#### TO BE CHANGED ####
+@hydra.main(config_path="../configs", config_name="eval_full_mug_place")
+def main(hydra_cfg):
+    trial_ids = list(range(hydra_cfg.start_iteration, hydra_cfg.num_iterations))
+    num_workers = hydra_cfg.num_eval_workers
+    if num_workers > 1:
+        # Workers are headless and cannot resolve ${hydra:...} interpolations.
+        hydra_cfg = resolve_config(hydra_cfg)
+        hydra_cfg.pybullet_viz = False
+
+    results = run_sharded_eval(
+        evaluate,
+        (hydra_cfg,),
+        trial_ids,
+        build_models,
+        (hydra_cfg,),
+        ["place", "grasp"],
+        num_workers,
+    )
+    if num_workers > 1:
+        log_merged_results(hydra_cfg, results)
+
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, util.signal_handler)
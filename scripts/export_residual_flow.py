@@ -0,0 +1,62 @@
+"""Export a trained ResidualFlow_DiffEmbTransformer for CPU inference.
+
+Writes a TorchScript module (<output>.pt) and/or an ONNX graph (<output>.onnx)
+that map (points_action (B, N, 3), points_anchor (B, M, 3)) to the flows and
+weights of both clouds, for any B, N and M. The pose is solved from those with
+`taxpose.utils.se3.dualflow2pose`, as in `EquivarianceTestingModule.predict`.
+
+    python scripts/export_residual_flow.py --checkpoint place.ckpt --output place
+    python scripts/export_residual_flow.py --checkpoint place.ckpt --output place --format onnx
+"""
+import torch
+import typer
+
+from taxpose.nets.export import (
+    ExportableResidualFlow,
+    export_onnx,
+    export_torchscript,
+    load_residual_flow,
+)
+
+
+def main(
+    checkpoint: str = typer.Option(...),
+    output: str = typer.Option(...),
+    target: str = typer.Option("both", "--format", help="torchscript, onnx or both"),
+    emb_dims: int = 512,
+    center_feature: bool = True,
+    residual_on: bool = True,
+    sample_stats_bn: bool = typer.Option(
+        True, help="Normalize with per-sample statistics, as the eval scripts do."
+    ),
+    num_points: int = 512,
+    check: bool = True,
+):
+    model = load_residual_flow(
+        checkpoint,
+        emb_dims=emb_dims,
+        center_feature=center_feature,
+        residual_on=residual_on,
+    )
+    wrapper = ExportableResidualFlow(model, sample_stats_bn=sample_stats_bn)
+    if not sample_stats_bn:
+        model.eval()
+
+    example = (torch.randn(1, num_points, 3), torch.randn(1, num_points, 3))
+    if check:
+        with torch.no_grad():
+            expected = model(*example)
+            actual = wrapper(*example)
+        err = max((e - a).abs().max().item() for e, a in zip(expected, actual))
+        print(f"wrapper vs. model: max abs difference {err:.2e}")
+
+    if target in ("torchscript", "both"):
+        export_torchscript(wrapper, output + ".pt", num_points=num_points)
+        print(f"wrote {output}.pt")
+    if target in ("onnx", "both"):
+        export_onnx(wrapper, output + ".onnx", num_points=num_points)
+        print(f"wrote {output}.onnx")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,40 @@
+"""Pack the NDF ShapeNet occupancy pickles into a memory-mapped store and scan the training samples.
+
+Samples that fail to load, miss fields or occupancy, or have views with too few
+points are listed in the manifest and skipped when pretraining with
+`use_packed=True`.
+
+    python scripts/pack_occupancy.py third_party/ndf_robot/src/ndf_robot/data
+"""
+import glob
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+from taxpose.datasets.occupancy_store import (
+    OccupancyStore,
+    build_manifest,
+    load_manifest,
+    pack_occupancy,
+)
+
+
+def main(
+    ndf_data_path: Path = typer.Argument(..., dir_okay=True, file_okay=False),
+    out_dir: Optional[Path] = None,
+):
+    store = OccupancyStore(pack_occupancy(ndf_data_path, out_dir))
+    print(f"Packed {len(store)} shapes ({store.offsets[-1]} voxels) into {store.root}")
+
+    files = [
+        f
+        for f in sorted(glob.glob(str(ndf_data_path / "training_data" / "*" / "*.npz")))
+        if Path(f).parent != store.root
+    ]
+    manifest = build_manifest(ndf_data_path, files, store)
+    print(f"{len(load_manifest(manifest))}/{len(files)} samples valid, see {manifest}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,33 @@
+"""Pack a directory of `{idx}_{cloud_type}_obj_points.npz` demos into a memory-mapped store.
+
+Train with `use_packed=True` afterwards to read from the store instead of the .npz files.
+`cached_fps=True` also subsamples full clouds from the stored FPS orderings instead of
+running FPS per sample; that is faster, but there are only fps_num_orderings distinct
+subsamples per demo and class.
+
+    python scripts/pack_point_clouds.py data/mug_place/train_data/renders --cloud-type teleport
+"""
+from pathlib import Path
+from typing import Optional
+
+import typer
+
+from taxpose.datasets.point_cloud_store import PackedPointCloudStore, pack_point_clouds
+
+
+def main(
+    dataset_root: Path = typer.Argument(..., dir_okay=True, file_okay=False),
+    cloud_type: str = "final",
+    out_dir: Optional[Path] = None,
+    fps_num_points: int = 2048,
+    fps_num_orderings: int = 4,
+):
+    out_dir = pack_point_clouds(
+        dataset_root, cloud_type, out_dir, fps_num_points, fps_num_orderings
+    )
+    store = PackedPointCloudStore(out_dir)
+    print(f"Packed {len(store)} demos ({store.offsets[-1]} points) into {out_dir}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
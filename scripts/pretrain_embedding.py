@@ -39,6 +39,7 @@ def main(cfg):
         cloud_type=cfg.cloud_type,
         # overfit=cfg.overfit,
         pretraining_data_path=cfg.pretraining_data_path,
+        use_packed=cfg.use_packed,
     )
 
     dm.setup()
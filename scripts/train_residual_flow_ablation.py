@@ -14,7 +14,11 @@ from taxpose.nets.transformer_flow import (
 from taxpose.training.flow_equivariance_training_module_nocentering import (
     EquivarianceTrainingModule,
 )
-from taxpose.utils.callbacks import SaverCallbackEmbnnActionAnchor, SaverCallbackModel
+from taxpose.utils.callbacks import (
+    PrecisionMonitor,
+    SaverCallbackEmbnnActionAnchor,
+    SaverCallbackModel,
+)
 
 
 def write_to_file(file_name, string):
@@ -34,8 +38,13 @@ def main(cfg):
         logger=logger,
         gpus=1,
         reload_dataloaders_every_n_epochs=1,
-        callbacks=[SaverCallbackModel(), SaverCallbackEmbnnActionAnchor()],
+        callbacks=[
+            SaverCallbackModel(),
+            SaverCallbackEmbnnActionAnchor(),
+            PrecisionMonitor(),
+        ],
         max_epochs=cfg.max_epochs,
+        precision=cfg.precision,
     )
     log_txt_file = cfg.log_txt_file
 
@@ -95,6 +104,13 @@ def main(cfg):
         plane_occlusion=cfg.plane_occlusion,
         num_demo=cfg.num_demo,
         occlusion_class=cfg.occlusion_class,
+        use_packed=cfg.use_packed,
+        cached_fps=cfg.cached_fps,
+        batch_fps=cfg.batch_fps,
+        gpu_augmentation=cfg.gpu_augmentation,
+        cache_demos=cfg.cache_demos,
+        stream_train=cfg.stream_train,
+        seed=cfg.seed,
     )
 
     dm.setup()
@@ -0,0 +1,89 @@
+import numpy as np
+import torch
+
+from taxpose.datasets.fps import batch_farthest_point_sample
+from taxpose.utils.occlusion_utils import ball_occlusion_mask, plane_occlusion_mask
+from taxpose.utils.se3 import batched_random_se3
+
+
+class BatchAugmentation:
+    """The per-sample augmentation of PointCloudDataset, applied to a whole batch.
+
+    Takes a `collate_ragged` batch of untransformed, padded action/anchor clouds
+    (as returned with gpu_augmentation=True) on any device and, with vectorized
+    ops, applies synthetic occlusion, FPS down to num_points and random SE(3)
+    transforms. The result has the same keys as a PointCloudDataset batch.
+    """
+
+    def __init__(
+        self,
+        num_points=1024,
+        rotation_variance=np.pi,
+        translation_variance=0.5,
+        action_class=0,
+        anchor_class=1,
+        synthetic_occlusion=False,
+        ball_radius=None,
+        plane_occlusion=False,
+        ball_occlusion=False,
+        plane_standoff=None,
+        occlusion_class=2,
+    ):
+        self.num_points = num_points
+        self.rot_var = rotation_variance
+        self.trans_var = translation_variance
+        self.occlude = {
+            "points_action": synthetic_occlusion and action_class == occlusion_class,
+            "points_anchor": synthetic_occlusion and anchor_class == occlusion_class,
+        }
+        self.ball_radius = ball_radius
+        self.plane_occlusion = plane_occlusion
+        self.ball_occlusion = ball_occlusion
+        self.plane_standoff = plane_standoff
+
+    def occlude_batch(self, points, lengths):
+        """Occlude each cloud and move its remaining points to the front.
+
+        As in PointCloudDataset, only clouds larger than num_points are occluded,
+        and a cloud is left whole if occlusion would drop it below num_points.
+        """
+        N = points.shape[1]
+        valid = torch.arange(N, device=points.device) < lengths.unsqueeze(1)
+        keep = valid
+        if self.ball_occlusion:
+            keep = ball_occlusion_mask(points, mask=keep, radius=self.ball_radius)
+        if self.plane_occlusion:
+            # A cloud that fits inside the ball has nothing left to cut.
+            keep = torch.where(keep.any(1, keepdim=True), keep, valid)
+            keep = plane_occlusion_mask(
+                points, mask=keep, stand_off=self.plane_standoff
+            )
+        new_lengths = keep.sum(1)
+        use_occluded = (lengths > self.num_points) & (new_lengths >= self.num_points)
+        keep = torch.where(use_occluded.unsqueeze(1), keep, valid)
+        lengths = torch.where(use_occluded, new_lengths, lengths)
+
+        # Stable sort puts the kept points first, in their original order.
+        _, order = torch.sort((~keep).int(), dim=1, stable=True)
+        points = torch.gather(points, 1, order.unsqueeze(-1).expand(-1, -1, 3))
+        return points, lengths
+
+    def __call__(self, batch):
+        batch = dict(batch)
+        for key, occlude in self.occlude.items():
+            if occlude and (self.ball_occlusion or self.plane_occlusion):
+                batch[key], batch[f"{key}_lengths"] = self.occlude_batch(
+                    batch[key], batch[f"{key}_lengths"]
+                )
+        batch = batch_farthest_point_sample(batch, self.num_points)
+
+        points_action, points_anchor = batch["points_action"], batch["points_anchor"]
+        B = points_action.shape[0]
+        T0 = batched_random_se3(B, self.rot_var, self.trans_var, points_action.device)
+        T1 = batched_random_se3(B, self.rot_var, self.trans_var, points_anchor.device)
+        batch["points_action_trans"] = T0.transform_points(points_action)
+        batch["points_anchor_trans"] = T1.transform_points(points_anchor)
+        batch["T0"] = T0.get_matrix()
+        batch["T1"] = T1.get_matrix()
+        batch["symmetric_cls"] = points_action.new_zeros(B, 0)
+        return batch
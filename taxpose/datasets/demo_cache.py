@@ -0,0 +1,88 @@
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from taxpose.datasets.point_cloud_store import compute_camera_idxs
+
+
+class DemoCache:
+    """Raw point clouds of a fixed set of demos, held in shared-memory tensors.
+
+    The demos are concatenated into flat tensors (like `PackedPointCloudStore`)
+    and moved to shared memory, so DataLoader workers, forked or spawned, read
+    the same pages instead of each loading the files.
+    """
+
+    def __init__(self, filenames, load_raw_data):
+        self.rows = {str(filename): i for i, filename in enumerate(filenames)}
+        points, classes, camera_idxs = [], [], []
+        for filename in filenames:
+            demo_points, demo_classes, demo_camera_idxs = load_raw_data(filename)
+            if demo_camera_idxs is None:
+                demo_camera_idxs = compute_camera_idxs(demo_classes)
+            points.append(np.asarray(demo_points, dtype=np.float32))
+            classes.append(np.asarray(demo_classes, dtype=np.int64))
+            camera_idxs.append(np.asarray(demo_camera_idxs, dtype=np.int64))
+        sizes = [len(c) for c in classes]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.points = torch.from_numpy(np.concatenate(points)).share_memory_()
+        self.classes = torch.from_numpy(np.concatenate(classes)).share_memory_()
+        self.camera_idxs = torch.from_numpy(np.concatenate(camera_idxs)).share_memory_()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, filename):
+        return str(filename) in self.rows
+
+    def get(self, filename):
+        """(points, classes, camera_idxs) of one demo, as zero-copy numpy views."""
+        row = self.rows[str(filename)]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return tuple(
+            array[start:end].numpy()
+            for array in [self.points, self.classes, self.camera_idxs]
+        )
+
+
+class PointCloudStream(IterableDataset):
+    """Streams `len(dataset)` random samples per epoch from a PointCloudDataset.
+
+    PointCloudDataset ignores the sample index and draws from the global torch
+    and numpy RNGs, which forked workers start with in the same state. Here each
+    worker yields its share of the epoch after seeding its own RNGs from
+    (seed, worker id, epoch), so workers never repeat each other's samples.
+    With seed=None the worker seed that DataLoader derives from the main
+    process RNG is used instead.
+
+    The epoch counter lives in the worker's copy of the stream, so use
+    persistent workers; otherwise every epoch restarts from epoch 0. With
+    num_workers=0 the global RNGs are used as they are.
+    """
+
+    def __init__(self, dataset, seed=None):
+        self.dataset = dataset
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_samples = len(self.dataset)
+        if worker_info is not None:
+            if self.seed is None:
+                entropy = [worker_info.seed, self.epoch]
+            else:
+                entropy = [self.seed, worker_info.id, self.epoch]
+            seq = np.random.SeedSequence(entropy)
+            torch_seed, np_seed = seq.generate_state(2).tolist()
+            torch.manual_seed(torch_seed)
+            np.random.seed(np_seed)
+            num_samples = len(
+                range(worker_info.id, num_samples, worker_info.num_workers)
+            )
+        self.epoch += 1
+        for _ in range(num_samples):
+            yield self.dataset[0]
@@ -0,0 +1,65 @@
+import torch
+from pytorch3d.ops import sample_farthest_points
+
+# Clouds that are subsampled together: the transformed cloud reuses the indices
+# picked on the untransformed one.
+FPS_KEYS = {
+    "points_action": ["points_action", "points_action_trans"],
+    "points_anchor": ["points_anchor", "points_anchor_trans"],
+}
+
+
+def fps_orderings(points, num_points, num_orderings=4, seed=0):
+    """Farthest point orderings of a cloud from `num_orderings` random start points.
+
+    FPS is greedy, so the first K entries of an ordering are exactly what
+    `sample_farthest_points(..., K=K)` returns for K <= num_points.
+
+    points: (N, 3) array
+    Returns: (num_orderings, min(N, num_points)) int32 array of point indices.
+    """
+    generator_state = torch.random.get_rng_state()
+    torch.manual_seed(seed)
+    points = torch.as_tensor(points, dtype=torch.float32).unsqueeze(0)
+    points = points.expand(num_orderings, -1, -1)
+    _, idxs = sample_farthest_points(
+        points, K=min(points.shape[1], num_points), random_start_point=True
+    )
+    torch.random.set_rng_state(generator_state)
+    return idxs.int().numpy()
+
+
+def collate_ragged(samples):
+    """Collate samples whose FPS clouds have different sizes.
+
+    The clouds in FPS_KEYS are zero-padded to the largest cloud in the batch and
+    their true sizes are stored under `<key>_lengths`. Everything else is stacked.
+    """
+    batch = {}
+    for key in samples[0]:
+        values = [sample[key] for sample in samples]
+        if not any(key in keys for keys in FPS_KEYS.values()):
+            batch[key] = torch.stack(values)
+            continue
+        batch[key] = torch.nn.utils.rnn.pad_sequence(values, batch_first=True)
+        if key in FPS_KEYS:
+            batch[f"{key}_lengths"] = torch.tensor([len(v) for v in values])
+    return batch
+
+
+def batch_farthest_point_sample(batch, num_points):
+    """Downsample a `collate_ragged` batch to num_points per cloud with a single FPS call.
+
+    Runs on whatever device the batch is on, so it is meant to be called after
+    the batch has been moved to the accelerator.
+    """
+    batch = dict(batch)
+    for key, keys in FPS_KEYS.items():
+        lengths = batch.pop(f"{key}_lengths")
+        _, idxs = sample_farthest_points(
+            batch[key], lengths=lengths, K=num_points, random_start_point=True
+        )
+        for k in filter(batch.__contains__, keys):
+            gather_idxs = idxs.unsqueeze(-1).expand(-1, -1, batch[k].shape[-1])
+            batch[k] = torch.gather(batch[k], 1, gather_idxs)
+    return batch
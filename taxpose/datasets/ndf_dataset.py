@@ -9,8 +9,36 @@ import torch
 from scipy.spatial.transform import Rotation
 from torch.utils.data import Dataset
 
+from taxpose.datasets.occupancy_store import (
+    OccupancyStore,
+    default_occupancy_root,
+    load_manifest,
+)
 from taxpose.utils import ndf_geometry
 
+IMAGE_HEIGHT = 480
+IMAGE_WIDTH = 640
+
+
+def camera_intrinsics():
+    # change these values depending on the intrinsic parameters of camera used to collect the data. These are what we used in pybullet
+    sensor_half_width = IMAGE_WIDTH // 2
+    sensor_half_height = IMAGE_HEIGHT // 2
+
+    vert_fov = 60 * np.pi / 180
+
+    vert_f = sensor_half_height / np.tan(vert_fov / 2)
+    hor_f = sensor_half_width / (np.tan(vert_fov / 2) * 320 / 240)
+
+    intrinsics = np.array(
+        [
+            [hor_f, 0.0, sensor_half_width, 0.0],
+            [0.0, vert_f, sensor_half_height, 0.0],
+            [0.0, 0.0, 1.0, 0.0],
+        ]
+    )
+    return torch.from_numpy(intrinsics)
+
 
 class JointOccTrainDataset(Dataset):
     def __init__(
@@ -22,6 +50,7 @@ class JointOccTrainDataset(Dataset):
         phase="train",
         obj_class="all",
         train_num=None,
+        use_packed=False,
     ):
         self.ndf_data_path = Path(ndf_data_path)
         # Path setup (change to folder where your training data is kept)
@@ -74,6 +103,18 @@ class JointOccTrainDataset(Dataset):
 
             files_total.extend(files)
 
+        self.use_packed = use_packed
+        if self.use_packed:
+            # Read occupancy from the memory-mapped store written by
+            # scripts/pack_occupancy.py and skip the samples its scan rejected.
+            self.occ_store = OccupancyStore(default_occupancy_root(self.ndf_data_path))
+            valid = load_manifest(self.occ_store.root / "manifest.json")
+            files_total = [
+                f
+                for f in files_total
+                if str(Path(f).relative_to(self.ndf_data_path)) in valid
+            ]
+
         self.files = files_total
 
         self.sidelength = sidelength
@@ -86,29 +127,41 @@ class JointOccTrainDataset(Dataset):
         self.bs = bs
         self.hbs = hbs
 
-        self.shapenet_mug_dict = pickle.load(
-            open(osp.join(self.ndf_data_path, "training_data/occ_shapenet_mug.p"), "rb")
-        )
-        self.shapenet_bowl_dict = pickle.load(
-            open(
-                osp.join(self.ndf_data_path, "training_data/occ_shapenet_bowl.p"), "rb"
+        if not self.use_packed:
+            self.shapenet_mug_dict = pickle.load(
+                open(
+                    osp.join(self.ndf_data_path, "training_data/occ_shapenet_mug.p"),
+                    "rb",
+                )
             )
-        )
-        self.shapenet_bottle_dict = pickle.load(
-            open(
-                osp.join(self.ndf_data_path, "training_data/occ_shapenet_bottle.p"),
-                "rb",
+            self.shapenet_bowl_dict = pickle.load(
+                open(
+                    osp.join(self.ndf_data_path, "training_data/occ_shapenet_bowl.p"),
+                    "rb",
+                )
+            )
+            self.shapenet_bottle_dict = pickle.load(
+                open(
+                    osp.join(self.ndf_data_path, "training_data/occ_shapenet_bottle.p"),
+                    "rb",
+                )
             )
-        )
 
-        self.shapenet_dict = {
-            "03797390": self.shapenet_mug_dict,
-            "02880940": self.shapenet_bowl_dict,
-            "02876657": self.shapenet_bottle_dict,
-        }
+            self.shapenet_dict = {
+                "03797390": self.shapenet_mug_dict,
+                "02880940": self.shapenet_bowl_dict,
+                "02876657": self.shapenet_bottle_dict,
+            }
 
         self.projection_mode = "perspective"
 
+        # The cameras are the same for every sample, so lift through a per-pixel
+        # ray table instead of rebuilding the pixel grid each time.
+        self.intrinsics = camera_intrinsics()
+        self.ray_table = ndf_geometry.pixel_ray_table(
+            self.intrinsics[None], IMAGE_HEIGHT, IMAGE_WIDTH
+        )
+
         self.cache_file = None
         self.count = 0
 
@@ -130,25 +183,18 @@ class JointOccTrainDataset(Dataset):
             if self.multiview_aug:
                 idxs = idxs[:select]
 
-            poses = []
-            quats = []
-            for i in idxs:
-                pos = posecam[i, :3]
-                quat = posecam[i, 3:]
-
-                poses.append(pos)
-                quats.append(quat)
-
             shapenet_id = str(data["shapenet_id"].item())
             category_id = str(data["shapenet_category_id"].item())
 
-            depths = []
-            segs = []
-            cam_poses = []
+            # Each npz field access decompresses the whole array, so read once.
+            seg_all = data["object_segmentation"]
+            depth_all = data["depth_observation"]
 
+            segs = []
+            depths = []
             for i in idxs:
-                seg = data["object_segmentation"][i, 0]
-                depth = data["depth_observation"][i]
+                seg = seg_all[i, 0]
+                depth = depth_all[i]
 
                 rix = np.random.permutation(depth.shape[0])[:1000]
                 seg = seg[rix]
@@ -158,50 +204,16 @@ class JointOccTrainDataset(Dataset):
                     depth = depth + np.random.randn(*depth.shape) * 0.1
 
                 segs.append(seg)
-                depths.append(torch.from_numpy(depth))
-                cam_poses.append(data["cam_pose_world"][i])
-
-            # change these values depending on the intrinsic parameters of camera used to collect the data. These are what we used in pybullet
-            y, x = torch.meshgrid(torch.arange(480), torch.arange(640))
-
-            # Compute native intrinsic matrix
-            sensor_half_width = 320
-            sensor_half_height = 240
-
-            vert_fov = 60 * np.pi / 180
-
-            vert_f = sensor_half_height / np.tan(vert_fov / 2)
-            hor_f = sensor_half_width / (np.tan(vert_fov / 2) * 320 / 240)
-
-            intrinsics = np.array(
-                [
-                    [hor_f, 0.0, sensor_half_width, 0.0],
-                    [0.0, vert_f, sensor_half_height, 0.0],
-                    [0.0, 0.0, 1.0, 0.0],
-                ]
-            )
-
-            # Rescale to new sidelength
-            intrinsics = torch.from_numpy(intrinsics)
-
-            # build depth images from data
-            dp_nps = []
-            for i in range(len(segs)):
-                seg_mask = segs[i]
-                dp_np = ndf_geometry.lift(
-                    x.flatten()[seg_mask],
-                    y.flatten()[seg_mask],
-                    depths[i].flatten(),
-                    intrinsics[None, :, :],
-                )
-                dp_np = torch.cat([dp_np, torch.ones_like(dp_np[..., :1])], dim=-1)
-                dp_nps.append(dp_np)
+                depths.append(depth)
 
             # load in voxel occupancy data
             voxel_path = osp.join(
                 category_id, shapenet_id, "models", "model_normalized_128.mat"
             )
-            coord, voxel_bool, _ = self.shapenet_dict[category_id][voxel_path]
+            if self.use_packed:
+                coord, voxel_bool = self.occ_store.get(voxel_path)
+            else:
+                coord, voxel_bool, _ = self.shapenet_dict[category_id][voxel_path]
 
             rix = np.random.permutation(coord.shape[0])
 
@@ -215,38 +227,19 @@ class JointOccTrainDataset(Dataset):
             coord = torch.from_numpy(coord)
 
             # transform everything into the same frame
-            transforms = []
-            for quat, pos in zip(quats, poses):
-                quat_list = [
-                    float(quat[0]),
-                    float(quat[1]),
-                    float(quat[2]),
-                    float(quat[3]),
-                ]
-                rotation_matrix = Rotation.from_quat(quat_list)
-                rotation_matrix = rotation_matrix.as_matrix()
-
-                transform = np.eye(4)
-                transform[:3, :3] = rotation_matrix
-                transform[:3, -1] = pos
-                transform = torch.from_numpy(transform)
-                transforms.append(transform)
+            transforms = np.tile(np.eye(4), (len(idxs), 1, 1))
+            transforms[:, :3, :3] = Rotation.from_quat(
+                posecam[idxs, 3:].astype(np.float64)
+            ).as_matrix()
+            transforms[:, :3, 3] = posecam[idxs, :3]
+            transforms = torch.from_numpy(transforms)
 
             transform = transforms[0]
-            coord = torch.cat([coord, torch.ones_like(coord[..., :1])], dim=-1)
-            coord = torch.sum(transform[None, :, :] * coord[:, None, :], dim=-1)
-            coord = coord[..., :3]
+            coord = coord @ transform[:3, :3].T + transform[:3, 3]
 
-            points_world = []
-
-            for i, dp_np in enumerate(dp_nps):
-                point_transform = torch.matmul(transform, torch.inverse(transforms[i]))
-                dp_np = torch.sum(
-                    point_transform[None, :, :] * dp_np[:, None, :], dim=-1
-                )
-                points_world.append(dp_np[..., :3])
-
-            point_cloud = torch.cat(points_world, dim=0)
+            point_cloud = ndf_geometry.lift_views(
+                segs, depths, self.ray_table, transform @ torch.inverse(transforms)
+            )
 
             rix = torch.randperm(point_cloud.size(0))
             point_cloud = point_cloud[rix[:1000]]
@@ -270,12 +263,15 @@ class JointOccTrainDataset(Dataset):
             res = {
                 "point_cloud": point_cloud.float(),
                 "coords": coord.float(),
-                "intrinsics": intrinsics.float(),
+                "intrinsics": self.intrinsics.float(),
                 "cam_poses": np.zeros(1),
             }  # cam poses not used
             return res["point_cloud"]
 
         except Exception as e:
+            if self.use_packed:
+                # Bad samples were excluded by the manifest, so this is a real error.
+                raise
             print(e)
             #    print(file)
             return self.get_item(index=random.randint(0, self.__len__() - 1))
@@ -0,0 +1,169 @@
+import json
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+OCC_PICKLES = ["occ_shapenet_mug.p", "occ_shapenet_bowl.p", "occ_shapenet_bottle.p"]
+MANIFEST_FIELDS = [
+    "object_pose_cam_frame",
+    "shapenet_id",
+    "shapenet_category_id",
+    "object_segmentation",
+    "depth_observation",
+    "mesh_scale",
+]
+
+
+def default_occupancy_root(ndf_data_path):
+    return Path(ndf_data_path) / "training_data" / "packed_occupancy"
+
+
+def pack_occupancy(ndf_data_path, out_dir=None):
+    """Pack the ShapeNet occupancy pickles of the NDF training data into one store.
+
+    The store is a directory of flat .npy arrays that can be memory-mapped:
+        coords.npy  (P, 3) voxel coordinates of every shape, concatenated
+        labels.npy  (P,) occupancy of each coordinate
+        index.npz   keys (S,) voxel paths (as in the pickles) and offsets (S + 1,)
+    """
+    training_data = Path(ndf_data_path) / "training_data"
+    out_dir = (
+        default_occupancy_root(ndf_data_path) if out_dir is None else Path(out_dir)
+    )
+    os.makedirs(out_dir, exist_ok=True)
+
+    coords, labels, keys = [], [], []
+    for name in OCC_PICKLES:
+        with open(training_data / name, "rb") as f:
+            occ = pickle.load(f)
+        for key in sorted(occ):
+            coord, voxel_bool, _ = occ[key]
+            keys.append(key)
+            coords.append(coord)
+            labels.append(voxel_bool)
+        del occ
+    offsets = np.concatenate([[0], np.cumsum([len(c) for c in coords])])
+
+    for name, arrays in [("coords", coords), ("labels", labels)]:
+        out = np.lib.format.open_memmap(
+            out_dir / f"{name}.npy",
+            mode="w+",
+            dtype=arrays[0].dtype,
+            shape=(int(offsets[-1]),) + arrays[0].shape[1:],
+        )
+        for array, start, end in zip(arrays, offsets[:-1], offsets[1:]):
+            out[start:end] = array
+        out.flush()
+
+    np.savez(out_dir / "index.npz", keys=np.array(keys), offsets=offsets)
+    return out_dir
+
+
+class OccupancyStore:
+    """Read-only, memory-mapped view of a store written by `pack_occupancy`.
+
+    Like `PackedPointCloudStore`, each DataLoader worker maps the files itself
+    and shares the pages through the OS page cache.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        if not (self.root / "index.npz").exists():
+            raise FileNotFoundError(
+                f"no packed occupancy store at {self.root}, "
+                "create one with scripts/pack_occupancy.py"
+            )
+        index = np.load(self.root / "index.npz")
+        self.offsets = index["offsets"]
+        self._rows = {str(key): i for i, key in enumerate(index["keys"])}
+        self._arrays = None
+
+    def __getstate__(self):
+        # Pickling a memmap copies its contents; let each worker map the files itself.
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def _open(self):
+        if self._arrays is None:
+            self._arrays = tuple(
+                np.load(self.root / f"{name}.npy", mmap_mode="r")
+                for name in ["coords", "labels"]
+            )
+        return self._arrays
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def get(self, key):
+        """(coords, labels) of one shape."""
+        row = self._rows[key]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return tuple(array[start:end] for array in self._open())
+
+
+def check_sample(path, occ_keys, min_points=1000):
+    """Reason the NDF training sample at path can't be used, or None if it can.
+
+    A sample is usable if it loads, has the fields JointOccTrainDataset reads,
+    its shape is in the occupancy store, and every view has at least min_points
+    observed points, so any subset of views gives a full cloud.
+    """
+    try:
+        data = np.load(path, allow_pickle=True)
+        missing = [field for field in MANIFEST_FIELDS if field not in data.files]
+        if missing:
+            return f"missing fields {missing}"
+        key = os.path.join(
+            str(data["shapenet_category_id"].item()),
+            str(data["shapenet_id"].item()),
+            "models",
+            "model_normalized_128.mat",
+        )
+        if key not in occ_keys:
+            return f"no occupancy for {key}"
+        segs, depths = data["object_segmentation"], data["depth_observation"]
+        num_views = data["object_pose_cam_frame"].shape[0]
+        for i in range(num_views):
+            if len(segs[i, 0]) < len(depths[i]):
+                return f"view {i} has fewer segmentation indices than depths"
+            if len(depths[i]) < min_points:
+                return f"view {i} has {len(depths[i])} points"
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def build_manifest(ndf_data_path, files, occ_store, out_path=None):
+    """Scan every training sample once and record which ones are usable.
+
+    Writes {"valid": [...], "invalid": {file: reason}} as JSON, with paths
+    relative to ndf_data_path, to out_path (default: manifest.json in the
+    occupancy store).
+    """
+    ndf_data_path = Path(ndf_data_path)
+    out_path = (
+        Path(occ_store.root) / "manifest.json" if out_path is None else Path(out_path)
+    )
+    valid, invalid = [], {}
+    for path in files:
+        reason = check_sample(path, occ_store)
+        rel = str(Path(path).relative_to(ndf_data_path))
+        if reason is None:
+            valid.append(rel)
+        else:
+            invalid[rel] = reason
+    with open(out_path, "w") as f:
+        json.dump({"valid": valid, "invalid": invalid}, f, indent=1)
+    return out_path
+
+
+def load_manifest(path):
+    """Set of valid sample paths, relative to the NDF data path."""
+    with open(path) as f:
+        return set(json.load(f)["valid"])
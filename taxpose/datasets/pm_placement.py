@@ -17,6 +17,12 @@ from rpad.pyg.dataset import CachedByKeyDataset
 from scipy.spatial.transform import Rotation as R
 
 import taxpose.datasets.pm_splits as splits
+from taxpose.datasets.render_env_pool import RenderEnvPool
+from taxpose.datasets.shard_store import (
+    ShardedDataset,
+    build_shards,
+    print_worker_stats,
+)
 
 TAXPOSE_ROOT = Path(__file__).parent.parent.parent
 GOAL_DATA_PATH = TAXPOSE_ROOT / "taxpose" / "datasets" / "pm_data"
@@ -360,6 +366,7 @@ class PlaceDataset(tgd.Dataset):
         full_obj: bool = False,
         even_downsample: bool = False,
         rotate_anchor: bool = False,
+        env_pool_size: int = 0,
     ):
         if scene_ids is None:
             scene_ids = default_scenes("train", mode=mode)
@@ -378,6 +385,10 @@ class PlaceDataset(tgd.Dataset):
         self.full_obj = full_obj
         self.even_downsample = even_downsample
         self.rotate_anchor = rotate_anchor
+        # Reuse render environments across samples instead of building one per sample.
+        self.env_pool = (
+            RenderEnvPool(PMRenderEnv, env_pool_size) if env_pool_size > 0 else None
+        )
 
         super().__init__(root)
 
@@ -442,7 +453,10 @@ class PlaceDataset(tgd.Dataset):
         rng = np.random.default_rng(seed)
 
         # First, create an environment which will generate our source observations.
-        env = PMRenderEnv(obj_id, self.raw_dir, camera_pos=[-3, 0, 1.2])
+        if self.env_pool is not None:
+            env = self.env_pool.get(obj_id, self.raw_dir, camera_pos=[-3, 0, 1.2])
+        else:
+            env = PMRenderEnv(obj_id, self.raw_dir, camera_pos=[-3, 0, 1.2])
         object_dict = splits.all_objs[CATEGORIES[obj_id].lower()]
 
         # Next, check to see if the object needs to be opened in any way.
@@ -692,24 +706,18 @@ class PlaceDataset(tgd.Dataset):
             data.R_action_anchor = R_action_anchor
             data.flow = flow
 
-        env.close()
+        if self.env_pool is None:
+            env.close()
         # TODO: rewrite this so that there's only a pos and a mask (anchor, action).
         # OR: return a tuple of data.
         return cast(GIData, data)
 
 
 def resample_to_n(k, n=200):
-    ixs = torch.arange(k)
-    orig_ixs = torch.arange(k)
-    while len(ixs) < n:
-        num_needed = n - len(ixs)
-        if num_needed > len(ixs):
-            ixs = torch.cat([ixs, ixs], dim=-2)
-        else:
-            resampled = orig_ixs[torch.randperm(len(orig_ixs))[:num_needed]]
-            ixs = torch.cat([ixs, resampled], dim=-2)
-
-    return ixs
+    if k >= n:
+        return torch.arange(k)
+    # Every point n // k times, plus n % k distinct random ones.
+    return torch.cat([torch.arange(k).repeat(n // k), torch.randperm(k)[: n % k]])
 
 
 class GoalInferenceDataset(tgd.Dataset):
@@ -722,10 +730,14 @@ class GoalInferenceDataset(tgd.Dataset):
 
     def __init__(
         self,
-        dset: Union[PlaceDataset, CachedByKeyDataset[PlaceDataset]],
+        dset: Union[PlaceDataset, CachedByKeyDataset[PlaceDataset], ShardedDataset],
+        packed: bool = False,
     ):
         super().__init__()
         self.dset = dset
+        # Keep the clouds at their own sizes; PyG batches them by concatenation
+        # and TAXPoseModel pads and masks each batch.
+        self.packed = packed
 
     def len(self) -> int:
         return len(self.dset)
@@ -739,11 +751,11 @@ class GoalInferenceDataset(tgd.Dataset):
         act_pos = data.action_pos
         anc_pos = data.anchor_pos
 
-        if len(act_pos) != N_ACTION_POINTS:
+        if not self.packed and len(act_pos) != N_ACTION_POINTS:
             obs_act_ixs = resample_to_n(len(act_pos), n=N_ACTION_POINTS)
             act_pos = act_pos[obs_act_ixs].float()
 
-        if len(anc_pos) != N_ANCHOR_POINTS:
+        if not self.packed and len(anc_pos) != N_ANCHOR_POINTS:
             obs_anc_ixs = resample_to_n(len(anc_pos), n=N_ANCHOR_POINTS)
             anc_pos = anc_pos[obs_anc_ixs].float()
 
@@ -856,6 +868,11 @@ class DatasetType(str, Enum):
     ALL = "all"
 
 
+def shard_store_dir(pm_root) -> Path:
+    # Samples are content-addressed, so every kwarg combination shares one store.
+    return Path(pm_root) / "processed" / "taxpose_shards"
+
+
 def create_goal_inference_dataset(
     pm_root: str,
     dataset: DatasetType,
@@ -869,6 +886,8 @@ def create_goal_inference_dataset(
     n_workers: int = 30,
     n_proc_per_worker: int = 2,
     seed: Optional[int] = None,
+    sharded: bool = False,
+    packed: bool = False,
 ) -> GoalInferenceDataset:
     if dataset == DatasetType.SINGLE:
         scene_ids = [("11299", "ell", "0", "in")]
@@ -901,19 +920,42 @@ def create_goal_inference_dataset(
     else:
         raise ValueError("bad dataset")
 
+    dset_kwargs = {
+        "root": pm_root,
+        "randomize_camera": randomize_camera,
+        "snap_to_surface": snap_to_surface,
+        "full_obj": full_obj,
+        "even_downsample": even_downsample,
+        "rotate_anchor": rotate_anchor,
+        "scene_ids": scene_ids,
+        "mode": "obs",
+    }
+
+    if sharded:
+        # Build only the samples missing from the shard store, then read from it.
+        store_dir = shard_store_dir(pm_root)
+        stats = build_shards(
+            PlaceDataset,
+            dset_kwargs,
+            scene_ids,
+            store_dir,
+            n_repeat=n_repeat,
+            seed=seed,
+            n_workers=n_workers,
+        )
+        if stats:
+            print_worker_stats(stats)
+        return GoalInferenceDataset(
+            dset=ShardedDataset(
+                store_dir, dset_kwargs, scene_ids, n_repeat=n_repeat, seed=seed
+            ),
+            packed=packed,
+        )
+
     return GoalInferenceDataset(
         dset=CachedByKeyDataset(
             dset_cls=PlaceDataset,
-            dset_kwargs={
-                "root": pm_root,
-                "randomize_camera": randomize_camera,
-                "snap_to_surface": snap_to_surface,
-                "full_obj": full_obj,
-                "even_downsample": even_downsample,
-                "rotate_anchor": rotate_anchor,
-                "scene_ids": scene_ids,
-                "mode": "obs",
-            },
+            dset_kwargs=dset_kwargs,
             data_keys=scene_ids,
             root=pm_root,
             processed_dirname=PlaceDataset.processed_dir_name(
@@ -927,5 +969,6 @@ def create_goal_inference_dataset(
             n_workers=n_workers,
             n_proc_per_worker=n_proc_per_worker,
             seed=seed,
-        )
+        ),
+        packed=packed,
     )
@@ -2,6 +2,9 @@ import numpy as np
 import pytorch_lightning as pl
 from torch.utils.data import DataLoader
 
+from taxpose.datasets.augmentation import BatchAugmentation
+from taxpose.datasets.demo_cache import PointCloudStream
+from taxpose.datasets.fps import batch_farthest_point_sample, collate_ragged
 from taxpose.datasets.point_cloud_dataset import PointCloudDataset
 from taxpose.datasets.point_cloud_dataset_test import TestPointCloudDataset
 
@@ -33,6 +36,13 @@ class MultiviewDataModule(pl.LightningDataModule):
         plane_standoff=None,
         num_demo=12,
         occlusion_class=0,
+        use_packed=False,
+        cached_fps=False,
+        batch_fps=False,
+        gpu_augmentation=False,
+        cache_demos=False,
+        stream_train=False,
+        seed=None,
     ):
         super().__init__()
         self.dataset_root = dataset_root
@@ -65,6 +75,32 @@ class MultiviewDataModule(pl.LightningDataModule):
         self.plane_standoff = plane_standoff
         self.num_demo = num_demo
         self.occlusion_class = occlusion_class
+        self.use_packed = use_packed
+        self.cached_fps = cached_fps
+        # Run FPS once per batch on the training device instead of per sample.
+        self.batch_fps = batch_fps
+        # Occlude, subsample and transform whole batches on the training device.
+        self.gpu_augmentation = gpu_augmentation
+        # Keep the demos in shared memory and the datasets across setup() calls.
+        self.cache_demos = cache_demos
+        # Train from a worker-sharded, seeded stream with persistent workers,
+        # so epoch boundaries neither respawn workers nor reload demos.
+        self.stream_train = stream_train
+        self.seed = seed
+        self._train_dataloader = None
+        self.augmentation = BatchAugmentation(
+            num_points=num_points,
+            rotation_variance=rotation_variance,
+            translation_variance=translation_variance,
+            action_class=action_class,
+            anchor_class=anchor_class,
+            synthetic_occlusion=synthetic_occlusion,
+            ball_radius=ball_radius,
+            plane_occlusion=plane_occlusion,
+            ball_occlusion=ball_occlusion,
+            plane_standoff=plane_standoff,
+            occlusion_class=occlusion_class,
+        )
 
     def pass_loss(self, loss):
         self.loss = loss.to(self.device)
@@ -76,7 +112,10 @@ class MultiviewDataModule(pl.LightningDataModule):
         """called one each GPU separately - stage defines if we are at fit or test step"""
         # we set up only relevant datasets when stage is specified (automatically set by Pytorch-Lightning)
 
-        if stage == "fit" or stage is None:
+        # With cache_demos, the datasets (and their cached demos) are built only once.
+        if (stage == "fit" or stage is None) and not (
+            self.cache_demos and hasattr(self, "train_dataset")
+        ):
             print("TRAIN Dataset")
             self.train_dataset = PointCloudDataset(
                 dataset_root=self.dataset_root,
@@ -98,9 +137,16 @@ class MultiviewDataModule(pl.LightningDataModule):
                 plane_standoff=self.plane_standoff,
                 num_demo=self.num_demo,
                 occlusion_class=self.occlusion_class,
+                use_packed=self.use_packed,
+                cached_fps=self.cached_fps,
+                batch_fps=self.batch_fps,
+                gpu_augmentation=self.gpu_augmentation,
+                cache_demos=self.cache_demos,
             )
 
-        if stage == "val" or stage is None:
+        if (stage == "val" or stage is None) and not (
+            self.cache_demos and hasattr(self, "val_dataset")
+        ):
             print("VAL Dataset")
             self.val_dataset = PointCloudDataset(
                 dataset_root=self.test_dataset_root,
@@ -122,6 +168,11 @@ class MultiviewDataModule(pl.LightningDataModule):
                 plane_standoff=self.plane_standoff,
                 num_demo=None,
                 occlusion_class=self.occlusion_class,
+                use_packed=self.use_packed,
+                cached_fps=self.cached_fps,
+                batch_fps=self.batch_fps,
+                gpu_augmentation=self.gpu_augmentation,
+                cache_demos=self.cache_demos,
             )
         if stage == "test":
             self.test_dataset = TestPointCloudDataset(
@@ -145,14 +196,42 @@ class MultiviewDataModule(pl.LightningDataModule):
     def return_index_list_test(self):
         return self.test_dataset.return_index_list()
 
+    @property
+    def collate_fn(self):
+        return collate_ragged if self.batch_fps or self.gpu_augmentation else None
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if "points_action_lengths" not in batch:
+            return batch
+        if "T0" not in batch:
+            return self.augmentation(batch)
+        return batch_farthest_point_sample(batch, self.num_points)
+
     def train_dataloader(self):
-        return DataLoader(
-            self.train_dataset, batch_size=self.batch_size, num_workers=self.num_workers
-        )
+        if not self.stream_train:
+            return DataLoader(
+                self.train_dataset,
+                batch_size=self.batch_size,
+                num_workers=self.num_workers,
+                collate_fn=self.collate_fn,
+            )
+        # Reloading every epoch returns the same loader, so its workers persist.
+        if self._train_dataloader is None:
+            self._train_dataloader = DataLoader(
+                PointCloudStream(self.train_dataset, seed=self.seed),
+                batch_size=self.batch_size,
+                num_workers=self.num_workers,
+                collate_fn=self.collate_fn,
+                persistent_workers=self.num_workers > 0,
+            )
+        return self._train_dataloader
 
     def val_dataloader(self):
         return DataLoader(
-            self.val_dataset, batch_size=self.batch_size, num_workers=self.num_workers
+            self.val_dataset,
+            batch_size=self.batch_size,
+            num_workers=self.num_workers,
+            collate_fn=self.collate_fn,
         )
 
     def test_dataloader(self):
@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 
@@ -6,6 +7,12 @@ import torch
 from pytorch3d.ops import sample_farthest_points
 from torch.utils.data import Dataset
 
+from taxpose.datasets.demo_cache import DemoCache
+from taxpose.datasets.point_cloud_store import (
+    PackedPointCloudStore,
+    compute_camera_idxs,
+    default_packed_root,
+)
 from taxpose.utils.occlusion_utils import ball_occlusion, plane_occlusion
 from taxpose.utils.se3 import random_se3
 
@@ -36,6 +43,11 @@ class PointCloudDataset(Dataset):
         num_demo=12,
         min_num_cameras=4,
         max_num_cameras=4,
+        use_packed=False,
+        cached_fps=False,
+        batch_fps=False,
+        gpu_augmentation=False,
+        cache_demos=False,
     ):
         self.dataset_size = dataset_size
         self.num_points = num_points
@@ -50,6 +62,19 @@ class PointCloudDataset(Dataset):
         self.angle_degree = angle_degree
         self.min_num_cameras = min_num_cameras
         self.max_num_cameras = max_num_cameras
+        # Read from the memory-mapped store written by scripts/pack_point_clouds.py
+        # instead of decompressing a .npz per sample.
+        self.store = (
+            PackedPointCloudStore(default_packed_root(self.dataset_root, cloud_type))
+            if use_packed
+            else None
+        )
+        # Subsample full clouds from the store's precomputed FPS orderings instead
+        # of running FPS from a random start point. Faster, but each demo and class
+        # then only has fps_num_orderings distinct subsamples.
+        if cached_fps and not use_packed:
+            raise ValueError("cached_fps needs use_packed")
+        self.cached_fps = cached_fps
 
         self.overfit = overfit
         self.gripper_lr_label = gripper_lr_label
@@ -57,6 +82,15 @@ class PointCloudDataset(Dataset):
         self.num_overfit_transforms = num_overfit_transforms
         self.T0_list = []
         self.T1_list = []
+        # Skip FPS here and leave it to batch_farthest_point_sample on the collated batch.
+        self.batch_fps = batch_fps
+        # Return raw clouds and leave occlusion, FPS and the random transforms to
+        # BatchAugmentation on the collated batch.
+        self.gpu_augmentation = gpu_augmentation
+        if (self.batch_fps or self.gpu_augmentation) and symmetric_class is not None:
+            raise ValueError(
+                "batch_fps and gpu_augmentation do not support symmetry labels"
+            )
         if self.dataset_indices == "None":
             dataset_indices = self.get_existing_data_indices()
             self.dataset_indices = dataset_indices
@@ -70,7 +104,7 @@ class PointCloudDataset(Dataset):
         self.num_demo = num_demo
 
         self.filenames = [
-            self.dataset_root / f"{idx}_{self.cloud_type}_obj_points.npz"
+            self.demo_filename(idx)
             for idx in self.dataset_indices
             if idx not in self.bad_demo_id
         ]
@@ -78,6 +112,11 @@ class PointCloudDataset(Dataset):
         if self.num_demo is not None:
             self.filenames = self.filenames[: self.num_demo]
 
+        # Load the demos once into shared memory instead of reading a file per sample.
+        self.cache = None
+        if cache_demos:
+            self.cache = DemoCache(self.filenames, self.load_raw_data)
+
     def get_fixed_transforms(self):
         points_action, points_anchor, _ = self.load_data(
             self.filenames[0],
@@ -106,6 +145,9 @@ class PointCloudDataset(Dataset):
     def get_existing_data_indices(self):
         import fnmatch
 
+        if self.store is not None:
+            return [int(idx) for idx in self.store.demo_ids]
+
         num_files = len(
             fnmatch.filter(
                 os.listdir(self.dataset_root), f"**_{self.cloud_type}_obj_points.npz"
@@ -119,14 +161,28 @@ class PointCloudDataset(Dataset):
         ]
         return file_indices
 
-    def load_data(self, filename, action_class, anchor_class):
+    def demo_filename(self, idx):
+        return self.dataset_root / f"{idx}_{self.cloud_type}_obj_points.npz"
+
+    def demo_exists(self, filename):
+        if self.store is not None:
+            return int(Path(filename).name.split("_")[0]) in self.store
+        return os.path.exists(filename)
+
+    def load_raw_data(self, filename):
+        """(points, classes, camera_idxs) of a demo; camera_idxs is None if not packed."""
+        if self.cache is not None:
+            return self.cache.get(filename)
+        if self.store is not None:
+            return self.store.get(int(Path(filename).name.split("_")[0]))
         point_data = np.load(filename, allow_pickle=True)
-        points_raw_np = point_data["clouds"]
-        classes_raw_np = point_data["classes"]
+        return point_data["clouds"], point_data["classes"], None
+
+    def load_data(self, filename, action_class, anchor_class):
+        points_raw_np, classes_raw_np, camera_idxs = self.load_raw_data(filename)
         if self.min_num_cameras < 4:
-            camera_idxs = np.concatenate(
-                [[0], np.cumsum((np.diff(classes_raw_np) == -2))]
-            )
+            if camera_idxs is None:
+                camera_idxs = compute_camera_idxs(classes_raw_np)
             if not np.all(np.isin(np.arange(4), np.unique(camera_idxs))):
                 print(
                     "\033[93m"
@@ -158,31 +214,100 @@ class PointCloudDataset(Dataset):
 
         return points_action, points_anchor, symmetric_cls
 
+    def demo_summary(self, filename):
+        """Per-class point counts of a demo and whether it has points from all 4 cameras."""
+        if self.store is not None:
+            _, classes, camera_idxs = self.store.get(
+                int(Path(filename).name.split("_")[0])
+            )
+        else:
+            classes = np.load(filename, allow_pickle=True)["classes"]
+            camera_idxs = compute_camera_idxs(classes)
+        labels, counts = np.unique(classes, return_counts=True)
+        return {
+            "class_counts": {str(l): int(c) for l, c in zip(labels, counts)},
+            "all_cameras": bool(np.all(np.isin(np.arange(4), camera_idxs))),
+        }
+
+    def load_validity_index(self):
+        """Summaries of the existing demos in dataset_indices, keyed by str(demo id).
+
+        Without a packed store, summaries are cached in
+        `{cloud_type}_validity_index.json` next to the data and recomputed only for
+        files whose mtime changed, so only new demos are read.
+        """
+        if self.store is not None:
+            return {
+                str(idx): self.demo_summary(self.demo_filename(idx))
+                for idx in self.dataset_indices
+                if int(idx) in self.store
+            }
+
+        path = self.dataset_root / f"{self.cloud_type}_validity_index.json"
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+
+        index = {}
+        for idx in self.dataset_indices:
+            filename = self.demo_filename(idx)
+            if not os.path.exists(filename):
+                continue
+            mtime = os.path.getmtime(filename)
+            summary = cached.get(str(idx))
+            if summary is None or summary["mtime"] != mtime:
+                summary = dict(self.demo_summary(filename), mtime=mtime)
+            index[str(idx)] = summary
+
+        if any(cached.get(k) != v for k, v in index.items()):
+            try:
+                with open(path, "w") as f:
+                    json.dump({**cached, **index}, f)
+            except OSError:
+                pass
+        return index
+
     def go_through_list(self):
+        """Ids of demos that are missing or have too few action/anchor points."""
+        index = self.load_validity_index()
         bad_demo_id = []
-        filenames = [
-            self.dataset_root / f"{idx}_{self.cloud_type}_obj_points.npz"
-            for idx in self.dataset_indices
-        ]
-        for i in range(len(filenames)):
-            filename = filenames[i]
-            if i == 0:
-                print(filename)
-            if not os.path.exists(filename):
-                bad_demo_id.append(i)
+        for idx in self.dataset_indices:
+            summary = index.get(str(idx))
+            if summary is None:
+                bad_demo_id.append(idx)
                 continue
-            points_action, points_anchor, _ = self.load_data(
-                filename,
-                action_class=self.action_class,
-                anchor_class=self.anchor_class,
-            )
-            if (points_action.shape[1] < self.num_points) or (
-                points_anchor.shape[1] < self.num_points
+            counts = summary["class_counts"]
+            if (
+                (self.min_num_cameras < 4 and not summary["all_cameras"])
+                or counts.get(str(self.action_class), 0) < self.num_points
+                or counts.get(str(self.anchor_class), 0) < self.num_points
             ):
-                bad_demo_id.append(i)
+                bad_demo_id.append(idx)
 
         return bad_demo_id
 
+    def farthest_point_sample(self, points, filename, cls, full_cloud):
+        """FPS down to num_points, reading a cached ordering when one applies.
+
+        With cached_fps, the orderings come from the packed store. They cover
+        each demo's full class cloud, so they are only valid when no cameras
+        were dropped and no points were occluded.
+        """
+        orderings = None
+        if full_cloud and self.cached_fps and self.min_num_cameras >= 4:
+            orderings = self.store.fps_ordering(
+                int(Path(filename).name.split("_")[0]), cls
+            )
+        if orderings is None or orderings.shape[1] < self.num_points:
+            return sample_farthest_points(
+                points, K=self.num_points, random_start_point=True
+            )
+        ordering = orderings[torch.randint(len(orderings), [1]).item()]
+        ids = torch.from_numpy(ordering[: self.num_points]).long().unsqueeze(0)
+        return points[:, ids[0]], ids
+
     def project_to_xy(self, vector):
         """
         vector: num_poins, 3
@@ -233,6 +358,17 @@ class PointCloudDataset(Dataset):
             anchor_class=self.anchor_class,
         )
 
+        if self.gpu_augmentation:
+            for name, points in [("Action", points_action), ("Anchor", points_anchor)]:
+                if points.shape[1] < self.num_points:
+                    raise NotImplementedError(
+                        f"{name} point cloud is smaller than cloud size ({points.shape[1]} < {self.num_points})"
+                    )
+            return {
+                "points_action": points_action.squeeze(0),
+                "points_anchor": points_anchor.squeeze(0),
+            }
+
         # if self.overfit:
         #     transform_idx = torch.randint(
         #         self.num_overfit_transforms, (1,)).item()
@@ -252,8 +388,13 @@ class PointCloudDataset(Dataset):
             device=points_anchor.device,
         )
 
+        occlude_action = (
+            self.synthetic_occlusion
+            and self.action_class == self.occlusion_class
+            and (self.ball_occlusion or self.plane_occlusion)
+        )
         if points_action.shape[1] > self.num_points:
-            if self.synthetic_occlusion and self.action_class == self.occlusion_class:
+            if occlude_action:
                 if self.ball_occlusion:
                     points_action = ball_occlusion(
                         points_action[0], radius=self.ball_radius
@@ -263,14 +404,17 @@ class PointCloudDataset(Dataset):
                         points_action[0], stand_off=self.plane_standoff
                     ).unsqueeze(0)
 
-            if points_action.shape[1] > self.num_points:
-                points_action, action_ids = sample_farthest_points(
-                    points_action, K=self.num_points, random_start_point=True
-                )
-            elif points_action.shape[1] < self.num_points:
+            if points_action.shape[1] < self.num_points:
                 raise NotImplementedError(
                     f"Action point cloud is smaller than cloud size ({points_action.shape[1]} < {self.num_points})"
                 )
+            elif points_action.shape[1] > self.num_points and not self.batch_fps:
+                points_action, action_ids = self.farthest_point_sample(
+                    points_action,
+                    filename,
+                    self.action_class,
+                    full_cloud=not occlude_action,
+                )
 
             if len(symmetric_cls) > 0:
                 symmetric_cls = symmetric_cls[action_ids.view(-1)]
@@ -279,8 +423,13 @@ class PointCloudDataset(Dataset):
                 f"Action point cloud is smaller than cloud size ({points_action.shape[1]} < {self.num_points})"
             )
 
+        occlude_anchor = (
+            self.synthetic_occlusion
+            and self.anchor_class == self.occlusion_class
+            and (self.ball_occlusion or self.plane_occlusion)
+        )
         if points_anchor.shape[1] > self.num_points:
-            if self.synthetic_occlusion and self.anchor_class == self.occlusion_class:
+            if occlude_anchor:
                 if self.ball_occlusion:
                     points_anchor = ball_occlusion(
                         points_anchor[0], radius=self.ball_radius
@@ -289,14 +438,17 @@ class PointCloudDataset(Dataset):
                     points_anchor = plane_occlusion(
                         points_anchor[0], stand_off=self.plane_standoff
                     ).unsqueeze(0)
-            if points_anchor.shape[1] > self.num_points:
-                points_anchor, _ = sample_farthest_points(
-                    points_anchor, K=self.num_points, random_start_point=True
-                )
-            elif points_anchor.shape[1] < self.num_points:
+            if points_anchor.shape[1] < self.num_points:
                 raise NotImplementedError(
                     f"Anchor point cloud is smaller than cloud size ({points_anchor.shape[1]} < {self.num_points})"
                 )
+            elif points_anchor.shape[1] > self.num_points and not self.batch_fps:
+                points_anchor, _ = self.farthest_point_sample(
+                    points_anchor,
+                    filename,
+                    self.anchor_class,
+                    full_cloud=not occlude_anchor,
+                )
         elif points_anchor.shape[1] < self.num_points:
             raise NotImplementedError(
                 f"Anchor point cloud is smaller than cloud size ({points_anchor.shape[1]} < {self.num_points})"
@@ -0,0 +1,142 @@
+import fnmatch
+import os
+from pathlib import Path
+
+import numpy as np
+
+from taxpose.datasets.fps import fps_orderings
+
+
+def default_packed_root(dataset_root, cloud_type):
+    return Path(dataset_root) / f"packed_{cloud_type}"
+
+
+def compute_camera_idxs(classes):
+    """Camera each point was rendered from, recovered from the class ordering.
+
+    Each camera's points are stored in class order, so a drop of 2 in the class
+    label marks the start of the next camera.
+    """
+    return np.concatenate([[0], np.cumsum((np.diff(classes) == -2))])
+
+
+def pack_point_clouds(
+    dataset_root, cloud_type, out_dir=None, fps_num_points=2048, fps_num_orderings=4
+):
+    """Pack every `{idx}_{cloud_type}_obj_points.npz` in dataset_root into one store.
+
+    The store is a directory of flat .npy arrays that can be memory-mapped:
+        points.npy       (P, 3) float32, all clouds concatenated
+        classes.npy      (P,) int64, per-point class label
+        camera_idxs.npy  (P,) int64, per-point camera index
+        index.npz        demo_ids (D,) and offsets (D + 1,) into the flat arrays
+        fps.npz          `{demo_id}_{class}`: (fps_num_orderings, <= fps_num_points)
+                         farthest point orderings of that class's points in the demo
+    """
+    dataset_root = Path(dataset_root)
+    out_dir = (
+        default_packed_root(dataset_root, cloud_type)
+        if out_dir is None
+        else Path(out_dir)
+    )
+    os.makedirs(out_dir, exist_ok=True)
+
+    filenames = fnmatch.filter(
+        os.listdir(dataset_root), f"**_{cloud_type}_obj_points.npz"
+    )
+    demo_ids = np.array(sorted(int(fn.split("_")[0]) for fn in filenames))
+    paths = [dataset_root / f"{idx}_{cloud_type}_obj_points.npz" for idx in demo_ids]
+
+    # First pass only decompresses the (small) class arrays to size the store.
+    sizes = [len(np.load(path, allow_pickle=True)["classes"]) for path in paths]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    total = int(offsets[-1])
+
+    points = np.lib.format.open_memmap(
+        out_dir / "points.npy", mode="w+", dtype=np.float32, shape=(total, 3)
+    )
+    classes = np.lib.format.open_memmap(
+        out_dir / "classes.npy", mode="w+", dtype=np.int64, shape=(total,)
+    )
+    camera_idxs = np.lib.format.open_memmap(
+        out_dir / "camera_idxs.npy", mode="w+", dtype=np.int64, shape=(total,)
+    )
+    for path, start, end in zip(paths, offsets[:-1], offsets[1:]):
+        point_data = np.load(path, allow_pickle=True)
+        points[start:end] = point_data["clouds"]
+        classes[start:end] = point_data["classes"]
+        camera_idxs[start:end] = compute_camera_idxs(point_data["classes"])
+    points.flush()
+    classes.flush()
+    camera_idxs.flush()
+
+    fps = {}
+    for demo_id, start, end in zip(demo_ids, offsets[:-1], offsets[1:]):
+        demo_points, demo_classes = points[start:end], classes[start:end]
+        for cls in np.unique(demo_classes):
+            fps[f"{demo_id}_{cls}"] = fps_orderings(
+                demo_points[demo_classes == cls],
+                fps_num_points,
+                fps_num_orderings,
+                seed=int(demo_id),
+            )
+    np.savez(out_dir / "fps.npz", **fps)
+
+    np.savez(out_dir / "index.npz", demo_ids=demo_ids, offsets=offsets)
+    return out_dir
+
+
+class PackedPointCloudStore:
+    """Read-only, memory-mapped view of a store written by `pack_point_clouds`.
+
+    `get` returns zero-copy slices, so opening the store in every DataLoader
+    worker is cheap and the pages are shared through the OS page cache.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        if not (self.root / "index.npz").exists():
+            raise FileNotFoundError(
+                f"no packed point cloud store at {self.root}, "
+                "create one with scripts/pack_point_clouds.py"
+            )
+        index = np.load(self.root / "index.npz")
+        self.demo_ids = index["demo_ids"]
+        self.offsets = index["offsets"]
+        self._rows = {int(idx): i for i, idx in enumerate(self.demo_ids)}
+        self._arrays = None
+        self._fps = None
+
+    def __getstate__(self):
+        # Pickling a memmap copies its contents; let each worker map the files itself.
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        state["_fps"] = None
+        return state
+
+    def _open(self):
+        if self._arrays is None:
+            self._arrays = tuple(
+                np.load(self.root / f"{name}.npy", mmap_mode="r")
+                for name in ["points", "classes", "camera_idxs"]
+            )
+        return self._arrays
+
+    def __len__(self):
+        return len(self.demo_ids)
+
+    def __contains__(self, demo_id):
+        return int(demo_id) in self._rows
+
+    def get(self, demo_id):
+        """(points, classes, camera_idxs) of one demo."""
+        row = self._rows[int(demo_id)]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return tuple(array[start:end] for array in self._open())
+
+    def fps_ordering(self, demo_id, cls):
+        """(num_orderings, K) FPS orderings of the class-`cls` points of a demo, or None."""
+        if self._fps is None:
+            path = self.root / "fps.npz"
+            self._fps = dict(np.load(path)) if path.exists() else {}
+        return self._fps.get(f"{int(demo_id)}_{int(cls)}")
@@ -18,6 +18,7 @@ class PretrainingMultiviewDataModule(pl.LightningDataModule):
         dataset_root=None,
         obj_class="mug",
         pretraining_data_path=None,
+        use_packed=False,
     ):
         super().__init__()
 
@@ -29,6 +30,7 @@ class PretrainingMultiviewDataModule(pl.LightningDataModule):
         self.dataset_root = dataset_root
         self.pretraining_data_path = pretraining_data_path
         self.obj_class = obj_class
+        self.use_packed = use_packed
 
         # 0 for mug, 1 for rack, 2 for gripper
         if self.cloud_class == 0:
@@ -48,6 +50,7 @@ class PretrainingMultiviewDataModule(pl.LightningDataModule):
                 ndf_data_path=self.pretraining_data_path,
                 obj_class=[self.obj_class],
                 phase="train",
+                use_packed=self.use_packed,
             )
         else:
             self.train_dataset = PretrainingPointCloudDataset(
@@ -68,6 +71,7 @@ class PretrainingMultiviewDataModule(pl.LightningDataModule):
                     ndf_data_path=self.pretraining_data_path,
                     obj_class=[self.obj_class],
                     phase="train",
+                    use_packed=self.use_packed,
                 )
             else:
                 self.train_dataset = PretrainingPointCloudDataset(
@@ -84,6 +88,7 @@ class PretrainingMultiviewDataModule(pl.LightningDataModule):
                     ndf_data_path=self.pretraining_data_path,
                     obj_class=[self.obj_class],
                     phase="val",
+                    use_packed=self.use_packed,
                 )
             else:
                 self.val_dataset = PretrainingPointCloudDataset(
@@ -95,7 +100,9 @@ class PretrainingMultiviewDataModule(pl.LightningDataModule):
         if stage == "test":
             if self.obj_class != "non_mug":
                 self.test_dataset = JointOccTrainDataset(
-                    ndf_data_path=self.pretraining_data_path, obj_class=[self.obj_class]
+                    ndf_data_path=self.pretraining_data_path,
+                    obj_class=[self.obj_class],
+                    use_packed=self.use_packed,
                 )
             else:
                 self.test_dataset = PretrainingPointCloudDataset(
@@ -0,0 +1,86 @@
+import os
+from collections import OrderedDict
+from typing import Any, Callable, List, Tuple
+
+import pybullet as p
+
+
+def _body_ids(client_id) -> List[int]:
+    return [
+        p.getBodyUniqueId(i, physicsClientId=client_id)
+        for i in range(p.getNumBodies(physicsClientId=client_id))
+    ]
+
+
+class RenderEnvPool:
+    """Per-process LRU pool of PMRenderEnvs, keyed by anchor object.
+
+    make_env(obj_id, dataset_path, camera_pos=...) builds an environment; it is
+    PMRenderEnv for PlaceDataset.
+
+    Building a PMRenderEnv starts a PyBullet client and parses the anchor's
+    PartNet-Mobility URDF, which dominates the cost of a sample when the same
+    scene is generated many times. A pooled environment is reset to the state
+    it was created in (joint angles, camera, no extra bodies) before it is
+    handed out again. PyBullet clients don't survive a fork, so a pool that
+    finds itself in a new process starts over instead of reusing them.
+    """
+
+    def __init__(self, make_env: Callable[..., Any], max_size: int = 4):
+        self.make_env = make_env
+        self.max_size = max_size
+        self._envs: "OrderedDict[tuple, Tuple[Any, dict]]" = OrderedDict()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_envs"] = OrderedDict()
+        return state
+
+    def get(self, obj_id: str, dataset_path: str, camera_pos) -> Any:
+        if self._pid != os.getpid():
+            self._envs = OrderedDict()
+            self._pid = os.getpid()
+
+        key = (obj_id, str(dataset_path), tuple(camera_pos))
+        if key in self._envs:
+            self._envs.move_to_end(key)
+            env, initial = self._envs[key]
+            self._reset(env, initial, camera_pos)
+            return env
+
+        env = self.make_env(obj_id, dataset_path, camera_pos=camera_pos)
+        initial = {
+            "bodies": set(_body_ids(env.client_id)),
+            "joints": {
+                i: p.getJointState(env.obj_id, i, physicsClientId=env.client_id)[:2]
+                for i in range(
+                    p.getNumJoints(env.obj_id, physicsClientId=env.client_id)
+                )
+                if p.getJointInfo(env.obj_id, i, physicsClientId=env.client_id)[2]
+                != p.JOINT_FIXED
+            },
+        }
+        self._envs[key] = (env, initial)
+        while len(self._envs) > self.max_size:
+            _, (evicted, _) = self._envs.popitem(last=False)
+            evicted.close()
+        return env
+
+    @staticmethod
+    def _reset(env, initial: dict, camera_pos):
+        # Drop whatever a previous sample left behind, e.g. after a failed attempt.
+        for body_id in _body_ids(env.client_id):
+            if body_id not in initial["bodies"]:
+                p.removeBody(body_id, physicsClientId=env.client_id)
+        for i, (position, velocity) in initial["joints"].items():
+            p.resetJointState(
+                env.obj_id, i, position, velocity, physicsClientId=env.client_id
+            )
+        env.set_camera(camera_pos)
+
+    def close(self):
+        if self._pid == os.getpid():
+            for env, _ in self._envs.values():
+                env.close()
+        self._envs = OrderedDict()
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+from torch.utils.data import Dataset
+
+# Constructor kwargs that change how samples are generated, not what they contain.
+NON_CONTENT_KWARGS = {"root", "scene_ids", "env_pool_size"}
+
+
+def _digest(content):
+    blob = json.dumps(content, sort_keys=True, default=str).encode()
+    return hashlib.sha1(blob).hexdigest()[:16]
+
+
+def sample_key(data_key, repeat, seed, dset_kwargs):
+    """Content address of one generated sample.
+
+    Hashes everything that determines the sample, so changing a dataset kwarg
+    only invalidates the samples it affects, and switching it back finds them
+    again.
+    """
+    kwargs = {k: v for k, v in dset_kwargs.items() if k not in NON_CONTENT_KWARGS}
+    return _digest([list(data_key), repeat, seed, kwargs])
+
+
+def sample_seed(data_key, repeat, seed):
+    """RNG seed of a sample. It doesn't depend on which worker, shard or run
+    generates the sample, nor on the dataset kwargs, so changing those keeps
+    the same scene draws."""
+    return int(_digest([list(data_key), repeat, seed]), 16)
+
+
+def load_manifest(store_dir):
+    """(built, failed): shard of every built sample, and the error of every
+    sample that failed to generate.
+
+    An interrupted build can leave a partial last line; it is ignored, and its
+    shard is rebuilt.
+    """
+    built, failed = {}, {}
+    path = Path(store_dir) / "manifest.jsonl"
+    if not path.exists():
+        return built, failed
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            built.update({key: entry["shard"] for key in entry["samples"]})
+            failed.update(entry["failed"])
+    return built, failed
+
+
+_worker_dset = None
+
+
+def _init_worker(dset_cls, dset_kwargs):
+    global _worker_dset
+    _worker_dset = dset_cls(**dset_kwargs)
+
+
+def _build_shard(task):
+    shard_dir, shard, samples = task
+    start = time.perf_counter()
+    data, failed = {}, {}
+    for key, data_key, seed in samples:
+        try:
+            data[key] = _worker_dset.get_data(*data_key, seed=seed)
+        except Exception as e:
+            failed[key] = f"{type(e).__name__}: {e}"
+    # Write-then-rename, so a shard listed in the manifest is always complete.
+    path = Path(shard_dir) / f"{shard}.pt"
+    torch.save(data, str(path) + ".tmp")
+    os.replace(str(path) + ".tmp", path)
+    return {
+        "shard": shard,
+        "samples": list(data),
+        "failed": failed,
+        "worker": os.getpid(),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def build_shards(
+    dset_cls,
+    dset_kwargs,
+    data_keys,
+    store_dir,
+    n_repeat=1,
+    seed=None,
+    shard_size=50,
+    n_workers=0,
+    retry_failed=False,
+):
+    """Generate the samples of `data_keys` x `n_repeat` missing from a shard store.
+
+    Each sample is generated by `dset_cls(**dset_kwargs).get_data(*data_key,
+    seed=...)` and stored under its `sample_key`. Missing samples are grouped
+    into shards of shard_size, written to store_dir/shards/, and a line is
+    appended to store_dir/manifest.jsonl as each shard finishes. Rerunning
+    after an interruption or with more keys or repeats builds only what is
+    missing. Samples that failed are skipped unless retry_failed is set.
+
+    Returns {worker pid: {"samples", "failed", "seconds"}}.
+    """
+    store_dir = Path(store_dir)
+    os.makedirs(store_dir / "shards", exist_ok=True)
+    built, failed = load_manifest(store_dir)
+
+    missing = []
+    for data_key in data_keys:
+        for repeat in range(n_repeat):
+            key = sample_key(data_key, repeat, seed, dset_kwargs)
+            if key not in built and (retry_failed or key not in failed):
+                missing.append(
+                    (key, tuple(data_key), sample_seed(data_key, repeat, seed))
+                )
+    tasks = []
+    for i in range(0, len(missing), shard_size):
+        samples = missing[i : i + shard_size]
+        shard = _digest([sample[0] for sample in samples])
+        tasks.append((str(store_dir / "shards"), shard, samples))
+    if not tasks:
+        return {}
+
+    stats = {}
+    with open(store_dir / "manifest.jsonl", "a") as manifest:
+        if n_workers == 0:
+            _init_worker(dset_cls, dset_kwargs)
+            results = map(_build_shard, tasks)
+            pool = None
+        else:
+            # Spawn, so no worker inherits a PyBullet client from this process.
+            pool = multiprocessing.get_context("spawn").Pool(
+                n_workers, initializer=_init_worker, initargs=(dset_cls, dset_kwargs)
+            )
+            results = pool.imap_unordered(_build_shard, tasks)
+        try:
+            for i, entry in enumerate(results):
+                manifest.write(json.dumps(entry) + "\n")
+                manifest.flush()
+                worker = stats.setdefault(
+                    entry["worker"], {"samples": 0, "failed": 0, "seconds": 0.0}
+                )
+                worker["samples"] += len(entry["samples"])
+                worker["failed"] += len(entry["failed"])
+                worker["seconds"] += entry["seconds"]
+                print(
+                    f"shard {i + 1}/{len(tasks)}: {len(entry['samples'])} samples, "
+                    f"{len(entry['failed'])} failed, {entry['seconds']:.1f}s "
+                    f"(worker {entry['worker']})"
+                )
+        finally:
+            if pool is not None:
+                pool.terminate()
+    return stats
+
+
+def print_worker_stats(stats):
+    print(f"{'worker':>8} {'samples':>8} {'failed':>7} {'samples/s':>10}")
+    for worker, s in sorted(stats.items()):
+        rate = s["samples"] / s["seconds"] if s["seconds"] > 0 else 0.0
+        print(f"{worker:>8} {s['samples']:>8} {s['failed']:>7} {rate:>10.2f}")
+
+
+class ShardedDataset(Dataset):
+    """Samples of `data_keys` x `n_repeat` from a store written by `build_shards`.
+
+    Indexed like `CachedByKeyDataset`, all repeats of a key in a row. Samples
+    that failed to generate are left out. Shards are loaded on demand and the
+    last max_open_shards are kept in memory.
+    """
+
+    def __init__(
+        self,
+        store_dir,
+        dset_kwargs,
+        data_keys,
+        n_repeat=1,
+        seed=None,
+        max_open_shards=8,
+    ):
+        self.shard_dir = Path(store_dir) / "shards"
+        built, _ = load_manifest(store_dir)
+        self.samples = []
+        for data_key in data_keys:
+            for repeat in range(n_repeat):
+                key = sample_key(data_key, repeat, seed, dset_kwargs)
+                if key in built:
+                    self.samples.append((key, built[key]))
+        self.max_open_shards = max_open_shards
+        self._shards = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        key, shard = self.samples[idx]
+        if shard in self._shards:
+            self._shards.move_to_end(shard)
+        else:
+            self._shards[shard] = torch.load(self.shard_dir / f"{shard}.pt")
+            if len(self._shards) > self.max_open_shards:
+                self._shards.popitem(last=False)
+        return self._shards[shard][key]
@@ -11,11 +11,31 @@ from third_party.dcp.model import DGCNN
 mse_criterion = nn.MSELoss(reduction="sum")
 
 
-def dense_flow_loss(points, flow_pred, trans_gt):
+def pad_packed(pos, ptr):
+    """Zero-pad a packed batch of clouds to its largest cloud.
+
+    pos (sum N_i, D) holds the clouds concatenated, as PyG batches them, and ptr
+    (B + 1,) their offsets. Returns (B, max N_i, D) clouds and a (B, max N_i)
+    mask of real points, or None for the mask if all clouds are the same size.
+    """
+    lengths = ptr[1:] - ptr[:-1]
+    if bool((lengths == lengths[0]).all()):
+        return pos.view(len(lengths), -1, pos.shape[-1]), None
+    mask = torch.arange(int(lengths.max()), device=pos.device) < lengths.unsqueeze(1)
+    padded = pos.new_zeros(*mask.shape, pos.shape[-1])
+    padded[mask] = pos
+    return padded, mask
+
+
+def _masked(x, mask):
+    return x if mask is None else x * mask.unsqueeze(-1)
+
+
+def dense_flow_loss(points, flow_pred, trans_gt, mask=None):
     flow_gt = trans_gt.transform_points(points) - points
     loss = mse_criterion(
-        flow_pred,
-        flow_gt,
+        _masked(flow_pred, mask),
+        _masked(flow_gt, mask),
     )
     return loss
 
@@ -23,7 +43,9 @@ def dense_flow_loss(points, flow_pred, trans_gt):
 class SE3LossTheirs(nn.Module):
     def forward(self, R_pred, R_gt, t_pred, t_gt):
         batch_size = len(t_gt)
-        identity = torch.eye(3).cuda().unsqueeze(0).repeat(batch_size, 1, 1)
+        identity = (
+            torch.eye(3, device=R_pred.device).unsqueeze(0).repeat(batch_size, 1, 1)
+        )
 
         R_loss = F.mse_loss(torch.matmul(R_pred.transpose(2, 1), R_gt), identity)
         t_loss = F.mse_loss(t_pred, t_gt)
@@ -33,7 +55,7 @@ class SE3LossTheirs(nn.Module):
 
 
 class BrianChuerLoss(nn.Module):
-    def forward(self, action_pos, T_pred, T_gt, Fx):
+    def forward(self, action_pos, T_pred, T_gt, Fx, mask=None):
         pred_flow_action = (T_gt.transform_points(action_pos) - action_pos).detach()
 
         loss = brian_chuer_loss(
@@ -42,6 +64,7 @@ class BrianChuerLoss(nn.Module):
             points_trans_action=action_pos,
             pred_flow_action=Fx,
             points_action=T_gt.transform_points(action_pos),
+            mask=mask,
         )
         return loss
 
@@ -55,7 +78,10 @@ def brian_chuer_loss(
     action_weight=1.0,
     smoothness_weight=0.1,
     consistency_weight=1.0,
+    mask=None,
 ):
+    """mask (B, N) marks the real points of zero-padded clouds; padded points
+    don't contribute to any of the terms."""
     induced_flow_action = (
         pred_T_action.transform_points(points_trans_action) - points_trans_action
     ).detach()
@@ -66,18 +92,23 @@ def brian_chuer_loss(
     # pred_T_action=T0^-1
     # gt_T_action = T0.inverse()
 
-    point_loss_action = mse_criterion(pred_points_action, points_action)
+    point_loss_action = mse_criterion(
+        _masked(pred_points_action, mask), _masked(points_action, mask)
+    )
 
     point_loss = action_weight * point_loss_action
 
     dense_loss = dense_flow_loss(
-        points=points_trans_action, flow_pred=pred_flow_action, trans_gt=gt_T_action
+        points=points_trans_action,
+        flow_pred=pred_flow_action,
+        trans_gt=gt_T_action,
+        mask=mask,
     )
 
     # Loss associated flow vectors matching a consistent rigid transform
     smoothness_loss_action = mse_criterion(
-        pred_flow_action,
-        induced_flow_action,
+        _masked(pred_flow_action, mask),
+        _masked(induced_flow_action, mask),
     )
 
     smoothness_loss = action_weight * smoothness_loss_action
@@ -110,6 +141,26 @@ class DummyParams(nn.Module):
         return self.actor_params, self.anchor_params
 
 
+def batched_procrustes(H, reflect):
+    """Solve the orthogonal Procrustes problem for a batch of 3x3 matrices at once.
+
+    Args:
+        H: (B, 3, 3) cross-covariance matrices.
+        reflect: (3, 3) diag(1, 1, -1) used to undo reflections.
+
+    Returns:
+        U, S, V, R stacked over the batch. As in the original per-sample loop, V is
+        the third output of `torch.linalg.svd`, and samples whose R has a negative
+        determinant get V @ reflect instead of a second SVD.
+    """
+    U, S, V = torch.linalg.svd(H)
+    R = torch.matmul(V, U.transpose(2, 1).contiguous())
+    flip = (torch.det(R) < 0).view(-1, 1, 1)
+    V = torch.where(flip, torch.matmul(V, reflect), V)
+    R = torch.where(flip, torch.matmul(V, U.transpose(2, 1).contiguous()), R)
+    return U, S, V, R
+
+
 class SVDHead(nn.Module):
     def __init__(self):
         super(SVDHead, self).__init__()
@@ -145,31 +196,7 @@ class SVDHead(nn.Module):
             aws * src_centered, src_corr_centered.transpose(2, 1).contiguous()
         )
 
-        U, S, V = [], [], []
-        R = []
-
-        for i in range(src.size(0)):
-            # print(H[i])
-            r_pert = (torch.rand(3, 3) * 1e-7).to(H[i].device)
-            r_pert = 0.0
-            u, s, v = torch.linalg.svd(H[i] + r_pert)
-            r = torch.matmul(v, u.transpose(1, 0).contiguous())
-            r_det = torch.det(r)
-            if r_det < 0:
-                u, s, v = torch.linalg.svd(H[i] + r_pert)
-                v = torch.matmul(v, self.reflect)
-                r = torch.matmul(v, u.transpose(1, 0).contiguous())
-                # r = r * self.reflect
-            R.append(r)
-
-            U.append(u)
-            S.append(s)
-            V.append(v)
-
-        U = torch.stack(U, dim=0)
-        V = torch.stack(V, dim=0)
-        S = torch.stack(S, dim=0)
-        R = torch.stack(R, dim=0)
+        U, S, V, R = batched_procrustes(H, self.reflect)
 
         t = torch.matmul(-R, src.mean(dim=2, keepdim=True)) + src_corr.mean(
             dim=2, keepdim=True
@@ -211,6 +238,16 @@ class TAXPoseModel(nn.Module):
     def forward(self, action, anchor):
         X, Y = action.pos, anchor.pos
         aws = None
+        if not self.arch.startswith("brianchuer"):
+            # Only the brianchuer archs mask padding; the others view the
+            # packed points as equal-sized clouds.
+            for data in [action, anchor]:
+                ptr = getattr(data, "ptr", None)
+                if ptr is not None and pad_packed(data.pos, ptr)[1] is not None:
+                    raise ValueError(
+                        f"arch {self.arch} needs clouds of one size, "
+                        "use packed=False or a brianchuer arch"
+                    )
         if self.arch == "dummy":
             Ex, Ey = self.net(action, anchor)
         # elif self.arch == "pn":
@@ -226,15 +263,18 @@ class TAXPoseModel(nn.Module):
                 Ex = Ex[:, :-1, :]
             # breakpoint()
         elif self.arch == "brianchuer" or self.arch == "brianchuer-loss":
-            Xs = X.view(action.num_graphs, -1, 3)
-            Ys = Y.view(anchor.num_graphs, -1, 3)
-            R_pred, t_pred, pred_T_action, Fx, Fy = self.net(Xs, Ys)
+            # Clouds of different sizes are padded; the masks keep padding out.
+            Xs, mask_x = pad_packed(X, action.ptr)
+            Ys, mask_y = pad_packed(Y, anchor.ptr)
+            R_pred, t_pred, pred_T_action, Fx, Fy = self.net(
+                Xs, Ys, mask_x=mask_x, mask_y=mask_y
+            )
             return R_pred, t_pred, None, pred_T_action, Fx, Fy
         elif self.arch == "brianchuer-gc":
-            Xs = X.view(action.num_graphs, -1, 3)
-            Ys = Y.view(anchor.num_graphs, -1, 3)
+            Xs, mask_x = pad_packed(X, action.ptr)
+            Ys, mask_y = pad_packed(Y, anchor.ptr)
             R_pred, t_pred, pred_T_action, Fx, Fy = self.net(
-                Xs, Ys, action.loc.unsqueeze(-1)
+                Xs, Ys, action.loc.unsqueeze(-1), mask_x=mask_x, mask_y=mask_y
             )
             return R_pred, t_pred, None, pred_T_action, Fx, Fy
         else:
@@ -0,0 +1,47 @@
+import torch
+from torch import nn
+
+
+class _PerSampleBatchNorm(nn.Module):
+    """Train-mode batch norm that normalizes each sample with its own statistics.
+
+    The eval scripts run the networks in train mode on one sample at a time, so
+    batch norm sees the statistics of that sample only. Computing them per
+    sample keeps exactly that behaviour for a micro-batch, and the plain ops
+    also export to every runtime. In eval mode the running statistics are used,
+    unless in_eval_mode is set.
+    """
+
+    def __init__(self, bn, in_eval_mode=False):
+        super().__init__()
+        self.bn = bn
+        self.in_eval_mode = in_eval_mode
+
+    def forward(self, x):
+        if not (self.training or self.in_eval_mode):
+            return self.bn(x)
+        if x.dim() < 3:
+            # A (B, C) sample has one value per channel, so no statistics of its own.
+            raise ValueError(
+                f"per-sample batch norm needs (B, C, ...) inputs, got {tuple(x.shape)}"
+            )
+        dims = list(range(2, x.dim()))
+        mean = x.mean(dim=dims, keepdim=True)
+        var = ((x - mean) ** 2).mean(dim=dims, keepdim=True)
+        x = (x - mean) / torch.sqrt(var + self.bn.eps)
+        if self.bn.affine:
+            shape = (1, -1) + (1,) * len(dims)
+            x = x * self.bn.weight.view(shape) + self.bn.bias.view(shape)
+        return x
+
+
+def per_sample_batch_norm(module, in_eval_mode=False):
+    """Swap every batch norm layer in module for a `_PerSampleBatchNorm`, in place."""
+    for name, child in module.named_children():
+        if isinstance(child, _PerSampleBatchNorm):
+            continue
+        if isinstance(child, nn.modules.batchnorm._BatchNorm):
+            setattr(module, name, _PerSampleBatchNorm(child, in_eval_mode))
+        else:
+            per_sample_batch_norm(child, in_eval_mode)
+    return module
@@ -2,7 +2,8 @@ import torch
 from torch import nn as nn
 from torch.nn import functional as F
 
-from third_party.dcp.model import get_graph_feature
+from taxpose.nets.pointnet import masked_batch_norm
+from third_party.dcp.model import KNN_CHUNK_SIZE, get_graph_feature
 
 
 class DGCNN_GC(nn.Module):
@@ -10,8 +11,11 @@ class DGCNN_GC(nn.Module):
 
     See: https://github.com/WangYueFt/dcp/blob/master/model.py"""
 
-    def __init__(self, emb_dims=512, input_dims=3, gc=False):
+    def __init__(
+        self, emb_dims=512, input_dims=3, gc=False, knn_chunk_size=KNN_CHUNK_SIZE
+    ):
         super(DGCNN_GC, self).__init__()
+        self.knn_chunk_size = knn_chunk_size
         self.conv1 = nn.Conv2d(input_dims * 2, 64, kernel_size=1, bias=False)
         self.conv2 = nn.Conv2d(64, 64, kernel_size=1, bias=False)
         self.conv3 = nn.Conv2d(64, 128, kernel_size=1, bias=False)
@@ -26,20 +30,25 @@ class DGCNN_GC(nn.Module):
         if gc:
             self.cat_mlp = nn.Sequential(nn.Linear(1, 64), nn.ReLU())
 
-    def forward(self, x, cat=None):
-        """Same as the original DGCNN model, but with an optional goal-conditioning."""
+    def forward(self, x, cat=None, idx=None, mask=None):
+        """Same as the original DGCNN model, but with an optional goal-conditioning.
+
+        A precomputed kNN index (B, N, k) can be passed as `idx` to skip the graph build.
+        For zero-padded clouds, mask (B, N) keeps the padding out of the batch norm
+        statistics; `idx` should then be built without the padding too.
+        """
         batch_size, num_dims, num_points = x.size()
-        x = get_graph_feature(x)
-        x = F.relu(self.bn1(self.conv1(x)))
+        x = get_graph_feature(x, idx=idx, chunk_size=self.knn_chunk_size)
+        x = F.relu(masked_batch_norm(self.bn1, self.conv1(x), mask))
         x1 = x.max(dim=-1, keepdim=True)[0]
 
-        x = F.relu(self.bn2(self.conv2(x)))
+        x = F.relu(masked_batch_norm(self.bn2, self.conv2(x), mask))
         x2 = x.max(dim=-1, keepdim=True)[0]
 
-        x = F.relu(self.bn3(self.conv3(x)))
+        x = F.relu(masked_batch_norm(self.bn3, self.conv3(x), mask))
         x3 = x.max(dim=-1, keepdim=True)[0]
 
-        x = F.relu(self.bn4(self.conv4(x)))
+        x = F.relu(masked_batch_norm(self.bn4, self.conv4(x), mask))
         x4 = x.max(dim=-1, keepdim=True)[0]
 
         if cat is not None:
@@ -49,5 +58,6 @@ class DGCNN_GC(nn.Module):
 
         x = torch.cat((x1, x2, x3, x4), dim=1)
 
-        x = F.relu(self.bn5(self.conv5(x))).view(batch_size, -1, num_points)
+        x = F.relu(masked_batch_norm(self.bn5, self.conv5(x), mask))
+        x = x.view(batch_size, -1, num_points)
         return x
@@ -0,0 +1,58 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+class EmbeddingCache:
+    """LRU cache of point cloud embeddings, keyed on the content of the cloud.
+
+    The key is a hash of the cloud quantized to `resolution`, and a hit is only
+    used if the cached cloud also matches within `atol`, so a cloud that was
+    mean-centered after a rigid translation maps to the same entry despite
+    floating point noise.
+    """
+
+    def __init__(self, max_size=8, resolution=1e-4, atol=1e-5):
+        self.max_size = max_size
+        self.resolution = resolution
+        self.atol = atol
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, points):
+        quantized = torch.round(points.detach() / self.resolution).int()
+        digest = hashlib.blake2b(quantized.cpu().numpy().tobytes(), digest_size=16)
+        return (tuple(points.shape), str(points.device), digest.hexdigest())
+
+    def get_or_compute(self, points, compute):
+        """Embedding of points, computed with compute(points) on a miss."""
+        key = self.key(points)
+        entry = self.entries.get(key)
+        if entry is not None and torch.allclose(entry[0], points, atol=self.atol):
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        embedding = compute(points)
+        self.entries[key] = (points.detach().clone(), embedding.detach())
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return embedding
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return (
+            f"EmbeddingCache(size={len(self)}/{self.max_size}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
@@ -0,0 +1,154 @@
+"""Export-friendly inference wrapper for ResidualFlow_DiffEmbTransformer.
+
+The training model takes `*input`, branches on its configuration flags, reads
+the cross-attention back from an attribute of the last decoder layer and picks
+a kNN backend at runtime, none of which survives graph export.
+`ExportableResidualFlow` runs the same computation with a fixed signature and
+no side effects, so it can be traced to TorchScript or exported to ONNX with
+dynamic point counts.
+The pose is still solved from the exported flows with `dualflow2pose`.
+"""
+import copy
+from typing import Tuple
+
+import torch
+from torch import nn
+
+from taxpose.nets.batch_norm import per_sample_batch_norm
+from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
+from third_party.dcp.model import MultiHeadedAttention, attention, knn
+
+DGCNN_K = 20
+
+
+class ExportableResidualFlow(nn.Module):
+    """ResidualFlow_DiffEmbTransformer.forward with a fixed, traceable signature.
+
+    forward(points_action (B, N, 3), points_anchor (B, M, 3)) returns the flows
+    and weights of both clouds, (B, N, 4) and (B, M, 4), as the model does. The
+    wrapped model is copied, so the original is left untouched.
+    With `sample_stats_bn` batch norm uses the statistics of each sample, as in
+    the eval scripts; otherwise the model's running statistics are used.
+    """
+
+    def __init__(self, model: ResidualFlow_DiffEmbTransformer, sample_stats_bn=True):
+        super().__init__()
+        if not (model.cycle and model.pred_weight and model.return_attn):
+            raise ValueError(
+                "export needs cycle=True, pred_weight=True and return_attn=True"
+            )
+        model = copy.deepcopy(model).eval()
+        model.anchor_emb_cache = None
+        for module in model.modules():
+            if isinstance(module, MultiHeadedAttention):
+                module.memory_efficient = False
+        if sample_stats_bn:
+            per_sample_batch_norm(model, in_eval_mode=True)
+        self.center_feature = model.center_feature
+        self.emb_nn_action = model.emb_nn_action
+        self.emb_nn_anchor = model.emb_nn_anchor
+        self.transformer_action = model.transformer_action.model
+        self.transformer_anchor = model.transformer_anchor.model
+        self.head_action = model.head_action
+        self.head_anchor = model.head_anchor
+        self.eval()
+
+    @staticmethod
+    def _embed(emb_nn, points):
+        # Dense kNN: no tiling loop or CPU KD-tree that would freeze the size.
+        return emb_nn(points, idx=knn(points, DGCNN_K, chunk_size=None))
+
+    @staticmethod
+    def _cross_attend(transformer, src, tgt):
+        """CustomTransformer(src, tgt) that returns its last cross-attention."""
+        memory = transformer.encoder(tgt.transpose(2, 1), None)
+        x = src.transpose(2, 1)
+        layers = transformer.decoder.layers
+        for layer in layers[:-1]:
+            x = layer(x, memory, None, None)
+
+        last = layers[-1]
+        x = last.sublayer[0](x, lambda y: last.self_attn(y, y, y, None))
+        mha = last.src_attn
+        B = x.shape[0]
+        q, k, v = [
+            linear(y).view(B, -1, mha.h, mha.d_k).transpose(1, 2)
+            for linear, y in zip(
+                mha.linears, (last.sublayer[1].norm(x), memory, memory)
+            )
+        ]
+        attended, attn = attention(q, k, v)
+        attended = attended.transpose(1, 2).reshape(B, -1, mha.h * mha.d_k)
+        x = x + mha.linears[-1](attended)
+        x = last.sublayer[2](x, last.feed_forward)
+        return transformer.decoder.norm(x).transpose(2, 1), attn.mean(dim=1)
+
+    def forward(
+        self, points_action: torch.Tensor, points_anchor: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        action_points = points_action.permute(0, 2, 1)[:, :3]  # B,3,N
+        anchor_points = points_anchor.permute(0, 2, 1)[:, :3]
+        action_input = action_points
+        anchor_input = anchor_points
+        if self.center_feature:
+            action_input = action_points - action_points.mean(dim=2, keepdim=True)
+            anchor_input = anchor_points - anchor_points.mean(dim=2, keepdim=True)
+        action_embedding = self._embed(self.emb_nn_action, action_input)
+        anchor_embedding = self._embed(self.emb_nn_anchor, anchor_input)
+
+        action_tf, action_attn = self._cross_attend(
+            self.transformer_action, action_embedding, anchor_embedding
+        )
+        anchor_tf, anchor_attn = self._cross_attend(
+            self.transformer_anchor, anchor_embedding, action_embedding
+        )
+        action_tf = action_embedding + action_tf
+        anchor_tf = anchor_embedding + anchor_tf
+
+        flow_action = self.head_action(
+            action_tf, anchor_tf, action_points, anchor_points, scores=action_attn
+        )
+        flow_anchor = self.head_anchor(
+            anchor_tf, action_tf, anchor_points, action_points, scores=anchor_attn
+        )
+        return flow_action.permute(0, 2, 1), flow_anchor.permute(0, 2, 1)
+
+
+def export_torchscript(wrapper, path, num_points=512):
+    """Trace, freeze and save the wrapper. Sizes are not baked in, any N and M work."""
+    example = (torch.randn(1, num_points, 3), torch.randn(1, num_points, 3))
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper.eval(), example, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    traced.save(str(path))
+    return traced
+
+
+def export_onnx(wrapper, path, num_points=512, opset_version=14):
+    """Export the wrapper to ONNX with dynamic batch size and point counts."""
+    example = (torch.randn(1, num_points, 3), torch.randn(1, num_points, 3))
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            example,
+            str(path),
+            input_names=["points_action", "points_anchor"],
+            output_names=["flow_action", "flow_anchor"],
+            dynamic_axes={
+                "points_action": {0: "batch", 1: "num_points_action"},
+                "points_anchor": {0: "batch", 1: "num_points_anchor"},
+                "flow_action": {0: "batch", 1: "num_points_action"},
+                "flow_anchor": {0: "batch", 1: "num_points_anchor"},
+            },
+            opset_version=opset_version,
+        )
+
+
+def load_residual_flow(checkpoint_file, **model_kwargs):
+    """ResidualFlow_DiffEmbTransformer from an EquivarianceTestingModule checkpoint."""
+    state_dict = torch.load(checkpoint_file, map_location="cpu")["state_dict"]
+    model = ResidualFlow_DiffEmbTransformer(**model_kwargs)
+    model.load_state_dict(
+        {k[len("model.") :]: v for k, v in state_dict.items() if k.startswith("model.")}
+    )
+    return model
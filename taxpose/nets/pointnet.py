@@ -1,7 +1,39 @@
+import torch
 import torch.nn.functional as F
 from torch import nn
 
 
+def masked_batch_norm(bn, x, mask=None):
+    """`bn(x)`, but in training mode the batch statistics (and the running
+    statistics updated from them) only cover the points where mask is True.
+
+    x: (B, C, N) or (B, C, N, K), mask: (B, N) bool or None.
+    """
+    if mask is None or not bn.training:
+        return bn(x)
+    weights = mask.view(mask.shape[0], 1, mask.shape[1], *([1] * (x.dim() - 3)))
+    weights = weights.expand(-1, 1, *x.shape[2:]).to(x.dtype)
+    dims = [0] + list(range(2, x.dim()))
+    count = weights.sum()
+    stat_shape = (1, -1) + (1,) * (x.dim() - 2)
+    mean = (x * weights).sum(dims) / count
+    var = ((x - mean.view(stat_shape)) ** 2 * weights).sum(dims) / count
+    if bn.track_running_stats:
+        with torch.no_grad():
+            bn.num_batches_tracked += 1
+            if bn.momentum is None:
+                momentum = 1.0 / float(bn.num_batches_tracked)
+            else:
+                momentum = bn.momentum
+            unbiased_var = var * count / (count - 1)
+            bn.running_mean.mul_(1 - momentum).add_(momentum * mean)
+            bn.running_var.mul_(1 - momentum).add_(momentum * unbiased_var)
+    x = (x - mean.view(stat_shape)) / torch.sqrt(var.view(stat_shape) + bn.eps)
+    if bn.affine:
+        x = x * bn.weight.view(stat_shape) + bn.bias.view(stat_shape)
+    return x
+
+
 class PointNet(nn.Module):
     def __init__(self, layer_dims=[3, 64, 64, 64, 128, 512]):
         super(PointNet, self).__init__()
@@ -18,7 +50,7 @@ class PointNet(nn.Module):
         self.convs = nn.ModuleList(convs)
         self.norms = nn.ModuleList(norms)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         for bn, conv in zip(self.norms, self.convs):
-            x = F.relu(bn(conv(x)))
+            x = F.relu(masked_batch_norm(bn, conv(x), mask))
         return x
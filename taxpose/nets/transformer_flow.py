@@ -8,10 +8,50 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from taxpose.nets.embedding_cache import EmbeddingCache
 from taxpose.nets.pointnet import PointNet
 from taxpose.nets.transformer_flow_pm import CustomTransformer
+from taxpose.nets.twin_branches import TwinDGCNN, TwinTransformer
 from third_party.dcp.model import DGCNN
 
+CORR_CHUNK_SIZE = 1024
+
+
+def topk_scores(action_query, anchor_key, k, chunk_size=CORR_CHUNK_SIZE):
+    """Softmax attention of each action point over its k best anchor matches.
+
+    action_query: (B, C, N), anchor_key: (B, C, M).
+    Action points are processed in tiles of `chunk_size` so the B x N x M
+    logits are never held at once. `chunk_size=None` disables tiling.
+    Returns weights (B, N, k), renormalized over the k matches, and their
+    anchor indices (B, N, k).
+    """
+    num_points = action_query.size(2)
+    if chunk_size is None:
+        chunk_size = num_points
+    query = action_query.transpose(2, 1) / math.sqrt(action_query.size(1))
+    weights, idx = [], []
+    for start in range(0, num_points, chunk_size):
+        logits = torch.matmul(query[:, start : start + chunk_size], anchor_key)
+        logits, chunk_idx = logits.topk(k=min(k, logits.size(2)), dim=-1)
+        weights.append(torch.softmax(logits, dim=-1))
+        idx.append(chunk_idx)
+    return torch.cat(weights, dim=1), torch.cat(idx, dim=1)
+
+
+def sparsify_scores(scores, k):
+    """Keeps the k largest entries of each row of (B, N, M) soft correspondence
+    scores, renormalized. Returns weights (B, N, k) and anchor indices (B, N, k)."""
+    weights, idx = scores.topk(k=min(k, scores.size(2)), dim=-1)
+    return weights / weights.sum(dim=-1, keepdim=True), idx
+
+
+def gather_corr_points(anchor_points, weights, idx):
+    """anchor_points: (B, 3, M); weights, idx: (B, N, k). Returns (B, 3, N)."""
+    B, N, k = idx.shape
+    neighbors = anchor_points.gather(2, idx.reshape(B, 1, N * k).expand(-1, 3, -1))
+    return (neighbors.view(B, 3, N, k) * weights.unsqueeze(1)).sum(dim=-1)
+
 
 class EquivariantFeatureEmbeddingNetwork(nn.Module):
     def __init__(self, emb_dims=512, emb_nn="dgcnn"):
@@ -201,7 +241,9 @@ class ResidualMLPHead(nn.Module):
     v_i = f(\phi_i) + \tilde{y}_i - x_i
     """
 
-    def __init__(self, emb_dims=512, pred_weight=True, residual_on=True):
+    def __init__(
+        self, emb_dims=512, pred_weight=True, residual_on=True, corr_topk=None
+    ):
         super(ResidualMLPHead, self).__init__()
 
         self.emb_dims = emb_dims
@@ -225,6 +267,8 @@ class ResidualMLPHead(nn.Module):
             )
 
         self.residual_on = residual_on
+        # If set, \tilde{y}_i only averages over the corr_topk best anchor matches.
+        self.corr_topk = corr_topk
 
     def forward(
         self, *input, scores=None, return_flow_component=False, return_embedding=False
@@ -242,13 +286,24 @@ class ResidualMLPHead(nn.Module):
                 action_query = input[4]
                 anchor_key = input[5]
 
-            d_k = action_query.size(1)
-            scores = torch.matmul(
-                action_query.transpose(2, 1).contiguous(), anchor_key
-            ) / math.sqrt(d_k)
-            # W_i # B, N, N (N=number of points, 1024 cur)
-            scores = torch.softmax(scores, dim=2)
-        corr_points = torch.matmul(anchor_points, scores.transpose(2, 1).contiguous())
+            if self.corr_topk is not None:
+                scores, corr_idx = topk_scores(action_query, anchor_key, self.corr_topk)
+            else:
+                d_k = action_query.size(1)
+                scores = torch.matmul(
+                    action_query.transpose(2, 1).contiguous(), anchor_key
+                ) / math.sqrt(d_k)
+                # W_i # B, N, N (N=number of points, 1024 cur)
+                scores = torch.softmax(scores, dim=2)
+        elif self.corr_topk is not None:
+            scores, corr_idx = sparsify_scores(scores, self.corr_topk)
+        if self.corr_topk is not None:
+            # scores: B, N, k over the anchor points in corr_idx
+            corr_points = gather_corr_points(anchor_points, scores, corr_idx)
+        else:
+            corr_points = torch.matmul(
+                anchor_points, scores.transpose(2, 1).contiguous()
+            )
         # \tilde{y}_i = sum_{j}{w_ij,y_j}, - x_i  # B, 3, N
         corr_flow = corr_points - action_points
 
@@ -272,6 +327,7 @@ class ResidualMLPHead(nn.Module):
                 "corr_flow": corr_flow,
                 "corr_points": corr_points,
                 "scores": scores,
+                "corr_idx": corr_idx if self.corr_topk is not None else None,
             }
         return corr_flow_weight
 
@@ -288,6 +344,10 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
         residual_on=True,
         freeze_embnn=False,
         return_attn=True,
+        memory_efficient_attn=False,
+        anchor_emb_cache_size=0,
+        fuse_twin_branches=False,
+        corr_topk=None,
     ):
         super(ResidualFlow_DiffEmbTransformer, self).__init__()
         self.emb_dims = emb_dims
@@ -303,24 +363,97 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
         self.residual_on = residual_on
         self.freeze_embnn = freeze_embnn
         self.return_attn = return_attn
+        self.memory_efficient_attn = memory_efficient_attn
+        # Opt-in, inference only: reuse anchor embeddings of clouds seen recently.
+        # The cache is cleared whenever the anchor DGCNN's weights change.
+        self.anchor_emb_cache = (
+            EmbeddingCache(max_size=anchor_emb_cache_size)
+            if anchor_emb_cache_size > 0
+            else None
+        )
+        self._anchor_emb_cache_key = None
+        # Opt-in, inference only: run the action and anchor DGCNNs and
+        # transformers as one fused pass when both clouds have the same size.
+        # The fused copies of the weights are rebuilt whenever the weights change.
+        self.fuse_twin_branches = fuse_twin_branches
+        self._twin_branches = None
+        self._twin_branches_key = None
 
         self.transformer_action = CustomTransformer(
-            emb_dims=emb_dims, return_attn=self.return_attn, bidirectional=False
+            emb_dims=emb_dims,
+            return_attn=self.return_attn,
+            bidirectional=False,
+            memory_efficient_attn=self.memory_efficient_attn,
         )
         self.transformer_anchor = CustomTransformer(
-            emb_dims=emb_dims, return_attn=self.return_attn, bidirectional=False
+            emb_dims=emb_dims,
+            return_attn=self.return_attn,
+            bidirectional=False,
+            memory_efficient_attn=self.memory_efficient_attn,
         )
+        if self.memory_efficient_attn and not self.cycle:
+            # The anchor flow head is never run, so its attention is not needed.
+            self.transformer_anchor.model.decoder.layers[-1].src_attn.need_attn = False
+        # With return_attn=False the heads score the embeddings themselves, which
+        # corr_topk does in O(N * corr_topk) memory; otherwise it sparsifies the
+        # returned attention.
         self.head_action = ResidualMLPHead(
             emb_dims=emb_dims,
             pred_weight=self.pred_weight,
             residual_on=self.residual_on,
+            corr_topk=corr_topk,
         )
         self.head_anchor = ResidualMLPHead(
             emb_dims=emb_dims,
             pred_weight=self.pred_weight,
             residual_on=self.residual_on,
+            corr_topk=corr_topk,
         )
 
+    def embed_anchor(self, anchor_points):
+        # With center_feature, a rigidly translated anchor (as between refinement
+        # loops) has the same DGCNN input, so it hits the cache.
+        if self.anchor_emb_cache is None or torch.is_grad_enabled():
+            return self.emb_nn_anchor(anchor_points)
+        # As in twin_branches, but with the buffers: eval mode uses the BN
+        # running statistics, and a train-mode forward bumps num_batches_tracked.
+        key = (
+            tuple(t._version for t in self.emb_nn_anchor.parameters()),
+            tuple(t._version for t in self.emb_nn_anchor.buffers()),
+            self.training,
+        )
+        if key != self._anchor_emb_cache_key:
+            self.anchor_emb_cache.clear()
+            self._anchor_emb_cache_key = key
+        return self.anchor_emb_cache.get_or_compute(anchor_points, self.emb_nn_anchor)
+
+    def twin_branches(self):
+        """(TwinDGCNN, TwinTransformer) with the current weights of both branches."""
+        modules = [
+            self.emb_nn_action,
+            self.emb_nn_anchor,
+            self.transformer_action,
+            self.transformer_anchor,
+        ]
+        params = [p for m in modules for p in m.parameters()]
+        # Parameter versions change with every in-place update (optimizer steps,
+        # load_state_dict). BN running statistics are left out: they only move in
+        # train mode, where they are not used.
+        key = (
+            tuple(p._version for p in params),
+            params[0].device,
+            self.training,
+        )
+        if key != self._twin_branches_key:
+            self._twin_branches = (
+                TwinDGCNN(self.emb_nn_action, self.emb_nn_anchor),
+                TwinTransformer(self.transformer_action, self.transformer_anchor),
+            )
+            for module in self._twin_branches:
+                module.to(params[0].device).train(self.training)
+            self._twin_branches_key = key
+        return self._twin_branches
+
     def forward(self, *input):
         action_points = input[0].permute(0, 2, 1)[:, :3]  # B,3,num_points
         anchor_points = input[1].permute(0, 2, 1)[:, :3]
@@ -331,15 +464,38 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
         if not self.center_feature:
             action_points_dmean = action_points
             anchor_points_dmean = anchor_points
-        if self.freeze_embnn:
+
+        fused = (
+            self.fuse_twin_branches
+            and not torch.is_grad_enabled()
+            and action_points.shape[2] == anchor_points.shape[2]
+        )
+        if fused:
+            twin_emb_nn, twin_transformer = self.twin_branches()
+        if fused and self.anchor_emb_cache is None:
+            action_embedding, anchor_embedding = twin_emb_nn(
+                action_points_dmean, anchor_points_dmean
+            )
+        elif self.freeze_embnn:
             action_embedding = self.emb_nn_action(action_points_dmean).detach()
-            anchor_embedding = self.emb_nn_anchor(anchor_points_dmean).detach()
+            anchor_embedding = self.embed_anchor(anchor_points_dmean).detach()
         else:
             action_embedding = self.emb_nn_action(action_points_dmean)
-            anchor_embedding = self.emb_nn_anchor(anchor_points_dmean)
+            anchor_embedding = self.embed_anchor(anchor_points_dmean)
 
         # tilde_phi, phi are both B,512,N
-        if self.return_attn:
+        if fused:
+            action_out, anchor_out = twin_transformer(
+                action_embedding, anchor_embedding
+            )
+            if self.return_attn:
+                action_embedding_tf, action_attn = action_out
+                anchor_embedding_tf, anchor_attn = anchor_out
+            else:
+                action_embedding_tf, anchor_embedding_tf = action_out, anchor_out
+                action_attn = None
+                anchor_attn = None
+        elif self.return_attn:
             action_embedding_tf, action_attn = self.transformer_action(
                 action_embedding, anchor_embedding
             )
@@ -385,7 +541,8 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
             ).permute(0, 2, 1)
 
         if self.cycle:
-            anchor_attn = anchor_attn.mean(dim=1)
+            if anchor_attn is not None:
+                anchor_attn = anchor_attn.mean(dim=1)
             if self.return_flow_component:
                 flow_output_anchor = self.head_anchor(
                     anchor_embedding_tf,
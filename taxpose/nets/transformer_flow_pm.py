@@ -15,6 +15,7 @@ from third_party.dcp.model import (
     EncoderLayer,
     MultiHeadedAttention,
     PositionwiseFeedForward,
+    build_knn_idx,
 )
 
 
@@ -34,6 +35,7 @@ class CustomTransformer(nn.Module):
         n_heads=4,
         return_attn=False,
         bidirectional=True,
+        memory_efficient_attn=False,
     ):
         super(CustomTransformer, self).__init__()
         self.emb_dims = emb_dims
@@ -56,18 +58,33 @@ class CustomTransformer(nn.Module):
             nn.Sequential(),
             nn.Sequential(),
         )
-
-    def forward(self, *input):
+        self.memory_efficient_attn = memory_efficient_attn
+        if self.memory_efficient_attn:
+            # Use fused/tiled attention everywhere, and only keep the head-averaged
+            # (B, 1, N, M) cross-attention of the last decoder layer if it is returned.
+            for module in self.model.modules():
+                if isinstance(module, MultiHeadedAttention):
+                    module.memory_efficient = True
+                    module.need_attn = False
+            self.model.decoder.layers[-1].src_attn.need_attn = self.return_attn
+
+    def forward(self, *input, src_mask=None, tgt_mask=None):
+        """src_mask (B, N) and tgt_mask (B, M) mark the real points of padded
+        clouds; padded points are masked out as attention keys."""
         src = input[0]
         tgt = input[1]
         src = src.transpose(2, 1).contiguous()
         tgt = tgt.transpose(2, 1).contiguous()
-        src_embedding = self.model(tgt, src, None, None).transpose(2, 1).contiguous()
+        src_mask = None if src_mask is None else src_mask.unsqueeze(1)
+        tgt_mask = None if tgt_mask is None else tgt_mask.unsqueeze(1)
+        src_embedding = (
+            self.model(tgt, src, tgt_mask, src_mask).transpose(2, 1).contiguous()
+        )
         src_attn = self.model.decoder.layers[-1].src_attn.attn
 
         if self.bidirectional:
             tgt_embedding = (
-                self.model(src, tgt, None, None).transpose(2, 1).contiguous()
+                self.model(src, tgt, src_mask, tgt_mask).transpose(2, 1).contiguous()
             )
             tgt_attn = self.model.decoder.layers[-1].src_attn.attn
 
@@ -80,6 +97,17 @@ class CustomTransformer(nn.Module):
         return src_embedding
 
 
+def masked_mean(points, mask=None):
+    """Mean over the points (last dim) of (B, C, N) clouds, counting only the
+    points where the (B, N) mask is True."""
+    if mask is None:
+        return points.mean(dim=2, keepdim=True)
+    weights = mask.unsqueeze(1).to(points.dtype)
+    return (points * weights).sum(dim=2, keepdim=True) / weights.sum(
+        dim=2, keepdim=True
+    )
+
+
 class ResidualMLPHead(nn.Module):
     """
     Base ResidualMLPHead with flow calculated as
@@ -109,7 +137,13 @@ class ResidualMLPHead(nn.Module):
                 nn.Conv1d(512, 1, kernel_size=1, bias=False),
             )
 
-    def forward(self, *input, scores=None, return_flow_component=False):
+    @staticmethod
+    def _project(proj, x, mask):
+        # proj is PointNet then a 1x1 conv; only the PointNet has batch norm.
+        pointnet, conv = proj
+        return conv(pointnet(x, mask))
+
+    def forward(self, *input, scores=None, return_flow_component=False, mask=None):
         action_embedding = input[0]
         anchor_embedding = input[1]
         action_points = input[2]
@@ -135,7 +169,7 @@ class ResidualMLPHead(nn.Module):
         corr_flow = corr_points - action_points
 
         embedding = action_embedding  # B,512,N
-        residual_flow = self.proj_flow(embedding)  # B,3,N
+        residual_flow = self._project(self.proj_flow, embedding, mask)  # B,3,N
 
         # # Added for debug purpose
         # if return_flow_component:
@@ -146,7 +180,7 @@ class ResidualMLPHead(nn.Module):
         flow = residual_flow + corr_flow
         if self.pred_weight:
             # print("ResidualMLPHead: PRODUCING SVD WEIGHTS!!!!")
-            weight = self.proj_flow_weight(action_embedding)
+            weight = self._project(self.proj_flow_weight, action_embedding, mask)
             corr_flow_weight = torch.concat([flow, weight], dim=1)
         else:
             corr_flow_weight = flow
@@ -198,28 +232,48 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
             emb_dims=emb_dims, pred_weight=self.pred_weight
         )
 
-    def forward(self, *input):
+    @staticmethod
+    def _embed(emb_nn, points, cat, mask):
+        if mask is None or not isinstance(emb_nn, DGCNN_GC):
+            return emb_nn(points, cat)
+        # Build the kNN graph and the batch norm statistics without the padding.
+        return emb_nn(points, cat, idx=build_knn_idx(points, mask=mask), mask=mask)
+
+    def forward(self, *input, action_mask=None, anchor_mask=None):
+        """action_mask (B, N) and anchor_mask (B, M) mark the real points when the
+        clouds are zero-padded to a common size; flows of padded points are
+        meaningless."""
         action_points = input[0].permute(0, 2, 1)  # B,3,num_points
         anchor_points = input[1].permute(0, 2, 1)
         if len(input) == 3:
             cat = input[2]
         else:
             cat = None
-        action_points_dmean = action_points - action_points.mean(dim=2, keepdim=True)
-        anchor_points_dmean = anchor_points - anchor_points.mean(dim=2, keepdim=True)
+        action_points_dmean = action_points - masked_mean(action_points, action_mask)
+        anchor_points_dmean = anchor_points - masked_mean(anchor_points, anchor_mask)
         # mean center point cloud before DGCNN
         if not self.center_feature:
             action_points_dmean = action_points
             anchor_points_dmean = anchor_points
-        action_embedding = self.emb_nn_action(action_points_dmean, cat)
-        anchor_embedding = self.emb_nn_anchor(anchor_points_dmean, cat)
+        action_embedding = self._embed(
+            self.emb_nn_action, action_points_dmean, cat, action_mask
+        )
+        anchor_embedding = self._embed(
+            self.emb_nn_anchor, anchor_points_dmean, cat, anchor_mask
+        )
 
         # tilde_phi, phi are both B,512,N
         action_embedding_tf, action_attn = self.transformer_action(
-            action_embedding, anchor_embedding
+            action_embedding,
+            anchor_embedding,
+            src_mask=action_mask,
+            tgt_mask=anchor_mask,
         )
         anchor_embedding_tf, anchor_attn = self.transformer_anchor(
-            anchor_embedding, action_embedding
+            anchor_embedding,
+            action_embedding,
+            src_mask=anchor_mask,
+            tgt_mask=action_mask,
         )
 
         action_embedding_tf = action_embedding + action_embedding_tf
@@ -233,6 +287,7 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
                 action_points,
                 anchor_points,
                 scores=action_attn,
+                mask=action_mask,
                 return_flow_component=self.return_flow_component,
             )
             flow_action = flow_output_action["full_flow"].permute(0, 2, 1)
@@ -245,6 +300,7 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
                 action_points,
                 anchor_points,
                 scores=action_attn,
+                mask=action_mask,
                 return_flow_component=self.return_flow_component,
             ).permute(0, 2, 1)
 
@@ -257,6 +313,7 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
                     anchor_points,
                     action_points,
                     scores=anchor_attn,
+                    mask=anchor_mask,
                     return_flow_component=self.return_flow_component,
                 )
                 flow_anchor = flow_output_anchor["full_flow"].permute(0, 2, 1)
@@ -271,6 +328,7 @@ class ResidualFlow_DiffEmbTransformer(nn.Module):
                     anchor_points,
                     action_points,
                     scores=anchor_attn,
+                    mask=anchor_mask,
                     return_flow_component=self.return_flow_component,
                 ).permute(0, 2, 1)
             if self.return_flow_component:
@@ -312,8 +370,8 @@ class BrianChuerAdapter(nn.Module):
         self.weight_normalize = "l1"
         self.softmax_temperature = None
 
-    def forward(self, X, Y, cat=None):
-        Fx, Fy = self.model(X, Y, cat)
+    def forward(self, X, Y, cat=None, mask_x=None, mask_y=None):
+        Fx, Fy = self.model(X, Y, cat, action_mask=mask_x, anchor_mask=mask_y)
 
         Fx, pred_w_action = extract_flow_and_weight(Fx, True)
         Fy, pred_w_anchor = extract_flow_and_weight(Fy, True)
@@ -328,6 +386,8 @@ class BrianChuerAdapter(nn.Module):
             return_transform3d=True,
             normalization_scehme=self.weight_normalize,
             temperature=self.softmax_temperature,
+            mask_src=mask_x,
+            mask_tgt=mask_y,
         )
 
         # It's weirdly structured...
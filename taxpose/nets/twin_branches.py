@@ -0,0 +1,229 @@
+"""Fused execution of the twin action/anchor branches of ResidualFlow_DiffEmbTransformer.
+
+The action and anchor branches have the same architecture with separate
+weights. For clouds with the same number of points, `TwinDGCNN` runs both
+DGCNNs as one grouped convolution and `TwinTransformer` runs both
+cross-attention directions with stacked weights, so every layer is one kernel
+launch instead of two. The fused modules hold copies of the weights and are
+meant for inference; see `ResidualFlow_DiffEmbTransformer.fuse_twin_branches`.
+"""
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from third_party.dcp.model import (
+    attention,
+    build_knn_idx,
+    get_graph_feature,
+    memory_efficient_attention,
+)
+
+
+def _grouped_conv(convs):
+    conv = nn.Conv2d(
+        sum(c.in_channels for c in convs),
+        sum(c.out_channels for c in convs),
+        kernel_size=1,
+        groups=len(convs),
+        bias=False,
+    )
+    conv.weight.data.copy_(torch.cat([c.weight.data for c in convs]))
+    return conv
+
+
+def _stacked_batch_norm(bns):
+    # Layers wrapped by `per_sample_batch_norm` are stacked and wrapped again.
+    inner = [getattr(b, "bn", b) for b in bns]
+    bn = nn.BatchNorm2d(sum(b.num_features for b in inner), eps=inner[0].eps)
+    bn.momentum = inner[0].momentum
+    for name in ["weight", "bias", "running_mean", "running_var"]:
+        getattr(bn, name).data.copy_(torch.cat([getattr(b, name).data for b in inner]))
+    bn.num_batches_tracked.copy_(inner[0].num_batches_tracked)
+    return bn if inner[0] is bns[0] else type(bns[0])(bn)
+
+
+class TwinDGCNN(nn.Module):
+    """Two DGCNNs with separate weights, run as one grouped DGCNN."""
+
+    def __init__(self, dgcnn_a, dgcnn_b):
+        super().__init__()
+        self.knn_chunk_size = dgcnn_a.knn_chunk_size
+        for i in range(1, 6):
+            name = f"conv{i}"
+            setattr(
+                self,
+                name,
+                _grouped_conv([getattr(dgcnn_a, name), getattr(dgcnn_b, name)]),
+            )
+            name = f"bn{i}"
+            setattr(
+                self,
+                name,
+                _stacked_batch_norm([getattr(dgcnn_a, name), getattr(dgcnn_b, name)]),
+            )
+
+    def forward(self, x_a, x_b):
+        """x_a, x_b: (B, 3, N). Returns both (B, emb_dims, N) embeddings."""
+        B, _, N = x_a.shape
+        x = torch.cat([x_a, x_b])
+        idx = build_knn_idx(x, chunk_size=self.knn_chunk_size)
+        x = get_graph_feature(x, idx=idx)  # 2B, 6, N, k
+        x = x.view(2, B, *x.shape[1:]).transpose(0, 1).reshape(B, -1, N, x.shape[-1])
+
+        features = []
+        for i in range(1, 5):
+            conv, bn = getattr(self, f"conv{i}"), getattr(self, f"bn{i}")
+            x = F.relu(bn(conv(x)))
+            features.append(x.max(dim=-1, keepdim=True)[0].view(B, 2, -1, N, 1))
+        # conv5 expects [x1, x2, x3, x4] per branch.
+        x = torch.cat(features, dim=2).view(B, -1, N, 1)
+        x = F.relu(self.bn5(self.conv5(x))).view(B, 2, -1, N)
+        return x[:, 0], x[:, 1]
+
+
+class _StackedLinear(nn.Module):
+    def __init__(self, linears):
+        super().__init__()
+        self.weight = nn.Parameter(torch.stack([l.weight.data.t() for l in linears]))
+        self.bias = nn.Parameter(
+            torch.stack([l.bias.data for l in linears]).unsqueeze(1)
+        )
+
+    def forward(self, x):
+        # x: (G, T, in) -> (G, T, out)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class _StackedLayerNorm(nn.Module):
+    def __init__(self, norms):
+        super().__init__()
+        # (G, 1, 1, C), to broadcast over (G, B, T, C).
+        self.a_2 = nn.Parameter(torch.stack([n.a_2.data for n in norms])[:, None, None])
+        self.b_2 = nn.Parameter(torch.stack([n.b_2.data for n in norms])[:, None, None])
+        self.eps = norms[0].eps
+
+    def forward(self, x):
+        mean = x.mean(-1, keepdim=True)
+        std = x.std(-1, keepdim=True)
+        return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+
+
+class _StackedAttention(nn.Module):
+    def __init__(self, attns):
+        super().__init__()
+        self.h = attns[0].h
+        self.d_k = attns[0].d_k
+        self.memory_efficient = attns[0].memory_efficient
+        self.need_attn = attns[0].need_attn
+        self.linears = nn.ModuleList(
+            [_StackedLinear([a.linears[i] for a in attns]) for i in range(4)]
+        )
+
+    def forward(self, query, key, value):
+        """query: (G, B, N, C), key/value: (G, B, M, C). Returns (G, B, N, C) and
+        the attention, as MultiHeadedAttention would store it, with G folded into B."""
+        G, B = query.shape[:2]
+
+        def heads(linear, x):
+            x = linear(x.reshape(G, -1, x.shape[-1]))
+            return x.view(G * B, -1, self.h, self.d_k).transpose(1, 2)
+
+        q, k, v = [heads(l, x) for l, x in zip(self.linears, (query, key, value))]
+        if self.memory_efficient:
+            x, attn = memory_efficient_attention(q, k, v, need_attn=self.need_attn)
+        else:
+            x, attn = attention(q, k, v)
+        x = x.transpose(1, 2).reshape(G, -1, self.h * self.d_k)
+        return self.linears[-1](x).view(G, B, -1, self.h * self.d_k), attn
+
+
+class _StackedFeedForward(nn.Module):
+    def __init__(self, ffs):
+        super().__init__()
+        self.w_1 = _StackedLinear([f.w_1 for f in ffs])
+        self.w_2 = _StackedLinear([f.w_2 for f in ffs])
+
+    def forward(self, x):
+        G, B = x.shape[:2]
+        x = self.w_2(F.relu(self.w_1(x.reshape(G, -1, x.shape[-1]))))
+        return x.view(G, B, -1, x.shape[-1])
+
+
+class TwinTransformer(nn.Module):
+    """Two CustomTransformers (bidirectional=False) with separate weights, run
+    on stacked inputs with stacked weights."""
+
+    def __init__(self, transformer_a, transformer_b):
+        super().__init__()
+        models = [transformer_a.model, transformer_b.model]
+        self.return_attn = transformer_a.return_attn
+        self.encoder_layers = nn.ModuleList()
+        for layers in zip(*[m.encoder.layers for m in models]):
+            self.encoder_layers.append(
+                nn.ModuleDict(
+                    {
+                        "norm0": _StackedLayerNorm(
+                            [l.sublayer[0].norm for l in layers]
+                        ),
+                        "self_attn": _StackedAttention([l.self_attn for l in layers]),
+                        "norm1": _StackedLayerNorm(
+                            [l.sublayer[1].norm for l in layers]
+                        ),
+                        "ff": _StackedFeedForward([l.feed_forward for l in layers]),
+                    }
+                )
+            )
+        self.encoder_norm = _StackedLayerNorm([m.encoder.norm for m in models])
+        self.decoder_layers = nn.ModuleList()
+        for layers in zip(*[m.decoder.layers for m in models]):
+            self.decoder_layers.append(
+                nn.ModuleDict(
+                    {
+                        "norm0": _StackedLayerNorm(
+                            [l.sublayer[0].norm for l in layers]
+                        ),
+                        "self_attn": _StackedAttention([l.self_attn for l in layers]),
+                        "norm1": _StackedLayerNorm(
+                            [l.sublayer[1].norm for l in layers]
+                        ),
+                        "src_attn": _StackedAttention([l.src_attn for l in layers]),
+                        "norm2": _StackedLayerNorm(
+                            [l.sublayer[2].norm for l in layers]
+                        ),
+                        "ff": _StackedFeedForward([l.feed_forward for l in layers]),
+                    }
+                )
+            )
+        self.decoder_norm = _StackedLayerNorm([m.decoder.norm for m in models])
+
+    def forward(self, src_a, src_b):
+        """transformer_a(src_a, src_b) and transformer_b(src_b, src_a) in one pass.
+
+        src_a, src_b: (B, C, N) embeddings with the same N. Returns the two
+        outputs as CustomTransformer does, each with its attention if
+        return_attn is set.
+        """
+        B = src_a.shape[0]
+        # Decoder runs over each branch's own cloud, the encoder over the other.
+        tgt = torch.stack([src_a, src_b]).transpose(2, 3)  # 2, B, N, C
+        memory = tgt.flip(0)
+
+        for layer in self.encoder_layers:
+            y = layer["norm0"](memory)
+            memory = memory + layer["self_attn"](y, y, y)[0]
+            memory = memory + layer["ff"](layer["norm1"](memory))
+        memory = self.encoder_norm(memory)
+
+        x = tgt
+        for layer in self.decoder_layers:
+            y = layer["norm0"](x)
+            x = x + layer["self_attn"](y, y, y)[0]
+            out, attn = layer["src_attn"](layer["norm1"](x), memory, memory)
+            x = x + out
+            x = x + layer["ff"](layer["norm2"](x))
+        x = self.decoder_norm(x).transpose(2, 3)  # 2, B, C, N
+
+        if not self.return_attn:
+            return x[0], x[1]
+        attn = attn.view(2, B, *attn.shape[1:])
+        return (x[0], attn[0]), (x[1], attn[1])
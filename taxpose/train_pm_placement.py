@@ -21,6 +21,7 @@ from taxpose.datasets.pm_placement import (
 )
 from taxpose.models.taxpose import BrianChuerLoss, SE3LossTheirs
 from taxpose.models.taxpose import TAXPoseModel as Model
+from taxpose.models.taxpose import pad_packed
 
 app = typer.Typer()
 
@@ -160,6 +161,8 @@ def train(
     embedding_dim: int = 512,
     n_workers: int = 30,
     n_proc_per_worker: int = 2,
+    sharded: bool = False,
+    packed: bool = False,
 ):
     torch.autograd.set_detect_anomaly(True)
 
@@ -178,6 +181,8 @@ def train(
         n_repeat=n_repeat,
         n_workers=n_workers,
         n_proc_per_worker=n_proc_per_worker,
+        sharded=sharded,
+        packed=packed,
         seed=123456,
     )
 
@@ -194,6 +199,8 @@ def train(
         n_repeat=1,
         n_workers=n_workers,
         n_proc_per_worker=n_proc_per_worker,
+        sharded=sharded,
+        packed=packed,
         seed=123456,
     )
     eval_test_dset = create_goal_inference_dataset(
@@ -208,6 +215,8 @@ def train(
         n_repeat=1,
         n_workers=n_workers,
         n_proc_per_worker=n_proc_per_worker,
+        sharded=sharded,
+        packed=packed,
         seed=654321,
     )
 
@@ -268,12 +277,8 @@ def train(
             )
 
             if use_bc_loss:
-                loss = crit(
-                    action.pos.reshape(len(action), -1, 3),
-                    pred_T_action,
-                    gt_T_action,
-                    Fx,
-                )
+                action_pos, action_mask = pad_packed(action.pos, action.ptr)
+                loss = crit(action_pos, pred_T_action, gt_T_action, Fx, action_mask)
             else:
                 loss, R_loss, t_loss = crit(R_pred, R_gt, t_pred, t_gt)
 
@@ -304,6 +309,7 @@ def evaluate(
     embedding_dim: int = 512,
     n_repeat: int = 50,
     results_dir: str = "results",
+    packed: bool = False,
 ):
     device = "cuda:0"
 
@@ -328,6 +334,7 @@ def evaluate(
         n_repeat=n_repeat,
         n_workers=30,
         n_proc_per_worker=2,
+        packed=packed,
         seed=123456 if split == "train" else 654321,
     )
 
@@ -7,6 +7,7 @@ from torchvision.transforms import ToTensor
 
 from taxpose.training.point_cloud_training_module import PointCloudTrainingModule
 from taxpose.utils.display_headless import quiver3d, scatter3d  # type: ignore
+from taxpose.utils.precision import full_precision
 from taxpose.utils.se3 import flow2pose, get_degree_angle, get_translation
 
 mse_criterion = nn.MSELoss(reduction="sum")
@@ -62,6 +63,7 @@ class EquivarianceTrainingModule(PointCloudTrainingModule):
         mean = torch.mean(t_norm).item()
         return max, min, mean
 
+    @full_precision
     def cal_loss(self, x_action, x_anchor, batch, log_values={}, loss_prefix=""):
         points_action = batch["points_action"]
         points_anchor = batch["points_anchor"]
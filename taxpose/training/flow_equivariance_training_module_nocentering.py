@@ -6,6 +6,7 @@ from torchvision.transforms import ToTensor
 
 from taxpose.training.point_cloud_training_module import PointCloudTrainingModule
 from taxpose.utils.color_utils import get_color
+from taxpose.utils.precision import full_precision
 from taxpose.utils.se3 import (
     dense_flow_loss,
     dualflow2pose,
@@ -59,6 +60,7 @@ class EquivarianceTrainingModule(PointCloudTrainingModule):
         if self.weight_normalize == "l1":
             assert self.sigmoid_on, "l1 weight normalization need sigmoid on"
 
+    @full_precision
     def compute_loss(self, x_action, x_anchor, batch, log_values={}, loss_prefix=""):
         points_action = batch["points_action"][:, :, :3]  # action point clouds
         points_anchor = batch["points_anchor"][:, :, :3]  # anchor point clouds
@@ -1,21 +1,32 @@
+import numpy as np
 import torch
 import wandb
-from pytorch3d.transforms import Transform3d
+from pytorch3d.transforms import Transform3d, Translate
 from torch import nn
 from torchvision.transforms import ToTensor
 
 from taxpose.training.point_cloud_training_module import PointCloudTrainingModule
 from taxpose.utils.color_utils import get_color
+from taxpose.utils.precision import autocast, full_precision
 from taxpose.utils.se3 import (
     dualflow2pose,
+    fuse_hypotheses,
     get_degree_angle,
     get_translation,
-    pure_translation_se3,
+    rotation_angle,
 )
 
 mse_criterion = nn.MSELoss(reduction="sum")
 to_tensor = ToTensor()
 
+# Per-point outputs of predict, kept from each sample's last refinement pass.
+PER_POINT_KEYS = [
+    "pred_flow_action",
+    "pred_w_action",
+    "pred_flow_anchor",
+    "pred_w_anchor",
+]
+
 
 class EquivarianceTestingModule(PointCloudTrainingModule):
     def __init__(
@@ -33,6 +44,9 @@ class EquivarianceTestingModule(PointCloudTrainingModule):
         weight_normalize="l1",
         softmax_temperature=1,
         loop=3,
+        refine_rot_tol=None,
+        refine_trans_tol=None,
+        precision=32,
     ):
         super().__init__(
             model=model,
@@ -54,14 +68,21 @@ class EquivarianceTestingModule(PointCloudTrainingModule):
         self.point_loss_type = point_loss_type
         self.return_flow_component = return_flow_component
         self.loop = loop
+        # A sample stops refining once an update rotates by less than
+        # refine_rot_tol degrees and translates by less than refine_trans_tol.
+        self.refine_rot_tol = refine_rot_tol
+        self.refine_trans_tol = refine_trans_tol
         self.softmax_temperature = softmax_temperature
+        # Autocast precision of the network (32, 16 or "bf16"); the pose is
+        # always solved in fp32.
+        self.precision = precision
 
     def action_centered(self, points_action, points_anchor):
         """
-        @param points_action, (1,num_points,3)
-        @param points_anchor, (1,num_points,3)
+        @param points_action, (B,num_points,3)
+        @param points_anchor, (B,num_points,3)
         """
-        points_action_mean = points_action.clone().mean(axis=1)
+        points_action_mean = points_action.clone().mean(axis=1, keepdim=True)
         points_action_mean_centered = points_action - points_action_mean
         points_anchor_mean_centered = points_anchor - points_action_mean
 
@@ -71,16 +92,40 @@ class EquivarianceTestingModule(PointCloudTrainingModule):
             points_action_mean,
         )
 
+    @torch.no_grad()
     def get_transform(self, points_trans_action, points_trans_anchor):
+        """Pose of the action cloud, refined over up to self.loop forward passes.
+
+        After each pass the action cloud is moved by the predicted transform and
+        both clouds are re-centered on it; the update is mapped back through the
+        accumulated centering and composed per sample. Samples whose update falls
+        under the refine tolerances are dropped from later passes.
+        """
+        B = points_trans_action.shape[0]
+        device = points_trans_action.device
+        points_trans_action_init = points_trans_action[:, :, :3]
+        pred_T = torch.eye(4, device=device).repeat(B, 1, 1)
+        # Current frame = original frame - offset.
+        offset = torch.zeros(B, 3, device=device)
+        refine_steps = torch.zeros(B, dtype=torch.long, device=device)
+        active = torch.arange(B, device=device)
+        early_exit = (
+            self.refine_rot_tol is not None and self.refine_trans_tol is not None
+        )
+
+        outputs = {}
         for i in range(self.loop):
-            if self.model.return_flow_component:
-                res = self.model(points_trans_action, points_trans_anchor)
-                x_action = res["flow_action"]
-                x_anchor = res["flow_anchor"]
-            else:
-                x_action, x_anchor = self.model(
-                    points_trans_action, points_trans_anchor
-                )
+            with autocast(device.type, self.precision):
+                if self.model.return_flow_component:
+                    res = self.model(points_trans_action, points_trans_anchor)
+                    res = {k: v.float() for k, v in res.items()}
+                    x_action = res["flow_action"]
+                    x_anchor = res["flow_anchor"]
+                else:
+                    x_action, x_anchor = self.model(
+                        points_trans_action, points_trans_anchor
+                    )
+            x_action, x_anchor = x_action.float(), x_anchor.float()
 
             points_trans_action = points_trans_action[:, :, :3]
             points_trans_anchor = points_trans_anchor[:, :, :3]
@@ -90,28 +135,75 @@ class EquivarianceTestingModule(PointCloudTrainingModule):
                 points_trans_action=points_trans_action,
                 points_trans_anchor=points_trans_anchor,
             )
-            if i == 0:
-                pred_T_action = ans_dict["pred_T_action"]
-            else:
-                pred_T_action = pred_T_action.compose(
-                    T_trans.inverse()
-                    .compose(ans_dict["pred_T_action"])
-                    .compose(T_trans)
-                )
-                ans_dict["pred_T_action"] = pred_T_action
+            step = ans_dict["pred_T_action"].get_matrix()
+            pred_T[active] = (
+                pred_T[active]
+                @ Translate(-offset[active], device=device).get_matrix()
+                @ step
+                @ Translate(offset[active], device=device).get_matrix()
+            )
+            refine_steps[active] += 1
+
+            per_sample = {k: ans_dict[k] for k in PER_POINT_KEYS}
+            if self.model.return_flow_component:
+                per_sample.update({f"flow_components/{k}": v for k, v in res.items()})
+            for k, v in per_sample.items():
+                if v is None:
+                    continue
+                if k not in outputs:
+                    outputs[k] = torch.zeros(
+                        (B,) + v.shape[1:], dtype=v.dtype, device=device
+                    )
+                outputs[k][active] = v
+            if i == self.loop - 1:
+                break
+
             pred_points_action = ans_dict["pred_points_action"]
+            if early_exit:
+                step_angle = rotation_angle(step[:, :3, :3]) * 180 / np.pi
+                step_trans = step[:, 3, :3].norm(dim=-1)
+                moving = (step_angle >= self.refine_rot_tol) | (
+                    step_trans >= self.refine_trans_tol
+                )
+                active = active[moving]
+                if len(active) == 0:
+                    break
+                pred_points_action = pred_points_action[moving]
+                points_trans_anchor = points_trans_anchor[moving]
             (
                 points_trans_action,
                 points_trans_anchor,
                 points_action_mean,
             ) = self.action_centered(pred_points_action, points_trans_anchor)
-            T_trans = pure_translation_se3(
-                1, points_action_mean.squeeze(), device=points_trans_action.device
-            )
-            if self.model.return_flow_component:
-                ans_dict["flow_components"] = res
+            offset[active] += points_action_mean.squeeze(1)
+
+        pred_T_action = Transform3d(matrix=pred_T)
+        ans_dict = {
+            "pred_T_action": pred_T_action,
+            "pred_points_action": pred_T_action.transform_points(
+                points_trans_action_init
+            ),
+            "refine_steps": refine_steps,
+        }
+        for k, v in outputs.items():
+            if k.startswith("flow_components/"):
+                ans_dict.setdefault("flow_components", {})[k.split("/", 1)[1]] = v
+            else:
+                ans_dict[k] = v
         return ans_dict
 
+    @torch.no_grad()
+    def get_consensus_transform(
+        self, points_trans_action, points_trans_anchor, mode="medoid"
+    ):
+        """One pose from K subsampled/perturbed versions of the same scene.
+
+        The K versions are refined as one batch and the resulting poses are fused
+        with `fuse_hypotheses`.
+        """
+        ans_dict = self.get_transform(points_trans_action, points_trans_anchor)
+        return fuse_hypotheses(ans_dict, points_trans_action[0, :, :3], mode=mode)
+
     def predict(self, x_action, x_anchor, points_trans_action, points_trans_anchor):
         pred_flow_action, pred_w_action = self.extract_flow_and_weight(x_action)
         pred_flow_anchor, pred_w_anchor = self.extract_flow_and_weight(x_anchor)
@@ -132,8 +224,13 @@ class EquivarianceTestingModule(PointCloudTrainingModule):
         return {
             "pred_T_action": pred_T_action,
             "pred_points_action": pred_points_action,
+            "pred_flow_action": pred_flow_action,
+            "pred_w_action": pred_w_action,
+            "pred_flow_anchor": pred_flow_anchor,
+            "pred_w_anchor": pred_w_anchor,
         }
 
+    @full_precision
     def compute_loss(
         self,
         x_action,
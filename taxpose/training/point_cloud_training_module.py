@@ -28,7 +28,8 @@ class PointCloudTrainingModule(pl.LightningModule):
             self.log(key, val)
 
         if (self.global_step % self.image_log_period) == 0:
-            results_images = self.visualize_results(batch, batch_idx)
+            with torch.autocast(self.device.type, enabled=False):
+                results_images = self.visualize_results(batch, batch_idx)
 
             for key, val in results_images.items():
                 if isinstance(val, wandb.Object3D):
@@ -53,7 +54,8 @@ class PointCloudTrainingModule(pl.LightningModule):
             self.log("val_" + key, val)
 
         if (self.global_val_step % self.image_log_period) == 0:
-            results_images = self.visualize_results(batch, batch_idx)
+            with torch.autocast(self.device.type, enabled=False):
+                results_images = self.visualize_results(batch, batch_idx)
 
             for key, val in results_images.items():
                 if isinstance(val, wandb.Object3D):
@@ -80,7 +82,8 @@ class PointCloudTrainingModule(pl.LightningModule):
             self.log(key, val)
 
         if (self.global_step % self.image_log_period) == 0:
-            results_images = self.visualize_results(batch, batch_idx)
+            with torch.autocast(self.device.type, enabled=False):
+                results_images = self.visualize_results(batch, batch_idx)
 
             for key, val in results_images.items():
                 if isinstance(val, wandb.Object3D):
@@ -0,0 +1,55 @@
+import multiprocessing as mp
+import resource
+import time
+
+import torch
+
+
+def time_fn(fn, n_iters=10, device="cpu"):
+    """Mean wall-clock latency of fn() in milliseconds, after one warmup call."""
+    device = torch.device(device)
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / n_iters * 1000.0
+
+
+def _cpu_worker(make_fn, args, n_iters, queue):
+    fn = make_fn(*args)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latency_ms = time_fn(fn, n_iters, "cpu")
+    peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024.0
+    queue.put((latency_ms, peak_mb))
+
+
+def measure_latency_and_memory(make_fn, args, device, n_iters=10):
+    """Latency (ms) and peak memory (MB) of the callable returned by make_fn(*args).
+
+    Setup done in make_fn (inputs, models) is excluded from the memory figure. On
+    CUDA, peak memory comes from the caching allocator. On CPU there is no allocator
+    counter, so the measurement runs in a fresh process and reports the growth of
+    its max RSS; make_fn and args must be picklable (e.g. a module-level function).
+    """
+    device = torch.device(device)
+    if device.type == "cpu":
+        ctx = mp.get_context("spawn")
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_cpu_worker, args=(make_fn, args, n_iters, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        return result
+
+    fn = make_fn(*args)
+    torch.cuda.synchronize(device)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    latency_ms = time_fn(fn, n_iters, device)
+    peak_mb = (torch.cuda.max_memory_allocated(device) - base) / 2**20
+    return latency_ms, peak_mb
@@ -133,3 +133,34 @@ class SaverCallbackRefinement(Callback):
             if self.prev_path is not None:
                 self.prev_path.unlink()
                 self.prev_path = pathlib.Path(ckpt_path_embnn)
+
+
+class PrecisionMonitor(Callback):
+    """
+    Log the AMP loss scale and count non-finite losses and skipped optimizer steps
+    when training in mixed precision. fp16 training skips a step whenever the
+    unscaled gradients are not finite, which shows up as a drop in the loss scale.
+    """
+
+    def __init__(self):
+        self.prev_scale = None
+        self.nonfinite_losses = 0
+        self.skipped_steps = 0
+
+    def on_train_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=None
+    ):
+        loss = outputs["loss"] if isinstance(outputs, dict) else outputs
+        if loss is not None and not torch.isfinite(loss).all():
+            self.nonfinite_losses += 1
+        pl_module.log("precision/nonfinite_losses", float(self.nonfinite_losses))
+
+        scaler = getattr(trainer.precision_plugin, "scaler", None)
+        if scaler is None or not scaler.is_enabled():
+            return
+        scale = scaler.get_scale()
+        if self.prev_scale is not None and scale < self.prev_scale:
+            self.skipped_steps += 1
+        self.prev_scale = scale
+        pl_module.log("precision/loss_scale", scale)
+        pl_module.log("precision/skipped_steps", float(self.skipped_steps))
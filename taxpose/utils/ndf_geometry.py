@@ -168,3 +168,36 @@ def depth_from_world(world_coords, cam2world):
     points_cam = torch.inverse(cam2world).bmm(points_hom)  # (batch, 4, num_samples)
     depth = points_cam[:, 2, :][:, :, None]  # (batch, num_samples, 1)
     return depth
+
+
+def pixel_ray_table(intrinsics, height, width):
+    """Camera-frame point at unit depth for every pixel, in row-major order.
+
+    :param intrinsics: Shape (1, 3, 4)
+    :return: Shape (height * width, 3), such that lift(x, y, z) for pixel (x, y)
+        is table[y * width + x] * z.
+    """
+    y, x = torch.meshgrid(torch.arange(height), torch.arange(width), indexing="ij")
+    return lift(x.flatten(), y.flatten(), torch.ones(height * width), intrinsics).to(
+        intrinsics.dtype
+    )
+
+
+def lift_views(pixel_idxs, depths, ray_table, transforms):
+    """Lifts the pixels of several views and moves each view's points by its transform.
+
+    :param pixel_idxs: List of (num_points_i,) flattened pixel indices, one per view
+    :param depths: List of (num_points_i,) depths
+    :param ray_table: Shape (height * width, 3), from pixel_ray_table
+    :param transforms: Shape (num_views, 4, 4)
+    :return: Shape (sum_i num_points_i, 3), the views concatenated in order.
+    """
+    counts = torch.tensor([len(idx) for idx in pixel_idxs])
+    pixel_idx = torch.cat([torch.as_tensor(idx) for idx in pixel_idxs]).long()
+    depth = torch.cat([torch.as_tensor(d) for d in depths]).to(ray_table.dtype)
+    points = ray_table[pixel_idx] * depth[:, None]
+
+    view = torch.repeat_interleave(torch.arange(len(pixel_idxs)), counts)
+    transforms = transforms.to(ray_table.dtype)[view]
+    rotated = torch.bmm(transforms[:, :3, :3], points[:, :, None])[..., 0]
+    return rotated + transforms[:, :3, 3]
@@ -101,3 +101,42 @@ def get_object_clouds_from_demo_npz(grasp_data, ids=[mug_id, rack_id, gripper_id
     cloud_classes = np.concatenate(cloud_classes, axis=0)
 
     return cloud_points, cloud_colors, cloud_classes
+
+
+def settle_bodies(
+    pb_client,
+    body_ids,
+    max_time=2.0,
+    lin_vel_thresh=1e-3,
+    ang_vel_thresh=1e-2,
+    rest_steps=10,
+):
+    """Step the simulation until the bodies come to rest, instead of sleeping.
+
+    The simulation is stepped by hand (step_sim mode) until every body has been
+    below the velocity thresholds for `rest_steps` consecutive steps, or until
+    `max_time` seconds of simulated time have passed. Real-time stepping is
+    switched back on afterwards.
+
+    Returns: the number of simulation steps taken.
+    """
+    time_step = pb_client.getPhysicsEngineParameters()["fixedTimeStep"]
+    max_steps = int(round(max_time / time_step))
+
+    pb_client.set_step_sim(True)
+    at_rest = 0
+    steps = 0
+    while steps < max_steps and at_rest < rest_steps:
+        pb_client.stepSimulation()
+        steps += 1
+        velocities = [pb_client.getBaseVelocity(body_id) for body_id in body_ids]
+        if all(
+            np.linalg.norm(lin) < lin_vel_thresh
+            and np.linalg.norm(ang) < ang_vel_thresh
+            for lin, ang in velocities
+        ):
+            at_rest += 1
+        else:
+            at_rest = 0
+    pb_client.set_step_sim(False)
+    return steps
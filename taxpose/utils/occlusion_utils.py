@@ -27,3 +27,61 @@ def plane_occlusion(points, stand_off=0.02):
     split = plane_norm @ points_vec.transpose(-1, -2)
     mask = split[0] < 0
     return points[mask]
+
+
+def _valid_mask(points, mask=None, lengths=None):
+    if mask is not None:
+        return mask
+    N = points.shape[1]
+    if lengths is None:
+        return torch.ones(points.shape[:2], dtype=torch.bool, device=points.device)
+    return torch.arange(N, device=points.device) < lengths.unsqueeze(1)
+
+
+def _sample_valid_points(points, mask, num_samples=1):
+    """Uniformly sampled valid points of each cloud.
+
+    points: (B, N, 3), mask: (B, N) bool, with at least one valid point per cloud
+    Returns: (B, num_samples, 3)
+    """
+    idx = torch.multinomial(mask.float(), num_samples, replacement=True)
+    return torch.gather(points, 1, idx.unsqueeze(-1).expand(-1, -1, 3))
+
+
+def ball_occlusion_mask(points, mask=None, lengths=None, radius=0.05, num_occluders=1):
+    """Batched ball_occlusion that returns a mask instead of a copy.
+
+    Removes every valid point within `radius` of any of `num_occluders` random
+    valid points. Padding is given either as a (B, N) bool `mask` of valid points
+    or as (B,) `lengths`; by default every point is valid.
+    points: (B, N, 3)
+    Returns: (B, N) bool of the points that are kept.
+    """
+    mask = _valid_mask(points, mask, lengths)
+    centers = _sample_valid_points(points, mask, num_occluders)  # B, K, 3
+    dist2 = ((points.unsqueeze(2) - centers.unsqueeze(1)) ** 2).sum(-1)  # B, N, K
+    return mask & (dist2 >= radius**2).all(-1)
+
+
+def plane_occlusion_mask(
+    points, mask=None, lengths=None, stand_off=0.02, num_occluders=1
+):
+    """Batched plane_occlusion that returns a mask instead of a copy.
+
+    Each of the `num_occluders` planes is built as in plane_occlusion from a
+    random valid point and the centroid of the valid points; a point is kept
+    only if no plane cuts it away. Padding is given as in ball_occlusion_mask.
+    points: (B, N, 3)
+    Returns: (B, N) bool of the points that are kept.
+    """
+    mask = _valid_mask(points, mask, lengths)
+    pts = _sample_valid_points(points, mask, num_occluders)  # B, K, 3
+    weights = mask.unsqueeze(-1).to(points.dtype)
+    center = (points * weights).sum(1, keepdim=True) / weights.sum(1, keepdim=True)
+    plane_norm = F.normalize(pts - center, dim=-1)
+    plane_orig = pts - stand_off * plane_norm
+    # Same sign as plane_occlusion's dot product with the normalized vectors:
+    # (p - o) . n = p . n - o . n, for all K planes in one matmul.
+    offset = (plane_orig * plane_norm).sum(-1).unsqueeze(1)  # B, 1, K
+    split = points @ plane_norm.transpose(1, 2) - offset  # B, N, K
+    return mask & (split < 0).all(-1)
@@ -0,0 +1,257 @@
+"""Shard simulated evaluation trials across worker processes.
+
+Each worker runs the script's own trial loop on its shard of trial ids, with its
+own (headless) PyBullet client. The models stay resident in a single
+model-server process that owns the GPU; workers talk to it through
+`RemoteModel`, which mimics `EquivarianceTestingModule.get_transform`, and
+concurrent requests are run as one micro-batch. Every trial is seeded from
+(seed, trial id), so results do not depend on the number of workers, and the
+per-trial results are merged in trial order.
+"""
+import multiprocessing as mp
+import queue
+import random
+import time
+from collections import defaultdict
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+from pytorch3d.transforms import Transform3d
+
+from taxpose.nets.batch_norm import per_sample_batch_norm
+from taxpose.utils.se3 import fuse_hypotheses
+
+# Per-sample outputs of get_transform that are sent back with the pose.
+RESPONSE_KEYS = [
+    "pred_flow_action",
+    "pred_w_action",
+    "pred_flow_anchor",
+    "pred_w_anchor",
+    "refine_steps",
+]
+
+
+def seed_trial(seed, trial):
+    """Seed python, numpy and torch for one trial, independently of the others."""
+    trial_seed = (seed * 1000003 + trial) % 2**32
+    random.seed(trial_seed)
+    np.random.seed(trial_seed)
+    torch.manual_seed(trial_seed)
+
+
+def shard_trials(trial_ids, num_workers):
+    """Round-robin split, so every worker sees a similar mix of early and late trials."""
+    return [trial_ids[i::num_workers] for i in range(num_workers)]
+
+
+def resolve_config(cfg):
+    """Plain copy of a hydra config with all interpolations resolved.
+
+    `${hydra:...}` interpolations only resolve inside the hydra process, so the
+    config has to be resolved before it is sent to worker processes.
+    """
+    container = OmegaConf.to_container(cfg)
+    container.pop("hydra", None)
+    return OmegaConf.create(
+        OmegaConf.to_container(OmegaConf.create(container), resolve=True)
+    )
+
+
+class RemoteModel:
+    """Stand-in for an EquivarianceTestingModule served by `serve_models`.
+
+    Besides the pose, the answer holds the per-point flows and weights and the
+    time the request spent queued and being computed, in seconds.
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, name, worker_id, requests, responses):
+        self.name = name
+        self.worker_id = worker_id
+        self.requests = requests
+        self.responses = responses
+
+    def get_transform(self, points_trans_action, points_trans_anchor):
+        self.requests.put(
+            (
+                self.worker_id,
+                self.name,
+                points_trans_action.detach().cpu().numpy(),
+                points_trans_anchor.detach().cpu().numpy(),
+                time.monotonic(),
+            )
+        )
+        response = self.responses.get()
+        ans = {
+            k: torch.from_numpy(v) if isinstance(v, np.ndarray) else v
+            for k, v in response.items()
+        }
+        ans["pred_T_action"] = Transform3d(matrix=ans["pred_T_action"])
+        return ans
+
+    def get_consensus_transform(
+        self, points_trans_action, points_trans_anchor, mode="medoid"
+    ):
+        # Same as EquivarianceTestingModule.get_consensus_transform; only the
+        # batched forward pass runs on the server.
+        ans = self.get_transform(points_trans_action, points_trans_anchor)
+        return fuse_hypotheses(ans, points_trans_action[0, :, :3], mode=mode)
+
+
+def _collect_requests(requests, max_batch_size, max_wait):
+    """Block for one request, then take whatever else arrives within max_wait."""
+    batch = [requests.get()]
+    deadline = time.monotonic() + max_wait
+    while batch[-1] is not None and len(batch) < max_batch_size:
+        try:
+            batch.append(requests.get(timeout=max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+            break
+    return batch
+
+
+def serve_models(
+    build_models, build_args, requests, responses, stats, max_batch_size, max_wait
+):
+    """Model-server loop: answers get_transform requests until it receives None.
+
+    Requests for the same model and cloud sizes that arrive together are
+    concatenated into one batch; a request may itself hold several samples. On
+    exit, the (queue, compute) latency of every request is put on `stats`.
+    """
+    models = build_models(*build_args)
+    for model in models.values():
+        per_sample_batch_norm(model)
+    device = next(iter(models.values())).device
+
+    latencies = []
+    running = True
+    while running:
+        batch = _collect_requests(requests, max_batch_size, max_wait)
+        if batch[-1] is None:
+            running = False
+            batch = batch[:-1]
+
+        groups = defaultdict(list)
+        for request in batch:
+            _, name, points_action, points_anchor, _ = request
+            groups[name, points_action.shape[1:], points_anchor.shape[1:]].append(
+                request
+            )
+
+        for (name, _, _), group in groups.items():
+            start = time.monotonic()
+            with torch.no_grad():
+                ans = models[name].get_transform(
+                    torch.from_numpy(np.concatenate([r[2] for r in group])).to(device),
+                    torch.from_numpy(np.concatenate([r[3] for r in group])).to(device),
+                )
+            outputs = {"pred_T_action": ans["pred_T_action"].get_matrix()}
+            outputs.update({k: ans[k] for k in RESPONSE_KEYS if ans.get(k) is not None})
+            outputs = {k: v.cpu().numpy() for k, v in outputs.items()}
+            compute_time = time.monotonic() - start
+
+            offsets = np.cumsum([0] + [len(r[2]) for r in group])
+            for (worker_id, _, _, _, sent), i, j in zip(group, offsets, offsets[1:]):
+                response = {k: v[i:j] for k, v in outputs.items()}
+                response["queue_time"] = start - sent
+                response["compute_time"] = compute_time
+                response["batch_size"] = int(offsets[-1])
+                responses[worker_id].put(response)
+                latencies.append((start - sent, compute_time, offsets[-1]))
+    stats.put(latencies)
+
+
+def format_latencies(latencies):
+    queue_ms, compute_ms, batch_size = np.asarray(latencies).T * [[1e3], [1e3], [1]]
+    return (
+        f"{len(latencies)} requests, mean batch size {batch_size.mean():.2f}, "
+        f"queue p50/p95 {np.percentile(queue_ms, 50):.1f}/"
+        f"{np.percentile(queue_ms, 95):.1f} ms, "
+        f"compute p50/p95 {np.percentile(compute_ms, 50):.1f}/"
+        f"{np.percentile(compute_ms, 95):.1f} ms"
+    )
+
+
+def _run_worker(evaluate, args, trial_ids, models, results):
+    results.put(evaluate(*args, trial_ids, models))
+
+
+def run_sharded_eval(
+    evaluate,
+    args,
+    trial_ids,
+    build_models,
+    build_args,
+    model_names,
+    num_workers=1,
+    max_wait=0.005,
+):
+    """Run evaluate(*args, trial_ids, models) over trial_ids, sharded across workers.
+
+    evaluate must be a module-level function returning one dict per finished
+    trial with a "trial" key. build_models(*build_args) returns a dict from name
+    to model; with one worker it is called in-process, otherwise once in the
+    model-server process, which waits up to max_wait seconds for concurrent
+    requests to batch together. Either way batch norm is made per-sample, so a
+    request holding several samples gets the same answer as each sample alone.
+    Returns the merged results, sorted by trial.
+    """
+    if num_workers <= 1:
+        models = build_models(*build_args)
+        for model in models.values():
+            per_sample_batch_norm(model)
+        return evaluate(*args, trial_ids, models)
+
+    ctx = mp.get_context("spawn")
+    requests = ctx.Queue()
+    responses = [ctx.Queue() for _ in range(num_workers)]
+    results = ctx.Queue()
+    stats = ctx.Queue()
+    server = ctx.Process(
+        target=serve_models,
+        args=(
+            build_models,
+            build_args,
+            requests,
+            responses,
+            stats,
+            num_workers,
+            max_wait,
+        ),
+    )
+    server.start()
+
+    workers = []
+    for worker_id, shard in enumerate(shard_trials(trial_ids, num_workers)):
+        models = {
+            name: RemoteModel(name, worker_id, requests, responses[worker_id])
+            for name in model_names
+        }
+        worker = ctx.Process(
+            target=_run_worker, args=(evaluate, args, shard, models, results)
+        )
+        worker.start()
+        workers.append(worker)
+
+    merged = []
+    pending = len(workers)
+    while pending:
+        try:
+            merged.extend(results.get(timeout=30))
+            pending -= 1
+        except queue.Empty:
+            if any(w.exitcode not in (None, 0) for w in workers + [server]):
+                for p in workers + [server]:
+                    p.terminate()
+                raise RuntimeError("an evaluation worker or the model server died")
+    for worker in workers:
+        worker.join()
+    requests.put(None)
+    latencies = stats.get()
+    server.join()
+    if latencies:
+        print("model server: " + format_latencies(latencies))
+    return sorted(merged, key=lambda r: r["trial"])
@@ -0,0 +1,52 @@
+"""Mixed precision helpers.
+
+`precision` follows the Lightning Trainer flag: 32, 16 or "bf16". The networks
+run under autocast at that precision, while pose solving, weight normalization
+and the losses are kept in fp32 with `full_precision`.
+"""
+import contextlib
+import functools
+import itertools
+
+import torch
+
+AUTOCAST_DTYPES = {"32": None, "16": torch.float16, "bf16": torch.bfloat16}
+
+
+def autocast_dtype(precision):
+    """Autocast dtype for a precision flag, or None for fp32."""
+    if str(precision) not in AUTOCAST_DTYPES:
+        raise ValueError(f"unknown precision: {precision}")
+    return AUTOCAST_DTYPES[str(precision)]
+
+
+def autocast(device_type, precision):
+    """Autocast context for the given precision; a no-op for fp32."""
+    dtype = autocast_dtype(precision)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type, dtype=dtype)
+
+
+def _fp32(x):
+    if torch.is_tensor(x) and x.dtype in (torch.float16, torch.bfloat16):
+        return x.float()
+    return x
+
+
+def full_precision(fn):
+    """Run fn with autocast disabled and its half-precision tensor arguments in fp32."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [_fp32(a) for a in args]
+        kwargs = {k: _fp32(v) for k, v in kwargs.items()}
+        tensor = next(
+            (a for a in itertools.chain(args, kwargs.values()) if torch.is_tensor(a)),
+            None,
+        )
+        device_type = "cpu" if tensor is None else tensor.device.type
+        with torch.autocast(device_type, enabled=False):
+            return fn(*args, **kwargs)
+
+    return wrapper
@@ -1,3 +1,6 @@
+import functools
+import os
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -11,8 +14,26 @@ from pytorch3d.transforms import (
 )
 from torch.nn import functional as F
 
+from taxpose.utils.precision import full_precision
+
 mse_criterion = nn.MSELoss(reduction="sum")
 
+# Input validation in the pose solvers reads tensors back to the host, which
+# stalls the GPU stream. Off by default; enable with TAXPOSE_DEBUG_CHECKS=1 or
+# set_debug_checks(True).
+DEBUG_CHECKS = os.environ.get("TAXPOSE_DEBUG_CHECKS", "0") == "1"
+
+
+def set_debug_checks(enabled):
+    global DEBUG_CHECKS
+    DEBUG_CHECKS = enabled
+
+
+def _check_weights_normalized(w, msg):
+    if DEBUG_CHECKS:
+        w_sum = w.sum(1)
+        assert torch.allclose(w_sum, torch.ones_like(w_sum)), msg
+
 
 def to_transform3d(x, rot_function=rotation_6d_to_matrix):
     trans = x[:, :3]
@@ -54,6 +75,20 @@ def random_se3(
     return Rotate(R, device=device).translate(t)
 
 
+def batched_random_se3(N, rot_var=np.pi / 180 * 5, trans_var=0.1, device=None):
+    """N independent draws, each distributed like random_se3(1, rot_var, trans_var).
+
+    random_se3(N) shares one angle and translation scale across the batch; this
+    samples them per transform and never reads values back to the host.
+    """
+    axis = F.normalize(torch.randn(N, 3, device=device), dim=1)
+    angle = torch.rand(N, 1, device=device) * rot_var
+    R = axis_angle_to_matrix(angle * axis)
+    direction = F.normalize(torch.randn(N, 3, device=device), dim=1)
+    t = torch.rand(N, 1, device=device) * trans_var * direction
+    return rt_to_transform3d(R, t)
+
+
 def get_degree_angle(T):
     angle_rad_T = (
         so3_rotation_angle(T.get_matrix()[:, :3, :3], eps=1e-2) * 180 / np.pi
@@ -65,6 +100,21 @@ def get_degree_angle(T):
     return max, min, mean
 
 
+def rotation_angle(R):
+    """Angle in radians of (B, 3, 3) rotation matrices.
+
+    Unlike `so3_rotation_angle`, whose cosine bound keeps it above ~0.8 degrees,
+    this stays accurate for small angles: it takes atan2 of the sine (from the
+    skew part of R) and the cosine (from its trace).
+    """
+    cos = (R[:, 0, 0] + R[:, 1, 1] + R[:, 2, 2] - 1) / 2
+    skew = torch.stack(
+        [R[:, 2, 1] - R[:, 1, 2], R[:, 0, 2] - R[:, 2, 0], R[:, 1, 0] - R[:, 0, 1]],
+        dim=-1,
+    )
+    return torch.atan2(skew.norm(dim=-1) / 2, cos)
+
+
 def get_translation(T):
     t = T.get_matrix()[:, 3, :3]  # B,3
     t_norm = torch.norm(t, dim=1)  # B
@@ -94,24 +144,79 @@ def pure_translation_se3(N, t, device=None):
     Args
         t: torch tensor of shape (3)
     """
-    axis = torch.tensor([0, 0, 1])
-    axis_angle = 0.0 * axis
-    axis_angle = axis_angle.unsqueeze(0)  # (1,3)
-    axis_angle = torch.repeat_interleave(axis_angle, N, dim=0)  # (N,3)
-    R = axis_angle_to_matrix(axis_angle.to(device))  # identity
-    assert torch.allclose(
-        torch.eye(3).to(device), R[0]
-    ), "R should be identity for pure translation se3"
     t = torch.repeat_interleave(t.unsqueeze(0), N, dim=0).to(device)  # N,3
-    return Rotate(R, device=device).translate(t)
+    return Translate(t, device=device)
+
 
+def rt_to_transform3d(R, t):
+    """Same transform as Rotate(R).translate(t), built directly from the matrix.
 
-def symmetric_orthogonalization(M):
+    Rotate validates R with torch.allclose, which syncs with the host on every
+    call. The solvers below already produce rotations, so the check is skipped.
+    R: (B, 3, 3), t: (B, 3)
+    """
+    B = R.shape[0]
+    top = torch.cat([R, R.new_zeros(B, 3, 1)], dim=2)
+    bottom = torch.cat([t, t.new_ones(B, 1)], dim=1).unsqueeze(1)
+    return Transform3d(matrix=torch.cat([top, bottom], dim=1))
+
+
+ROTATION_SOLVERS = ("svd", "quaternion")
+
+
+@functools.lru_cache(maxsize=None)
+def _quat_to_rot_basis(device, dtype):
+    """(3, 3, 4, 4) tensor A such that R(q)[i, j] = q^T A[i, j] q for a unit
+    quaternion q = (w, x, y, z)."""
+    w, x, y, z = 0, 1, 2, 3
+    terms = {
+        (0, 0): [(w, w, 1), (x, x, 1), (y, y, -1), (z, z, -1)],
+        (1, 1): [(w, w, 1), (x, x, -1), (y, y, 1), (z, z, -1)],
+        (2, 2): [(w, w, 1), (x, x, -1), (y, y, -1), (z, z, 1)],
+        (0, 1): [(x, y, 1), (y, x, 1), (w, z, -1), (z, w, -1)],
+        (1, 0): [(x, y, 1), (y, x, 1), (w, z, 1), (z, w, 1)],
+        (0, 2): [(x, z, 1), (z, x, 1), (w, y, 1), (y, w, 1)],
+        (2, 0): [(x, z, 1), (z, x, 1), (w, y, -1), (y, w, -1)],
+        (1, 2): [(y, z, 1), (z, y, 1), (w, x, -1), (x, w, -1)],
+        (2, 1): [(y, z, 1), (z, y, 1), (w, x, 1), (x, w, 1)],
+    }
+    A = torch.zeros(3, 3, 4, 4, dtype=dtype)
+    for (i, j), ij_terms in terms.items():
+        for a, b, c in ij_terms:
+            A[i, j, a, b] = c
+    return A.to(device)
+
+
+def quaternion_orthogonalization(M):
+    """Same projection as `symmetric_orthogonalization`, solved with Horn's quaternion method.
+
+    argmax_R tr(R^T M) over SO(3) is the rotation of the top eigenvector of a 4x4
+    symmetric matrix that is linear in M, so this needs one batched 4x4 `eigh`
+    instead of a 3x3 SVD plus a determinant and a reflection fix. Both solvers
+    differentiate the same function, so gradients agree wherever the solution is
+    unique.
+    M: should have size [batch_size, 3, 3]
+    """
+    A = _quat_to_rot_basis(M.device, M.dtype)
+    K = torch.einsum("bij,ijkl->bkl", M, A)
+    _, V = torch.linalg.eigh(K)
+    q = V[..., -1]  # Eigenvalues are ascending.
+    return torch.einsum("ijkl,bk,bl->bij", A, q, q)
+
+
+@full_precision
+def symmetric_orthogonalization(M, rotation_solver="svd"):
     """Maps arbitrary input matrices onto SO(3) via symmetric orthogonalization.
     (modified from https://github.com/amakadia/svd_for_pose)
     M: should have size [batch_size, 3, 3]
+    rotation_solver: {'svd', 'quaternion'}, see `quaternion_orthogonalization`.
     Output has size [batch_size, 3, 3], where each inner 3x3 matrix is in SO(3).
     """
+    assert (
+        rotation_solver in ROTATION_SOLVERS
+    ), "rotation_solver: {} is not currently supported!".format(rotation_solver)
+    if rotation_solver == "quaternion":
+        return quaternion_orthogonalization(M)
     U, _, Vh = torch.linalg.svd(M)
     det = torch.det(torch.bmm(U, Vh)).view(-1, 1, 1)
     Vh = torch.cat((Vh[:, :2, :], Vh[:, -1:, :] * det), 1)
@@ -119,6 +224,47 @@ def symmetric_orthogonalization(M):
     return R
 
 
+def consensus_pose(T, points, mode="medoid"):
+    """Fuse K pose hypotheses of the same scene into one pose.
+
+    T: (K, 4, 4) row-vector transforms, points: (N, 3) action points they act on.
+    medoid: pick the hypothesis whose transformed points are closest, on
+        average, to those of the other hypotheses; robust to outliers.
+    mean: chordal L2 mean of the rotations (projected back onto SO(3)) and the
+        mean translation.
+    Returns: (1, 4, 4) fused transform, and the index of the picked hypothesis
+    (None for mean).
+    """
+    if mode == "medoid":
+        moved = points @ T[:, :3, :3] + T[:, 3:, :3]  # K, N, 3
+        dists = (moved.unsqueeze(0) - moved.unsqueeze(1)).norm(dim=-1).mean(-1)
+        idx = int(dists.sum(-1).argmin())
+        return T[idx : idx + 1], idx
+    if mode == "mean":
+        fused = torch.eye(4, dtype=T.dtype, device=T.device).unsqueeze(0)
+        fused[:, :3, :3] = symmetric_orthogonalization(
+            T[:, :3, :3].mean(0, keepdim=True)
+        )
+        fused[:, 3, :3] = T[:, 3, :3].mean(0)
+        return fused, None
+    raise ValueError(f"unknown consensus mode: {mode}")
+
+
+def fuse_hypotheses(ans_dict, points, mode="medoid"):
+    """Replace the K poses of a get_transform answer with their `consensus_pose`.
+
+    points: (N, 3) action points of the first hypothesis. The K poses are kept
+    under "hypotheses_T_action" and the picked index under "hypothesis_idx".
+    """
+    T = ans_dict["pred_T_action"].get_matrix()
+    pred_T_action, idx = consensus_pose(T, points.to(T.device), mode=mode)
+    ans_dict["hypotheses_T_action"] = ans_dict["pred_T_action"]
+    ans_dict["pred_T_action"] = Transform3d(matrix=pred_T_action)
+    ans_dict["hypothesis_idx"] = idx
+    return ans_dict
+
+
+@full_precision
 def flow2pose(
     xyz,
     flow,
@@ -126,12 +272,14 @@ def flow2pose(
     return_transform3d=False,
     normalization_scehme="l1",
     temperature=1,
+    rotation_solver="svd",
 ):
     """
     @param xyz: (batch, num_points, 3)
     @param flow: (batch, num_points,3)
     @param weights: (batch, num_points)
     @param normalization_scehme: {'l1, 'softmax'}
+    @param rotation_solver: {'svd', 'quaternion'}, see symmetric_orthogonalization
     @param x: flow prediction
     @return pred_T_action: SE(3) transformation from xyz to the other point cloud
     """
@@ -150,12 +298,9 @@ def flow2pose(
         softmax_operator = torch.nn.Softmax(dim=-1)
         # B, num_points, 1
         w = softmax_operator(weights / temperature).unsqueeze(-1)
-    # if not torch.allclose(w.sum(1), torch.ones(w.sum(1).shape).cuda()):
-    #     import pdb
-    #     pdb.set_trace()
-    assert torch.allclose(
-        w.sum(1), torch.ones(w.sum(1).shape).cuda()
-    ), "flow weights does not sum to 1 for each batch element"
+    _check_weights_normalized(
+        w, "flow weights does not sum to 1 for each batch element"
+    )
     xyz_mean = (w * xyz).sum(dim=1, keepdims=True)
     xyz_centered = xyz - xyz_mean
 
@@ -165,17 +310,18 @@ def flow2pose(
     xyz_trans = xyz_centered + flow_centered
     X = torch.bmm(xyz_centered.transpose(-2, -1), w * xyz_trans)
 
-    R = symmetric_orthogonalization(X)
+    R = symmetric_orthogonalization(X, rotation_solver=rotation_solver)
     t = (flow_mean + xyz_mean - torch.bmm(xyz_mean, R)).squeeze(1)
 
     if return_transform3d:
-        return Rotate(R).translate(t)
+        return rt_to_transform3d(R, t)
     return R, t
 
 
 eps = 1e-9
 
 
+@full_precision
 def dualflow2pose(
     xyz_src,
     xyz_tgt,
@@ -186,7 +332,13 @@ def dualflow2pose(
     return_transform3d=False,
     normalization_scehme="l1",
     temperature=1,
+    rotation_solver="svd",
+    mask_src=None,
+    mask_tgt=None,
 ):
+    """mask_src (B, N) and mask_tgt (B, M) mark the real points of zero-padded
+    clouds; padded points get no weight and don't count towards the translation
+    average."""
     assert normalization_scehme in [
         "l1",
         "softmax",
@@ -199,6 +351,12 @@ def dualflow2pose(
     if weights_tgt is None:
         weights_tgt = torch.ones(xyz_tgt.shape[:-1], device=xyz_tgt.device)
 
+    fill = 0.0 if normalization_scehme == "l1" else -float("inf")
+    if mask_src is not None:
+        weights_src = weights_src.masked_fill(~mask_src, fill)
+    if mask_tgt is not None:
+        weights_tgt = weights_tgt.masked_fill(~mask_tgt, fill)
+
     if normalization_scehme == "l1":
         w_src = F.normalize(weights_src, p=1.0, dim=-1).unsqueeze(-1)
         w_tgt = F.normalize(weights_tgt, p=1.0, dim=-1).unsqueeze(-1)
@@ -206,12 +364,12 @@ def dualflow2pose(
         softmax_operator = torch.nn.Softmax(dim=-1)
         w_src = softmax_operator(weights_src / temperature).unsqueeze(-1)
         w_tgt = softmax_operator(weights_tgt / temperature).unsqueeze(-1)
-    assert torch.allclose(
-        w_src.sum(1), torch.ones(w_src.sum(1).shape).cuda()
-    ), "flow src weights does not sum to 1 for each batch element"
-    assert torch.allclose(
-        w_tgt.sum(1), torch.ones(w_tgt.sum(1).shape).cuda()
-    ), "flow tgt weights does not sum to 1 for each batch element"
+    _check_weights_normalized(
+        w_src, "flow src weights does not sum to 1 for each batch element"
+    )
+    _check_weights_normalized(
+        w_tgt, "flow tgt weights does not sum to 1 for each batch element"
+    )
 
     xyz_mean_src = (w_src * xyz_src).sum(dim=1, keepdims=True)
 
@@ -231,20 +389,20 @@ def dualflow2pose(
 
     X = torch.bmm(xyz_1.transpose(-2, -1), w * xyz_2)
 
-    R = symmetric_orthogonalization(X)
+    R = symmetric_orthogonalization(X, rotation_solver=rotation_solver)
     t_src = flow_mean_src + xyz_mean_src - torch.bmm(xyz_mean_src, R)
     t_tgt = xyz_mean_tgt - torch.bmm(flow_mean_tgt + xyz_mean_tgt, R)
 
-    t = (
-        (w_src.shape[1] * t_src + w_tgt.shape[1] * t_tgt)
-        / (w_src.shape[1] + w_tgt.shape[1])
-    ).squeeze(1)
+    n_src = w_src.shape[1] if mask_src is None else mask_src.sum(1).view(-1, 1, 1)
+    n_tgt = w_tgt.shape[1] if mask_tgt is None else mask_tgt.sum(1).view(-1, 1, 1)
+    t = ((n_src * t_src + n_tgt * t_tgt) / (n_src + n_tgt)).squeeze(1)
 
     if return_transform3d:
-        return Rotate(R).translate(t)
+        return rt_to_transform3d(R, t)
     return R, t
 
 
+@full_precision
 def dualflow2translation(
     xyz_src,
     xyz_tgt,
@@ -275,12 +433,12 @@ def dualflow2translation(
         softmax_operator = torch.nn.Softmax(dim=-1)
         w_src = softmax_operator(weights_src / temperature).unsqueeze(-1)
         w_tgt = softmax_operator(weights_tgt / temperature).unsqueeze(-1)
-    assert torch.allclose(
-        w_src.sum(1), torch.ones(w_src.sum(1).shape).cuda()
-    ), "flow src weights does not sum to 1 for each batch element"
-    assert torch.allclose(
-        w_tgt.sum(1), torch.ones(w_tgt.sum(1).shape).cuda()
-    ), "flow tgt weights does not sum to 1 for each batch element"
+    _check_weights_normalized(
+        w_src, "flow src weights does not sum to 1 for each batch element"
+    )
+    _check_weights_normalized(
+        w_tgt, "flow tgt weights does not sum to 1 for each batch element"
+    )
 
     xyz_mean_src = (w_src * xyz_src).sum(dim=1, keepdims=True)
     xyz_mean_tgt = (w_tgt * xyz_tgt).sum(dim=1, keepdims=True)
@@ -301,6 +459,7 @@ def dualflow2translation(
     return t
 
 
+@full_precision
 def dualflow2pose_joint(
     xyz,
     flow,
@@ -308,6 +467,7 @@ def dualflow2pose_joint(
     weights=None,
     return_transform3d=False,
     normalization_scehme="l1",
+    rotation_solver="svd",
 ):
     assert normalization_scehme in [
         "l1",
@@ -322,9 +482,9 @@ def dualflow2pose_joint(
     elif normalization_scehme == "softmax":
         softmax_operator = torch.nn.Softmax(dim=-1)
         w = softmax_operator(weights).unsqueeze(-1)
-    assert torch.allclose(
-        w.sum(1), torch.ones(w.sum(1).shape).cuda()
-    ), "flow weights does not sum to 1 for each batch element"
+    _check_weights_normalized(
+        w, "flow weights does not sum to 1 for each batch element"
+    )
 
     w_p = (polarity * weights).unsqueeze(-1)
     w_p_sum = w_p.sum(dim=1, keepdims=True)
@@ -349,19 +509,25 @@ def dualflow2pose_joint(
 
     X = torch.bmm(xyz_1.transpose(-2, -1), w * xyz_2)
 
-    R = symmetric_orthogonalization(X)
+    R = symmetric_orthogonalization(X, rotation_solver=rotation_solver)
     t_p = flow_mean_p + xyz_mean_p - torch.bmm(xyz_mean_p, R)
     t_n = xyz_mean_n - torch.bmm(flow_mean_n + xyz_mean_n, R)
 
     t = ((w_p_sum * t_p + w_n_sum * t_n) / (w_p_sum + w_n_sum)).squeeze(1)
 
     if return_transform3d:
-        return Rotate(R).translate(t)
+        return rt_to_transform3d(R, t)
     return R, t
 
 
+@full_precision
 def points2pose(
-    xyz1, xyz2, weights=None, return_transform3d=False, normalization_scehme="l1"
+    xyz1,
+    xyz2,
+    weights=None,
+    return_transform3d=False,
+    normalization_scehme="l1",
+    rotation_solver="svd",
 ):
     assert normalization_scehme in [
         "l1",
@@ -376,9 +542,9 @@ def points2pose(
     elif normalization_scehme == "softmax":
         softmax_operator = torch.nn.Softmax(dim=-1)
         w = softmax_operator(weights).unsqueeze(-1)
-    assert torch.allclose(
-        w.sum(1), torch.ones(w.sum(1).shape).cuda()
-    ), "flow weights does not sum to 1 for each batch element"
+    _check_weights_normalized(
+        w, "flow weights does not sum to 1 for each batch element"
+    )
     xyz1_mean = (w * xyz1).sum(dim=1, keepdims=True)
     xyz1_demean = xyz1 - xyz1_mean
 
@@ -387,14 +553,15 @@ def points2pose(
 
     X = torch.bmm(xyz1_demean.transpose(-2, -1), w * xyz2_demean)
 
-    R = symmetric_orthogonalization(X)
+    R = symmetric_orthogonalization(X, rotation_solver=rotation_solver)
     t = (xyz2_mean - torch.bmm(xyz1_mean, R)).squeeze(1)
 
     if return_transform3d:
-        return Rotate(R).translate(t)
+        return rt_to_transform3d(R, t)
     return R, t
 
 
+@full_precision
 def dense_flow_loss(points, flow_pred, trans_gt):
     flow_gt = trans_gt.transform_points(points) - points
     loss = mse_criterion(
@@ -404,6 +571,7 @@ def dense_flow_loss(points, flow_pred, trans_gt):
     return loss
 
 
+@full_precision
 def svd_flow_loss(points, flow_pred, points_tgt, weights_pred=None):
     T_pred = flow2pose(points, flow_pred, weights_pred, return_transform3d=True)
     points_pred = T_pred.transform_points(points)
@@ -422,6 +590,7 @@ def svd_flow_loss(points, flow_pred, points_tgt, weights_pred=None):
     return point_loss, consistency_loss
 
 
+@full_precision
 def consistency_flow_loss(points, flow_pred, weights_pred=None):
     T_pred = flow2pose(
         points, flow_pred, weights_pred, return_transform3d=True
@@ -437,6 +606,7 @@ def consistency_flow_loss(points, flow_pred, weights_pred=None):
     return consistency_loss
 
 
+@full_precision
 def consistency_dualflow_loss(
     points_trans_action,
     points_trans_anchor,
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from third_party.dcp.model import attention, memory_efficient_attention
+
+
+@pytest.mark.parametrize("chunk_size", [1, 64, 1024])
+def test_chunked_attention_matches_dense(chunk_size):
+    torch.manual_seed(0)
+    q, k, v = (torch.randn(2, 4, 300, 16) for _ in range(3))
+    out, p_attn = attention(q, k, v)
+    out_me, p_attn_me = memory_efficient_attention(
+        q, k, v, need_attn=True, chunk_size=chunk_size
+    )
+    assert torch.allclose(out, out_me, atol=1e-5)
+    assert p_attn_me.shape == (2, 1, 300, 300)
+    assert torch.allclose(p_attn.mean(dim=1, keepdim=True), p_attn_me, atol=1e-6)
+
+
+def test_fused_attention_matches_dense():
+    torch.manual_seed(0)
+    q, k, v = (torch.randn(2, 4, 300, 16) for _ in range(3))
+    out, _ = attention(q, k, v)
+    out_me, p_attn_me = memory_efficient_attention(q, k, v, need_attn=False)
+    assert torch.allclose(out, out_me, atol=1e-5)
+    assert p_attn_me is None
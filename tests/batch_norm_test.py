@@ -0,0 +1,18 @@
+import pytest
+import torch
+
+from taxpose.nets.batch_norm import per_sample_batch_norm
+
+
+def test_per_sample_batch_norm_matches_single_samples():
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 8, 1), torch.nn.BatchNorm2d(8), torch.nn.ReLU()
+    )
+    x = torch.randn(4, 3, 16, 5)
+    expected = torch.cat([net(x[i : i + 1]) for i in range(len(x))])
+    assert torch.allclose(per_sample_batch_norm(net)(x), expected, atol=1e-6)
+
+    with pytest.raises(ValueError, match="per-sample"):
+        net = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.BatchNorm1d(4))
+        per_sample_batch_norm(net)(torch.randn(3, 4))
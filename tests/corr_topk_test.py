@@ -0,0 +1,41 @@
+import torch
+
+from taxpose.nets.transformer_flow import ResidualMLPHead
+
+
+def test_corr_topk_matches_dense_when_k_covers_anchor():
+    torch.manual_seed(0)
+    head = ResidualMLPHead(emb_dims=32).eval()
+    action_emb, anchor_emb = torch.randn(2, 32, 50), torch.randn(2, 32, 70)
+    action, anchor = torch.randn(2, 3, 50), torch.randn(2, 3, 70)
+    scores = torch.softmax(torch.randn(2, 50, 70), dim=-1)
+
+    with torch.no_grad():
+        expected = head(action_emb, anchor_emb, action, anchor)
+        expected_attn = head(action_emb, anchor_emb, action, anchor, scores=scores)
+        head.corr_topk = 70
+        actual = head(action_emb, anchor_emb, action, anchor)
+        actual_attn = head(action_emb, anchor_emb, action, anchor, scores=scores)
+    assert torch.allclose(expected, actual, atol=1e-5)
+    assert torch.allclose(expected_attn, actual_attn, atol=1e-5)
+
+
+def test_corr_topk_keeps_best_matches():
+    torch.manual_seed(0)
+    head = ResidualMLPHead(emb_dims=32, corr_topk=3)
+    anchor = torch.randn(1, 3, 10)
+    scores = torch.softmax(torch.randn(1, 4, 10), dim=-1)
+    out = head(
+        torch.randn(1, 32, 4),
+        torch.randn(1, 32, 10),
+        torch.zeros(1, 3, 4),
+        anchor,
+        scores=scores,
+        return_flow_component=True,
+    )
+
+    weights, idx = scores.topk(3, dim=-1)
+    weights = weights / weights.sum(dim=-1, keepdim=True)
+    expected = torch.einsum("nk,nkc->cn", weights[0], anchor[0].T[idx[0]])
+    assert torch.equal(out["corr_idx"], idx)
+    assert torch.allclose(out["corr_points"][0], expected, atol=1e-6)
@@ -0,0 +1,47 @@
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from taxpose.datasets.demo_cache import DemoCache, PointCloudStream
+from taxpose.datasets.point_cloud_store import compute_camera_idxs
+
+
+class RandomDataset:
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, index):
+        return torch.rand(1).item() + np.random.rand()
+
+
+def test_demo_cache_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    demos = {}
+    for idx in [0, 3]:
+        classes = np.concatenate([np.repeat([0, 1, 2], rng.integers(1, 9, 3))] * 4)
+        clouds = rng.standard_normal((len(classes), 3)).astype(np.float32)
+        demos[tmp_path / f"{idx}.npz"] = (clouds, classes)
+
+    cache = DemoCache(list(demos), lambda f: (*demos[f], None))
+    assert cache.points.is_shared()
+    for filename, (clouds, classes) in demos.items():
+        points, cached_classes, camera_idxs = cache.get(filename)
+        np.testing.assert_array_equal(points, clouds)
+        np.testing.assert_array_equal(cached_classes, classes)
+        np.testing.assert_array_equal(camera_idxs, compute_camera_idxs(classes))
+
+
+def test_stream_is_sharded_and_seeded():
+    def epochs(seed):
+        loader = DataLoader(
+            PointCloudStream(RandomDataset(), seed=seed),
+            batch_size=None,
+            num_workers=3,
+            persistent_workers=True,
+        )
+        return [sorted(loader) for _ in range(2)]
+
+    first, second = epochs(seed=0)
+    assert len(first) == 10 and len(set(first)) == 10
+    assert set(first).isdisjoint(second)
+    assert epochs(seed=0) == [first, second]
@@ -0,0 +1,52 @@
+import torch
+
+from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
+
+
+def test_anchor_cache_reuses_translated_anchor():
+    torch.manual_seed(0)
+    model = ResidualFlow_DiffEmbTransformer(
+        emb_dims=32, center_feature=True, anchor_emb_cache_size=2
+    ).eval()
+    action, anchor = torch.rand(1, 64, 3), torch.rand(1, 80, 3)
+    shifted_anchor = anchor + torch.tensor([0.3, -0.1, 0.2])
+
+    with torch.no_grad():
+        model(action, anchor)
+        flow_action, flow_anchor = model(action, shifted_anchor)
+    assert (model.anchor_emb_cache.hits, model.anchor_emb_cache.misses) == (1, 1)
+
+    model.anchor_emb_cache = None
+    with torch.no_grad():
+        expected_action, expected_anchor = model(action, shifted_anchor)
+    assert torch.allclose(flow_action, expected_action, atol=1e-5)
+    assert torch.allclose(flow_anchor, expected_anchor, atol=1e-5)
+
+
+def test_anchor_cache_is_bypassed_with_gradients():
+    model = ResidualFlow_DiffEmbTransformer(
+        emb_dims=32, center_feature=True, anchor_emb_cache_size=2
+    )
+    model(torch.rand(1, 64, 3), torch.rand(1, 80, 3))
+    assert len(model.anchor_emb_cache) == 0
+
+
+def test_anchor_cache_is_cleared_when_weights_change():
+    torch.manual_seed(0)
+    model = ResidualFlow_DiffEmbTransformer(
+        emb_dims=32, center_feature=True, anchor_emb_cache_size=2
+    ).eval()
+    action, anchor = torch.rand(1, 64, 3), torch.rand(1, 80, 3)
+    with torch.no_grad():
+        model(action, anchor)
+
+        # e.g. an optimizer step after a validation pass
+        for p in model.emb_nn_anchor.parameters():
+            p.add_(0.1)
+        flow_action, _ = model(action, anchor)
+    assert model.anchor_emb_cache.hits == 0
+
+    model.anchor_emb_cache = None
+    with torch.no_grad():
+        expected_action, _ = model(action, anchor)
+    assert torch.allclose(flow_action, expected_action, atol=1e-5)
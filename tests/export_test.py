@@ -0,0 +1,36 @@
+import pytest
+import torch
+
+from taxpose.nets.export import ExportableResidualFlow, export_torchscript
+from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
+
+
+@pytest.mark.parametrize("sample_stats_bn", [True, False])
+def test_exportable_matches_model(sample_stats_bn):
+    torch.manual_seed(0)
+    model = ResidualFlow_DiffEmbTransformer(emb_dims=32, center_feature=True)
+    model.train(sample_stats_bn)
+    wrapper = ExportableResidualFlow(model, sample_stats_bn=sample_stats_bn)
+    action, anchor = torch.rand(1, 64, 3), torch.rand(1, 80, 3)
+
+    with torch.no_grad():
+        expected = model(action, anchor)
+        actual = wrapper(action, anchor)
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-4)
+    assert model.training == sample_stats_bn
+
+
+def test_torchscript_export_has_dynamic_sizes(tmp_path):
+    torch.manual_seed(0)
+    wrapper = ExportableResidualFlow(ResidualFlow_DiffEmbTransformer(emb_dims=32))
+    export_torchscript(wrapper, tmp_path / "model.pt", num_points=64)
+    traced = torch.jit.load(str(tmp_path / "model.pt"))
+
+    action, anchor = torch.rand(2, 100, 3), torch.rand(2, 130, 3)
+    with torch.no_grad():
+        expected = wrapper(action, anchor)
+        actual = traced(action, anchor)
+    assert actual[0].shape == (2, 100, 4) and actual[1].shape == (2, 130, 4)
+    for e, a in zip(expected, actual):
+        assert torch.allclose(e, a, atol=1e-4)
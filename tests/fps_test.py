@@ -0,0 +1,33 @@
+import torch
+
+from taxpose.datasets.fps import batch_farthest_point_sample, collate_ragged
+
+
+def test_batch_fps_keeps_pairs_aligned():
+    torch.manual_seed(0)
+    samples = []
+    for n_action, n_anchor in [(300, 500), (200, 800)]:
+        points_action = torch.randn(n_action, 3)
+        points_anchor = torch.randn(n_anchor, 3)
+        samples.append(
+            {
+                "points_action": points_action,
+                "points_anchor": points_anchor,
+                "points_action_trans": points_action + 1,
+                "points_anchor_trans": points_anchor * 2,
+                "T0": torch.eye(4),
+            }
+        )
+
+    batch = collate_ragged(samples)
+    assert batch["points_anchor"].shape == (2, 800, 3)
+    assert batch["points_action_lengths"].tolist() == [300, 200]
+
+    batch = batch_farthest_point_sample(batch, 128)
+    assert "points_action_lengths" not in batch
+    assert batch["points_action"].shape == (2, 128, 3)
+    assert batch["T0"].shape == (2, 4, 4)
+    assert torch.equal(batch["points_action_trans"], batch["points_action"] + 1)
+    assert torch.equal(batch["points_anchor_trans"], batch["points_anchor"] * 2)
+    # Padding is never sampled.
+    assert (batch["points_action"][1].abs().sum(-1) > 0).all()
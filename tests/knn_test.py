@@ -0,0 +1,21 @@
+import pytest
+import torch
+
+from third_party.dcp.model import get_graph_feature, knn
+
+
+@pytest.mark.parametrize("chunk_size", [1, 100, 512, 4096])
+def test_chunked_knn_matches_dense(chunk_size):
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, 1000)
+    assert torch.equal(knn(x, 20, chunk_size=None), knn(x, 20, chunk_size=chunk_size))
+
+
+def test_graph_feature_reuses_idx_on_cpu():
+    torch.manual_seed(0)
+    x = torch.randn(2, 3, 256)
+    idx = knn(x, 20, chunk_size=64)
+    feature = get_graph_feature(x, idx=idx)
+    assert feature.shape == (2, 6, 256, 20)
+    dense = get_graph_feature(x, idx=knn(x, 20, chunk_size=None))
+    assert torch.equal(feature, dense)
@@ -0,0 +1,22 @@
+import torch
+
+from taxpose.datasets.ndf_dataset import camera_intrinsics
+from taxpose.utils.ndf_geometry import lift, lift_views, pixel_ray_table
+
+
+def test_lift_views_matches_per_view_lift():
+    torch.manual_seed(0)
+    intrinsics = camera_intrinsics()[None]
+    ray_table = pixel_ray_table(intrinsics, 48, 64)
+    pixel_idxs = [torch.randint(0, 48 * 64, (n,)) for n in [5, 9, 1]]
+    depths = [torch.rand(len(idx)) + 0.5 for idx in pixel_idxs]
+    transforms = torch.eye(4, dtype=torch.float64).repeat(3, 1, 1)
+    transforms[:, :3, :3] = torch.linalg.qr(torch.randn(3, 3, 3).double())[0]
+    transforms[:, :3, 3] = torch.randn(3, 3).double()
+
+    expected = []
+    for idx, depth, T in zip(pixel_idxs, depths, transforms):
+        points = lift(idx % 64, idx // 64, depth.double(), intrinsics)
+        expected.append(points @ T[:3, :3].T + T[:3, 3])
+    actual = lift_views(pixel_idxs, depths, ray_table, transforms)
+    assert torch.allclose(actual, torch.cat(expected))
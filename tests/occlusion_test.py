@@ -0,0 +1,46 @@
+import pytest
+import torch
+from torch.nn import functional as F
+
+from taxpose.utils import occlusion_utils
+from taxpose.utils.occlusion_utils import ball_occlusion_mask, plane_occlusion_mask
+
+
+@pytest.mark.parametrize("num_occluders", [1, 3])
+def test_occlusion_masks_respect_padding(num_occluders):
+    torch.manual_seed(0)
+    points = torch.randn(4, 500, 3)
+    lengths = torch.tensor([500, 400, 300, 200])
+    mask = torch.arange(500) < lengths.unsqueeze(1)
+
+    ball = ball_occlusion_mask(
+        points, lengths=lengths, radius=0.5, num_occluders=num_occluders
+    )
+    plane = plane_occlusion_mask(
+        points, mask=mask, stand_off=0.1, num_occluders=num_occluders
+    )
+    for keep in [ball, plane]:
+        assert not (keep & ~mask).any()
+        assert (keep.sum(1) < lengths).all()
+
+
+def test_masks_match_single_cloud_occluders(monkeypatch):
+    torch.manual_seed(0)
+    points = torch.randn(1, 300, 3)
+    occluders = points[:, [7, 42]]
+    monkeypatch.setattr(
+        occlusion_utils, "_sample_valid_points", lambda p, m, k: occluders
+    )
+
+    ball = occlusion_utils.ball_occlusion_mask(points, radius=0.5, num_occluders=2)
+    dists = torch.cdist(points[0], occluders[0])
+    assert torch.equal(ball[0], (dists >= 0.5).all(-1))
+
+    plane = occlusion_utils.plane_occlusion_mask(points, stand_off=0.1, num_occluders=2)
+    expected = torch.ones(300, dtype=torch.bool)
+    center = points[0].mean(0)
+    for pt in occluders[0]:
+        # Same construction as plane_occlusion.
+        n = F.normalize(pt - center, dim=0)
+        expected &= F.normalize(points[0] - (pt - 0.1 * n), dim=-1) @ n < 0
+    assert torch.equal(plane[0], expected)
@@ -0,0 +1,71 @@
+import pickle
+import random
+
+import numpy as np
+import torch
+
+from taxpose.datasets.ndf_dataset import JointOccTrainDataset
+from taxpose.datasets.occupancy_store import (
+    OCC_PICKLES,
+    OccupancyStore,
+    build_manifest,
+    load_manifest,
+    pack_occupancy,
+)
+
+
+def make_ndf_data(root, num_points):
+    rng = np.random.default_rng(0)
+    training_data = root / "training_data"
+    sample_dir = training_data / "mug_table_all_pose_4_cam_half_occ_full_rand_scale"
+    sample_dir.mkdir(parents=True)
+    key = "03797390/abc/models/model_normalized_128.mat"
+    occ = {key: (rng.uniform(-0.5, 0.5, (2000, 3)), rng.integers(0, 2, 2000), None)}
+    for i, name in enumerate(OCC_PICKLES):
+        with open(training_data / name, "wb") as f:
+            pickle.dump(occ if i == 0 else {}, f)
+    for i, n in enumerate(num_points):
+        quats = rng.standard_normal((4, 4))
+        np.savez(
+            sample_dir / f"{i}.npz",
+            object_pose_cam_frame=np.concatenate(
+                [rng.standard_normal((4, 3)), quats / np.linalg.norm(quats)], axis=1
+            ),
+            shapenet_id=np.array("abc"),
+            shapenet_category_id=np.array("03797390"),
+            object_segmentation=rng.integers(0, 480 * 640, (4, 1, n)),
+            depth_observation=rng.uniform(0.5, 2, (4, n)).astype(np.float32),
+            mesh_scale=np.array(0.3),
+        )
+    return occ[key], sorted(sample_dir.glob("*.npz"))
+
+
+def test_packed_occupancy_and_manifest(tmp_path):
+    (coord, labels, _), files = make_ndf_data(tmp_path, [1200, 500, 1100])
+
+    store = OccupancyStore(pack_occupancy(tmp_path))
+    store = pickle.loads(pickle.dumps(store))
+    packed_coord, packed_labels = store.get(
+        "03797390/abc/models/model_normalized_128.mat"
+    )
+    assert isinstance(packed_coord, np.memmap)
+    np.testing.assert_array_equal(packed_coord, coord)
+    np.testing.assert_array_equal(packed_labels, labels)
+
+    valid = load_manifest(build_manifest(tmp_path, files, store))
+    assert valid == {
+        str(files[0].relative_to(tmp_path)),
+        str(files[2].relative_to(tmp_path)),
+    }
+
+    outputs = []
+    for use_packed in [False, True]:
+        dataset = JointOccTrainDataset(
+            tmp_path, obj_class="mug", train_num=3, use_packed=use_packed
+        )
+        assert len(dataset) == (2 if use_packed else 3)
+        random.seed(0)
+        np.random.seed(0)
+        torch.manual_seed(0)
+        outputs.append(dataset[1 if use_packed else 2])
+    assert torch.equal(*outputs)
@@ -0,0 +1,97 @@
+import copy
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from taxpose.models.taxpose import TAXPoseModel, pad_packed
+from taxpose.nets.transformer_flow_pm import ResidualFlow_DiffEmbTransformer
+from taxpose.utils.se3 import dualflow2pose
+
+
+def test_pad_packed():
+    clouds = [torch.randn(n, 3) for n in [5, 2, 7]]
+    pos = torch.cat(clouds)
+    ptr = torch.tensor([0, 5, 7, 14])
+    padded, mask = pad_packed(pos, ptr)
+    assert padded.shape == (3, 7, 3)
+    assert mask.sum(1).tolist() == [5, 2, 7]
+    for cloud, row, m in zip(clouds, padded, mask):
+        assert torch.equal(row[m], cloud)
+        assert (row[~m] == 0).all()
+
+    padded, mask = pad_packed(pos[:14], torch.tensor([0, 7, 14]))
+    assert mask is None and padded.shape == (2, 7, 3)
+
+
+def test_unmasked_archs_reject_ragged_batches():
+    model = TAXPoseModel("dgcnn", embedding_dim=16)
+    # 100 + 300 points would silently view as 2 x 200.
+    action = SimpleNamespace(
+        pos=torch.randn(400, 3), ptr=torch.tensor([0, 100, 400]), num_graphs=2
+    )
+    anchor = SimpleNamespace(
+        pos=torch.randn(400, 3), ptr=torch.tensor([0, 200, 400]), num_graphs=2
+    )
+    with pytest.raises(ValueError, match="packed=False"):
+        model(action, anchor)
+
+
+def test_padded_batch_matches_per_sample():
+    torch.manual_seed(0)
+    model = ResidualFlow_DiffEmbTransformer(emb_dims=32).eval()
+    actions = [torch.randn(n, 3) for n in [40, 25]]
+    anchors = [torch.randn(n, 3) for n in [60, 90]]
+    X, mask_x = pad_packed(torch.cat(actions), torch.tensor([0, 40, 65]))
+    Y, mask_y = pad_packed(torch.cat(anchors), torch.tensor([0, 60, 150]))
+
+    with torch.no_grad():
+        Fx, Fy = model(X, Y, action_mask=mask_x, anchor_mask=mask_y)
+        R, t = dualflow2pose(
+            X,
+            Y,
+            Fx[..., :3],
+            Fy[..., :3],
+            Fx[..., 3],
+            Fy[..., 3],
+            mask_src=mask_x,
+            mask_tgt=mask_y,
+        )
+        for i, (action, anchor) in enumerate(zip(actions, anchors)):
+            fx, fy = model(action[None], anchor[None])
+            torch.testing.assert_close(Fx[i, : len(action)], fx[0])
+            torch.testing.assert_close(Fy[i, : len(anchor)], fy[0])
+            R_i, t_i = dualflow2pose(
+                action[None],
+                anchor[None],
+                fx[..., :3],
+                fy[..., :3],
+                fx[..., 3],
+                fy[..., 3],
+            )
+            torch.testing.assert_close(R[i], R_i[0], atol=1e-4, rtol=1e-4)
+            torch.testing.assert_close(t[i], t_i[0], atol=1e-4, rtol=1e-4)
+
+
+def test_padding_does_not_change_training_batch_norm():
+    torch.manual_seed(0)
+    model = ResidualFlow_DiffEmbTransformer(emb_dims=32).train()
+    padded_model = copy.deepcopy(model)
+    X, Y = torch.randn(2, 40, 3), torch.randn(2, 60, 3)
+    Fx, Fy = model(X, Y)
+
+    # Pad the same clouds with junk points and mask them out.
+    X_pad = torch.cat([X, 5 * torch.randn(2, 10, 3)], dim=1)
+    Y_pad = torch.cat([Y, 5 * torch.randn(2, 30, 3)], dim=1)
+    mask_x = torch.arange(50) < 40
+    mask_y = torch.arange(90) < 60
+    Fx_pad, Fy_pad = padded_model(
+        X_pad,
+        Y_pad,
+        action_mask=mask_x.expand(2, -1),
+        anchor_mask=mask_y.expand(2, -1),
+    )
+    torch.testing.assert_close(Fx_pad[:, :40], Fx)
+    torch.testing.assert_close(Fy_pad[:, :60], Fy)
+    for name, buffer in model.named_buffers():
+        torch.testing.assert_close(dict(padded_model.named_buffers())[name], buffer)
@@ -0,0 +1,113 @@
+import queue
+import random
+
+import numpy as np
+import torch
+from pytorch3d.transforms import Transform3d
+from torch import nn
+
+from taxpose.utils.parallel_eval import (
+    run_sharded_eval,
+    seed_trial,
+    serve_models,
+    shard_trials,
+)
+
+
+def _evaluate(trial_ids, models):
+    results = []
+    for trial in trial_ids:
+        seed_trial(0, trial)
+        results.append(
+            dict(
+                trial=trial,
+                draw=(random.random(), np.random.rand(), torch.rand(1).item()),
+            )
+        )
+    return results
+
+
+class _CentroidModel(nn.Module):
+    """Translates the action centroid onto the anchor centroid, per sample."""
+
+    device = torch.device("cpu")
+
+    def get_transform(self, points_trans_action, points_trans_anchor):
+        T = torch.eye(4).repeat(len(points_trans_action), 1, 1)
+        T[:, 3, :3] = points_trans_anchor.mean(1) - points_trans_action.mean(1)
+        return {
+            "pred_T_action": Transform3d(matrix=T),
+            "pred_flow_action": T[:, None, 3, :3] + 0 * points_trans_action,
+        }
+
+
+def _build_models():
+    return {"centroid": _CentroidModel()}
+
+
+def _evaluate_poses(trial_ids, models):
+    results = []
+    for trial in trial_ids:
+        seed_trial(0, trial)
+        # Trials differ in size, so some requests can batch and some can't.
+        action, anchor = torch.rand(1, 10 + trial % 2, 3), torch.rand(1, 20, 3)
+        ans = models["centroid"].get_transform(action, anchor)
+        results.append(dict(trial=trial, T=ans["pred_T_action"].get_matrix().tolist()))
+    return results
+
+
+def test_shard_trials():
+    shards = shard_trials(list(range(10)), 3)
+    assert shards == [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]]
+    assert shard_trials([1, 2], 4) == [[1], [2], [], []]
+
+
+def test_trials_do_not_depend_on_sharding():
+    serial = run_sharded_eval(_evaluate, (), list(range(6)), dict, (), [])
+    sharded = sorted(
+        sum((_evaluate(shard, {}) for shard in shard_trials(list(range(6)), 4)), []),
+        key=lambda r: r["trial"],
+    )
+    assert serial == sharded
+    assert len({r["draw"] for r in serial}) == 6
+
+
+def test_server_batches_requests_and_splits_responses():
+    requests = queue.Queue()
+    responses = [queue.Queue(), queue.Queue()]
+    stats = queue.Queue()
+    points = {
+        0: (np.random.rand(1, 10, 3), np.random.rand(1, 20, 3)),
+        1: (np.random.rand(2, 10, 3), np.random.rand(2, 20, 3)),
+    }
+    for worker_id, (action, anchor) in points.items():
+        requests.put((worker_id, "centroid", action, anchor, 0.0))
+    requests.put(None)
+    serve_models(_build_models, (), requests, responses, stats, 4, 0.0)
+
+    for worker_id, (action, anchor) in points.items():
+        response = responses[worker_id].get_nowait()
+        assert response["batch_size"] == 3
+        shift = anchor.mean(1) - action.mean(1)
+        np.testing.assert_allclose(response["pred_T_action"][:, 3, :3], shift)
+        assert response["pred_flow_action"].shape == action.shape
+        assert responses[worker_id].empty()
+    assert [batch_size for _, _, batch_size in stats.get_nowait()] == [3, 3]
+
+
+def test_worker_processes_match_in_process_eval():
+    trial_ids = list(range(8))
+    serial = run_sharded_eval(
+        _evaluate_poses, (), trial_ids, _build_models, (), ["centroid"]
+    )
+    sharded = run_sharded_eval(
+        _evaluate_poses,
+        (),
+        trial_ids,
+        _build_models,
+        (),
+        ["centroid"],
+        num_workers=3,
+    )
+    assert [r["trial"] for r in sharded] == trial_ids
+    assert sharded == serial
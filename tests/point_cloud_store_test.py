@@ -0,0 +1,35 @@
+import pickle
+
+import numpy as np
+
+from taxpose.datasets.point_cloud_store import (
+    PackedPointCloudStore,
+    compute_camera_idxs,
+    pack_point_clouds,
+)
+
+
+def test_pack_roundtrip(tmp_path):
+    rng = np.random.default_rng(0)
+    demos = {}
+    for idx in [3, 0, 11]:
+        # 4 cameras, each listing its points in class order 0, 1, 2.
+        classes = np.concatenate([np.repeat([0, 1, 2], rng.integers(1, 20, 3))] * 4)
+        clouds = rng.standard_normal((len(classes), 3)).astype(np.float32)
+        np.savez(
+            tmp_path / f"{idx}_final_obj_points.npz", clouds=clouds, classes=classes
+        )
+        demos[idx] = (clouds, classes)
+
+    store = PackedPointCloudStore(pack_point_clouds(tmp_path, "final"))
+    assert list(store.demo_ids) == [0, 3, 11]
+    assert 5 not in store
+
+    store = pickle.loads(pickle.dumps(store))
+    for idx, (clouds, classes) in demos.items():
+        points, packed_classes, camera_idxs = store.get(idx)
+        assert isinstance(points, np.memmap)
+        np.testing.assert_array_equal(points, clouds)
+        np.testing.assert_array_equal(packed_classes, classes)
+        np.testing.assert_array_equal(camera_idxs, compute_camera_idxs(classes))
+        assert set(camera_idxs) == {0, 1, 2, 3}
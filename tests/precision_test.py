@@ -0,0 +1,24 @@
+import torch
+
+from taxpose.utils.se3 import dualflow2pose
+
+
+def test_pose_solving_stays_fp32_under_autocast():
+    torch.manual_seed(0)
+    xyz_src, xyz_tgt = torch.rand(2, 64, 3), torch.rand(2, 80, 3)
+    flow_src, flow_tgt = torch.randn(2, 64, 3), torch.randn(2, 80, 3)
+    w_src, w_tgt = torch.rand(2, 64), torch.rand(2, 80)
+    R_ref, t_ref = dualflow2pose(xyz_src, xyz_tgt, flow_src, flow_tgt, w_src, w_tgt)
+
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        R, t = dualflow2pose(
+            xyz_src,
+            xyz_tgt,
+            flow_src.bfloat16(),
+            flow_tgt.bfloat16(),
+            w_src.bfloat16(),
+            w_tgt.bfloat16(),
+        )
+    assert R.dtype == t.dtype == torch.float32
+    assert torch.allclose(R.det(), torch.ones(2), atol=1e-5)
+    assert torch.allclose(R, R_ref, atol=0.05) and torch.allclose(t, t_ref, atol=0.05)
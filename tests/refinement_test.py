@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+from pytorch3d.transforms import axis_angle_to_matrix, so3_rotation_angle
+from torch import nn
+
+from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
+from taxpose.training.flow_equivariance_training_module_nocentering_eval_init import (
+    EquivarianceTestingModule,
+)
+from taxpose.utils.se3 import rotation_angle
+
+
+def test_batched_refinement_matches_single_scenes():
+    torch.manual_seed(0)
+    network = ResidualFlow_DiffEmbTransformer(emb_dims=32, center_feature=True)
+    model = EquivarianceTestingModule(network.eval(), loop=1)
+    points_action, points_anchor = torch.rand(3, 64, 3), torch.rand(3, 80, 3) + 0.5
+
+    # Pick the tolerance so that only some scenes converge after the first pass.
+    first_step = model.get_transform(points_action, points_anchor)["pred_T_action"]
+    angles = so3_rotation_angle(first_step.get_matrix()[:, :3, :3]) * 180 / np.pi
+    model.loop = 4
+    model.refine_rot_tol = angles.median().item()
+    model.refine_trans_tol = float("inf")
+
+    ans = model.get_transform(points_action, points_anchor)
+    for i in range(3):
+        ans_i = model.get_transform(points_action[i : i + 1], points_anchor[i : i + 1])
+        assert ans["refine_steps"][i] == ans_i["refine_steps"][0]
+        assert torch.allclose(
+            ans["pred_T_action"].get_matrix()[i],
+            ans_i["pred_T_action"].get_matrix()[0],
+            atol=1e-5,
+        )
+        assert torch.allclose(
+            ans["pred_flow_action"][i], ans_i["pred_flow_action"][0], atol=1e-5
+        )
+    # Some scenes stop early, some use every pass.
+    assert 1 <= ans["refine_steps"].min() < ans["refine_steps"].max() <= 4
+
+
+class SmallRotation(nn.Module):
+    """Flows of a fixed rotation by `degrees` about z."""
+
+    return_flow_component = False
+
+    def __init__(self, degrees):
+        super().__init__()
+        self.R = axis_angle_to_matrix(
+            torch.tensor([[0.0, 0.0, np.radians(degrees)]])
+        ).float()
+
+    def forward(self, points_action, points_anchor):
+        flow_action = points_action @ self.R - points_action
+        flow_anchor = points_anchor @ self.R.transpose(-1, -2) - points_anchor
+        return flow_action, flow_anchor
+
+
+def test_early_exit_below_one_degree():
+    torch.manual_seed(0)
+    model = EquivarianceTestingModule(SmallRotation(0.2), loop=4)
+    model.refine_rot_tol = 0.5
+    model.refine_trans_tol = 1e-3
+    points_action, points_anchor = torch.rand(2, 64, 3), torch.rand(2, 80, 3) + 0.5
+
+    ans = model.get_transform(points_action, points_anchor)
+    assert (ans["refine_steps"] == 1).all()
+
+    R = axis_angle_to_matrix(torch.tensor([[0.0, 0.0, np.radians(0.2)]]).double())
+    angle = rotation_angle(R) * 180 / np.pi
+    assert torch.allclose(angle, torch.tensor([0.2], dtype=torch.float64))
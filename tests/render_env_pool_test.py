@@ -0,0 +1,78 @@
+import pybullet as p
+import pybullet_data
+import pytest
+
+from taxpose.datasets.render_env_pool import RenderEnvPool
+
+CAMERA = [-3, 0, 1.2]
+
+
+class FakeRenderEnv:
+    """The parts of PMRenderEnv the pool touches, on a stock pybullet_data URDF."""
+
+    def __init__(self, obj_id, dataset_path, camera_pos):
+        self.client_id = p.connect(p.DIRECT)
+        p.setAdditionalSearchPath(
+            pybullet_data.getDataPath(), physicsClientId=self.client_id
+        )
+        p.loadURDF("plane.urdf", physicsClientId=self.client_id)
+        self.obj_id = p.loadURDF(
+            obj_id, useFixedBase=True, physicsClientId=self.client_id
+        )
+        self.camera_pos = camera_pos
+        self.closed = False
+
+    def set_camera(self, camera_pos):
+        self.camera_pos = camera_pos
+
+    def close(self):
+        self.closed = True
+        p.disconnect(self.client_id)
+
+
+def joint_state(env):
+    return [
+        p.getJointState(env.obj_id, i, physicsClientId=env.client_id)[:2]
+        for i in range(p.getNumJoints(env.obj_id, physicsClientId=env.client_id))
+    ]
+
+
+@pytest.fixture
+def pool():
+    pool = RenderEnvPool(FakeRenderEnv, max_size=1)
+    yield pool
+    pool.close()
+
+
+def test_pooled_env_is_reset(pool):
+    env = pool.get("r2d2.urdf", "root", CAMERA)
+    n_bodies = p.getNumBodies(physicsClientId=env.client_id)
+    joints = joint_state(env)
+
+    # Dirty the scene the way a (failed) sample would.
+    for i in range(p.getNumJoints(env.obj_id, physicsClientId=env.client_id)):
+        p.resetJointState(env.obj_id, i, 0.7, 0.1, physicsClientId=env.client_id)
+    p.loadURDF("cube_small.urdf", physicsClientId=env.client_id)
+    env.set_camera("random")
+
+    assert pool.get("r2d2.urdf", "root", CAMERA) is env
+    assert p.getNumBodies(physicsClientId=env.client_id) == n_bodies
+    assert joint_state(env) == joints
+    assert env.camera_pos == CAMERA
+
+
+def test_evicted_env_is_closed(pool):
+    first = pool.get("r2d2.urdf", "root", CAMERA)
+    second = pool.get("cube_small.urdf", "root", CAMERA)
+    assert first.closed and not second.closed
+    assert pool.get("r2d2.urdf", "root", CAMERA) is not first
+    assert second.closed
+
+
+def test_pool_starts_over_in_new_process(pool, monkeypatch):
+    env = pool.get("r2d2.urdf", "root", CAMERA)
+    # Pretend we were forked: the inherited client must not be reused.
+    monkeypatch.setattr(pool, "_pid", -1)
+    new_env = pool.get("r2d2.urdf", "root", CAMERA)
+    assert new_env is not env and not env.closed
+    env.close()
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import torch
+from pytorch3d.transforms import Transform3d
+
+from taxpose.utils import se3
+from taxpose.utils.se3 import (
+    consensus_pose,
+    dualflow2pose,
+    fuse_hypotheses,
+    random_se3,
+    symmetric_orthogonalization,
+)
+
+
+@pytest.mark.parametrize("batch_size", [1, 16, 1024])
+def test_quaternion_solver_matches_svd(batch_size):
+    torch.manual_seed(0)
+    M = torch.randn(batch_size, 3, 3, dtype=torch.float64, requires_grad=True)
+    W = torch.randn(3, 3, dtype=torch.float64)
+
+    R_svd = symmetric_orthogonalization(M, rotation_solver="svd")
+    R_quat = symmetric_orthogonalization(M, rotation_solver="quaternion")
+    assert torch.allclose(R_svd, R_quat)
+
+    (g_svd,) = torch.autograd.grad((R_svd * W).sum(), M)
+    (g_quat,) = torch.autograd.grad((R_quat * W).sum(), M)
+    assert torch.allclose(g_svd, g_quat)
+
+
+@pytest.mark.parametrize("debug_checks", [False, True])
+def test_dualflow2pose_runs_on_cpu(debug_checks, monkeypatch):
+    torch.manual_seed(0)
+    # Restored after the test, whether it passes or not.
+    monkeypatch.setattr(se3, "DEBUG_CHECKS", debug_checks)
+    T_gt = random_se3(4, rot_var=np.pi, trans_var=0.5)
+    xyz_src, xyz_tgt = torch.randn(4, 100, 3), torch.randn(4, 120, 3)
+    flow_src = T_gt.transform_points(xyz_src) - xyz_src
+    flow_tgt = T_gt.inverse().transform_points(xyz_tgt) - xyz_tgt
+
+    T_pred = dualflow2pose(
+        xyz_src, xyz_tgt, flow_src, flow_tgt, return_transform3d=True
+    )
+
+    assert torch.allclose(T_pred.get_matrix(), T_gt.get_matrix(), atol=1e-4)
+
+
+def test_consensus_pose_rejects_outlier():
+    torch.manual_seed(0)
+    points = torch.randn(100, 3)
+    T = torch.eye(4).repeat(5, 1, 1)
+    T[:, 3, :3] = torch.tensor([0.1, 0.2, 0.3]) + 1e-3 * torch.randn(5, 3)
+    T[2, :3, :3] = torch.tensor([[0.0, 1.0, 0.0], [-1.0, 0.0, 0.0], [0.0, 0.0, 1.0]])
+
+    fused, idx = consensus_pose(T, points, mode="medoid")
+    assert idx != 2
+    assert torch.equal(fused, T[idx : idx + 1])
+
+    fused, idx = consensus_pose(T[[0, 1, 3, 4]], points, mode="mean")
+    assert idx is None
+    assert torch.allclose(fused[0, :3, :3], torch.eye(3), atol=1e-5)
+    assert torch.allclose(fused[0, 3, :3], T[[0, 1, 3, 4], 3, :3].mean(0))
+
+
+def test_fuse_hypotheses_keeps_hypotheses():
+    torch.manual_seed(0)
+    T = torch.eye(4).repeat(3, 1, 1)
+    T[:, 3, :3] = torch.tensor([[0.0, 0.0, 0.0], [0.1, 0.0, 0.0], [5.0, 0.0, 0.0]])
+    hypotheses = Transform3d(matrix=T)
+    ans = fuse_hypotheses({"pred_T_action": hypotheses}, torch.randn(50, 3))
+    assert ans["hypotheses_T_action"] is hypotheses
+    assert ans["hypothesis_idx"] in (0, 1)
+    i = ans["hypothesis_idx"]
+    assert torch.equal(ans["pred_T_action"].get_matrix(), T[i : i + 1])
@@ -0,0 +1,77 @@
+import numpy as np
+
+from taxpose.datasets.shard_store import ShardedDataset, build_shards, load_manifest
+
+SCENES = [("a", "block", "0"), ("b", "bowl", "1"), ("c", "ell", "2")]
+
+
+class CountingDataset:
+    calls = 0
+
+    def __init__(self, root, scene_ids, scale=1.0, env_pool_size=0):
+        self.scale = scale
+
+    def get_data(self, obj_id, action_id, goal_id, seed=None):
+        CountingDataset.calls += 1
+        if obj_id == "c":
+            raise ValueError("no valid pose")
+        return self.scale * np.random.default_rng(seed).random(3)
+
+
+def build(tmp_path, n_repeat, **kwargs):
+    dset_kwargs = {"root": str(tmp_path), "scene_ids": SCENES, **kwargs}
+    CountingDataset.calls = 0
+    stats = build_shards(
+        CountingDataset, dset_kwargs, SCENES, tmp_path, n_repeat=n_repeat, seed=0
+    )
+    return dset_kwargs, stats, CountingDataset.calls
+
+
+def test_build_shards_resumes_and_content_addresses(tmp_path):
+    dset_kwargs, stats, calls = build(tmp_path, 2)
+    assert calls == 6
+    (worker,) = stats.values()
+    assert worker["samples"] == 4 and worker["failed"] == 2
+    first = ShardedDataset(tmp_path, dset_kwargs, SCENES, n_repeat=2, seed=0)
+    assert len(first) == 4
+
+    # More repeats only generate the new ones; failed samples are not retried.
+    _, _, calls = build(tmp_path, 3)
+    assert calls == 3
+    # Kwargs that don't change the samples don't invalidate them.
+    _, stats, calls = build(tmp_path, 3, env_pool_size=4)
+    assert stats == {} and calls == 0
+    # Kwargs that do only add new samples, next to the old ones.
+    scaled_kwargs, _, calls = build(tmp_path, 2, scale=2.0)
+    assert calls == 6
+
+    dset = ShardedDataset(tmp_path, dset_kwargs, SCENES, n_repeat=3, seed=0)
+    assert len(dset) == 6
+    for i in range(2):
+        np.testing.assert_array_equal(dset[i], first[i])
+    scaled = ShardedDataset(tmp_path, scaled_kwargs, SCENES, n_repeat=2, seed=0)
+    np.testing.assert_allclose(scaled[0], 2 * first[0])
+
+    dset_kwargs, _, calls = build(tmp_path, 3)
+    assert calls == 0
+    CountingDataset.calls = 0
+    build_shards(
+        CountingDataset,
+        dset_kwargs,
+        SCENES,
+        tmp_path,
+        n_repeat=3,
+        seed=0,
+        retry_failed=True,
+    )
+    assert CountingDataset.calls == 3
+
+
+def test_load_manifest_ignores_partial_line(tmp_path):
+    build(tmp_path, 2)
+    with open(tmp_path / "manifest.jsonl", "a") as f:
+        f.write('{"shard": "abc", "samp')
+    built, failed = load_manifest(tmp_path)
+    assert len(built) == 4 and len(failed) == 2
+    _, _, calls = build(tmp_path, 2)
+    assert calls == 0
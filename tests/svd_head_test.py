@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from taxpose.models.taxpose import SVDHead, batched_procrustes
+
+
+def looped_procrustes(H, reflect):
+    # The original per-sample implementation of SVDHead, kept as a reference.
+    U, S, V, R = [], [], [], []
+    for i in range(H.size(0)):
+        u, s, v = torch.linalg.svd(H[i])
+        r = torch.matmul(v, u.transpose(1, 0).contiguous())
+        if torch.det(r) < 0:
+            v = torch.matmul(v, reflect)
+            r = torch.matmul(v, u.transpose(1, 0).contiguous())
+        U.append(u)
+        S.append(s)
+        V.append(v)
+        R.append(r)
+    return tuple(torch.stack(x, dim=0) for x in (U, S, V, R))
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 64])
+def test_batched_procrustes_parity(batch_size):
+    torch.manual_seed(0)
+    H = torch.randn(batch_size, 3, 3, dtype=torch.float64)
+    reflect = torch.diag(torch.tensor([1.0, 1.0, -1.0], dtype=torch.float64))
+
+    for expected, actual in zip(
+        looped_procrustes(H, reflect), batched_procrustes(H, reflect)
+    ):
+        assert torch.allclose(expected, actual)
+
+
+def test_svd_head_returns_rotations():
+    torch.manual_seed(0)
+    head = SVDHead()
+    src_emb, tgt_emb = torch.randn(16, 16, 100), torch.randn(16, 16, 120)
+    src, tgt = torch.randn(16, 3, 100), torch.randn(16, 3, 120)
+
+    R, t = head(src_emb, tgt_emb, src, tgt)
+
+    assert R.shape == (16, 3, 3) and t.shape == (16, 3)
+    assert torch.allclose(torch.det(R), torch.ones(16), atol=1e-5)
@@ -0,0 +1,30 @@
+import pytest
+import torch
+
+from taxpose.nets.transformer_flow import ResidualFlow_DiffEmbTransformer
+
+
+@pytest.mark.parametrize("memory_efficient_attn", [False, True])
+def test_fused_twin_branches_match_separate(memory_efficient_attn):
+    torch.manual_seed(0)
+    model = ResidualFlow_DiffEmbTransformer(
+        emb_dims=32, center_feature=True, memory_efficient_attn=memory_efficient_attn
+    )
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(0.1 * torch.randn_like(p))
+    action, anchor = torch.rand(3, 64, 3), torch.rand(3, 64, 3)
+
+    with torch.no_grad():
+        expected = model(action, anchor)
+        model.fuse_twin_branches = True
+        actual = model(action, anchor)
+        # Fused weights follow in-place updates of the originals.
+        model.emb_nn_anchor.conv1.weight.mul_(2)
+        model.transformer_action.model.encoder.norm.a_2.mul_(2)
+        updated = model(action, anchor)
+        model.fuse_twin_branches = False
+        expected_updated = model(action, anchor)
+
+    for e, a in zip(expected + expected_updated, actual + updated):
+        assert torch.allclose(e, a, atol=1e-4)
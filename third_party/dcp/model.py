@@ -3,6 +3,11 @@
 # Only changes:
 # - Change `from util import quat2mat` to `from .util import quat2mat`.
 # - Add this comment.
+# - Make `knn`/`get_graph_feature` device-agnostic, tile the kNN query points,
+#   use torch_cluster's KD-tree on CPU, and let DGCNN reuse a precomputed index.
+# - Add `memory_efficient_attention` and a `memory_efficient` mode to
+#   MultiHeadedAttention that only keeps the head-averaged attention.
+# - Build the kNN graph in fp32 under autocast.
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
@@ -20,6 +25,18 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 from .util import quat2mat
 
+try:
+    import torch_cluster
+except ImportError:
+    torch_cluster = None
+
+# Number of query points per tile when building the kNN graph. Bounds the
+# pairwise-distance buffer to B x KNN_CHUNK_SIZE x N instead of B x N x N.
+KNN_CHUNK_SIZE = 2048
+
+# Number of query rows per tile in `memory_efficient_attention`.
+ATTN_CHUNK_SIZE = 1024
+
 
 # Part of the code is referred from: http://nlp.seas.harvard.edu/2018/04/03/attention.html#positional-encoding
 
@@ -36,6 +53,33 @@ def attention(query, key, value, mask=None, dropout=None):
     return torch.matmul(p_attn, value), p_attn
 
 
+def memory_efficient_attention(query, key, value, need_attn=False, chunk_size=ATTN_CHUNK_SIZE):
+    """Unmasked `attention` that never holds the full (B, h, N, M) score tensor.
+
+    If the head-averaged attention is not needed, this uses the fused
+    F.scaled_dot_product_attention kernel when available. Otherwise query rows are
+    processed in tiles of `chunk_size` (softmax is row-wise, so tiling is exact)
+    and only the (B, 1, N, M) head average is kept, or None if not needed.
+    """
+    if not need_attn and hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(query, key, value), None
+
+    d_k = query.size(-1)
+    num_queries = query.size(-2)
+    if chunk_size is None:
+        chunk_size = num_queries
+    x, p_attn_mean = [], []
+    for start in range(0, num_queries, chunk_size):
+        q = query[..., start:start + chunk_size, :]
+        scores = torch.matmul(q, key.transpose(-2, -1).contiguous()) / math.sqrt(d_k)
+        p_attn = F.softmax(scores, dim=-1)
+        x.append(torch.matmul(p_attn, value))
+        if need_attn:
+            p_attn_mean.append(p_attn.mean(dim=1, keepdim=True))
+    x = torch.cat(x, dim=-2)
+    return x, torch.cat(p_attn_mean, dim=-2) if need_attn else None
+
+
 def nearest_neighbor(src, dst):
     inner = -2 * torch.matmul(src.transpose(1, 0).contiguous(), dst)  # src, dst (num_dims, num_points)
     distances = -torch.sum(src ** 2, dim=0, keepdim=True).transpose(1, 0).contiguous() - inner - torch.sum(dst ** 2,
@@ -45,22 +89,71 @@ def nearest_neighbor(src, dst):
     return distances, indices
 
 
-def knn(x, k):
-    inner = -2 * torch.matmul(x.transpose(2, 1).contiguous(), x)
-    xx = torch.sum(x ** 2, dim=1, keepdim=True)
-    pairwise_distance = -xx - inner - xx.transpose(2, 1).contiguous()
+def knn(x, k, chunk_size=KNN_CHUNK_SIZE, mask=None):
+    """Indices of the k nearest neighbours (including the point itself).
 
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]  # (batch_size, num_points, k)
-    return idx
-
-
-def get_graph_feature(x, k=20):
+    x: (batch_size, num_dims, num_points)
+    Query points are processed in tiles of `chunk_size` so the peak allocation
+    is O(chunk_size * N) rather than O(N^2). `chunk_size=None` disables tiling.
+    mask: optional (batch_size, num_points) bool, False for padding points,
+    which are then never picked as neighbours.
+    Returns idx: (batch_size, num_points, k)
+    """
+    num_points = x.size(2)
+    xx = torch.sum(x ** 2, dim=1, keepdim=True)  # (batch_size, 1, num_points)
+    if mask is not None:
+        # Padding points are infinitely far from every query.
+        xx = xx.masked_fill(~mask.unsqueeze(1), float('inf'))
+    if chunk_size is None or chunk_size >= num_points:
+        inner = -2 * torch.matmul(x.transpose(2, 1).contiguous(), x)
+        pairwise_distance = -xx - inner - xx.transpose(2, 1).contiguous()
+        return pairwise_distance.topk(k=k, dim=-1)[1]  # (batch_size, num_points, k)
+
+    x_t = x.transpose(2, 1).contiguous()  # (batch_size, num_points, num_dims)
+    xx_t = xx.transpose(2, 1).contiguous()
+    idx = []
+    for start in range(0, num_points, chunk_size):
+        end = min(start + chunk_size, num_points)
+        inner = -2 * torch.matmul(x_t[:, start:end], x)
+        pairwise_distance = -xx - inner - xx_t[:, start:end]
+        idx.append(pairwise_distance.topk(k=k, dim=-1)[1])
+    return torch.cat(idx, dim=1)
+
+
+def knn_kdtree(x, k):
+    """CPU fast path for `knn` using torch_cluster's KD-tree.
+
+    Neighbour order within a row may differ from `knn` (DGCNN max-pools over
+    neighbours, so only the set matters).
+    """
+    batch_size, num_dims, num_points = x.size()
+    pos = x.detach().transpose(2, 1).reshape(batch_size * num_points, num_dims)
+    batch = torch.arange(batch_size, device=x.device).repeat_interleave(num_points)
+    _, col = torch_cluster.knn(pos, pos, k, batch, batch, num_workers=torch.get_num_threads())
+    idx = col.view(batch_size, num_points, k)
+    return idx - torch.arange(batch_size, device=x.device).view(-1, 1, 1) * num_points
+
+
+def build_knn_idx(x, k=20, chunk_size=KNN_CHUNK_SIZE, mask=None):
+    """Pick the kNN backend for x's device. The result can be passed to
+    `get_graph_feature(..., idx=idx)` to reuse the graph across calls.
+    Distances are always computed in fp32, also under autocast, since reduced
+    precision changes which neighbours are picked. Padded batches (mask given)
+    always use `knn`."""
+    x = x.float()
+    if x.device.type == 'cpu' and torch_cluster is not None and x.size(2) >= k and mask is None:
+        return knn_kdtree(x, k)
+    with torch.autocast(x.device.type, enabled=False):
+        return knn(x, k, chunk_size=chunk_size, mask=mask)
+
+
+def get_graph_feature(x, k=20, idx=None, chunk_size=KNN_CHUNK_SIZE):
     # x = x.squeeze()
-    idx = knn(x, k=k)  # (batch_size, num_points, k)
-    batch_size, num_points, _ = idx.size()
-    device = torch.device('cuda')
+    if idx is None:
+        idx = build_knn_idx(x, k=k, chunk_size=chunk_size)  # (batch_size, num_points, k)
+    batch_size, num_points, k = idx.size()
 
-    idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1) * num_points
+    idx_base = torch.arange(0, batch_size, device=x.device).view(-1, 1, 1) * num_points
 
     idx = idx + idx_base
 
@@ -72,7 +165,7 @@ def get_graph_feature(x, k=20):
                     1).contiguous()  # (batch_size, num_points, num_dims)  -> (batch_size*num_points, num_dims) #   batch_size * num_points * k + range(0, batch_size*num_points)
     feature = x.view(batch_size * num_points, -1)[idx, :]
     feature = feature.view(batch_size, num_points, k, num_dims)
-    x = x.view(batch_size, num_points, 1, num_dims).repeat(1, 1, k, 1)
+    x = x.view(batch_size, num_points, 1, num_dims).expand(-1, -1, k, -1)
 
     feature = torch.cat((feature, x), dim=3).permute(0, 3, 1, 2)
 
@@ -219,6 +312,10 @@ class MultiHeadedAttention(nn.Module):
         self.linears = clones(nn.Linear(d_model, d_model), 4)
         self.attn = None
         self.dropout = None
+        # In memory-efficient mode `self.attn` holds the (B, 1, N, M) head average,
+        # and only if `need_attn` is set.
+        self.memory_efficient = False
+        self.need_attn = True
 
     def forward(self, query, key, value, mask=None):
         "Implements Figure 2"
@@ -233,8 +330,11 @@ class MultiHeadedAttention(nn.Module):
              for l, x in zip(self.linears, (query, key, value))]
 
         # 2) Apply attention on all the projected vectors in batch.
-        x, self.attn = attention(query, key, value, mask=mask,
-                                 dropout=self.dropout)
+        if self.memory_efficient and mask is None:
+            x, self.attn = memory_efficient_attention(query, key, value, need_attn=self.need_attn)
+        else:
+            x, self.attn = attention(query, key, value, mask=mask,
+                                     dropout=self.dropout)
 
         # 3) "Concat" using a view and apply a final linear.
         x = x.transpose(1, 2).contiguous() \
@@ -280,8 +380,9 @@ class PointNet(nn.Module):
 
 
 class DGCNN(nn.Module):
-    def __init__(self, emb_dims=512):
+    def __init__(self, emb_dims=512, knn_chunk_size=KNN_CHUNK_SIZE):
         super(DGCNN, self).__init__()
+        self.knn_chunk_size = knn_chunk_size
         self.conv1 = nn.Conv2d(6, 64, kernel_size=1, bias=False)
         self.conv2 = nn.Conv2d(64, 64, kernel_size=1, bias=False)
         self.conv3 = nn.Conv2d(64, 128, kernel_size=1, bias=False)
@@ -293,9 +394,9 @@ class DGCNN(nn.Module):
         self.bn4 = nn.BatchNorm2d(256)
         self.bn5 = nn.BatchNorm2d(emb_dims)
 
-    def forward(self, x):
+    def forward(self, x, idx=None):
         batch_size, num_dims, num_points = x.size()
-        x = get_graph_feature(x)
+        x = get_graph_feature(x, idx=idx, chunk_size=self.knn_chunk_size)
         x = F.relu(self.bn1(self.conv1(x)))
         x1 = x.max(dim=-1, keepdim=True)[0]
 